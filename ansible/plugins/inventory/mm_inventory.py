@@ -20,27 +20,73 @@ __metaclass__ = type
 import sys
 import re
 import os
+import argparse
+import bisect
 import json
 import time
+import base64
+import binascii
+import copy
+import fnmatch
+import hashlib
+import mmap
+import select
+import socket
+import ssl
+import struct
+import zlib
+from array import array
+import tempfile
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
 from ansible import constants as C
+try:
+    from ansible import context
+except ImportError:
+    # Ansible 2.7- has no CLI arguments in a context
+    context = None
 from ansible.errors import AnsibleError
 from ansible.module_utils import six
-from ansible.module_utils.urls import Request, urllib_error, ConnectionError, socket, httplib
-from ansible.module_utils._text import to_native
+from ansible.module_utils._text import to_bytes, to_native
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.parse import unquote, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
 from ansible.errors import AnsibleParserError
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
-from ansible.module_utils.six.moves.urllib.error import HTTPError, URLError
-from ansible.module_utils.urls import open_url, SSLValidationError
 from ansible.plugins.loader import inventory_loader
+from ansible.parsing.yaml.dumper import AnsibleDumper
+import jinja2
+import yaml
 
 # Python 2/3 Compatibility
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     from urlparse import urljoin
 except ImportError:
     from urllib.parse import urljoin
 
+# Faster JSON codecs, when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 # Debugging stuff
 from ansible.utils.display import Display
+try:
+    from ansible.module_utils.common.json import AnsibleJSONEncoder
+except ImportError:
+    # Ansible 2.11-
+    from ansible.parsing.ajson import AnsibleJSONEncoder
 display = Display()
 
 DOCUMENTATION = '''
@@ -51,6 +97,7 @@ DOCUMENTATION = '''
     version_added: "2.7"
     extends_documentation_fragment:
       - inventory_cache
+      - constructed
     description:
       - Reads inventories from Micetro.
       - Supports reading configuration from both YAML config file and environment variables.
@@ -71,25 +118,260 @@ DOCUMENTATION = '''
         type: string
         env:
           - name: MM_HOST
-        required: True
+        required: False
       user:
         description: The user that you plan to use to access inventories in your Micetro
         type: string
         env:
           - name: MM_USER
-        required: True
+        required: False
       password:
         description: The password for your Micetro user.
         type: string
         env:
           - name: MM_PASSWORD
-        required: True
+        required: False
+      validate_certs:
+        description: Validate the TLS certificate of the Micetro host
+        type: bool
+        default: False
+        env:
+          - name: MM_VALIDATE_CERTS
+        required: False
+      ca_bundle:
+        description: File with the CA certificates to validate the Micetro host with,
+                     the system CA certificates are used when not set
+        type: path
+        env:
+          - name: MM_CA_BUNDLE
+        required: False
+      client_cert:
+        description: File with the client certificate to present to the Micetro host
+        type: path
+        env:
+          - name: MM_CLIENT_CERT
+        required: False
+      client_key:
+        description: File with the private key of the client certificate,
+                     not needed when the key is in the client_cert file
+        type: path
+        env:
+          - name: MM_CLIENT_KEY
+        required: False
       ranges:
-        description: Ranges to get the inventory from (e.g. 172.16.17.0/24)
+        description:
+          - Ranges to get the inventory from (e.g. 172.16.17.0/24)
+          - A network in CIDR notation selects all ranges inside that
+            network, so a supernet (e.g. 10.0.0.0/8) selects all ranges
+            below it. Other values are matched on the name of a range
+            and select that range and its child ranges.
+          - Every host is in a group for the smallest range it is in and
+            for the selected ranges above that one.
         type: list
         env:
           - name: MM_RANGES
         required: False
+      cache_columnar:
+        description:
+          - Also save the whole inventory in a columnar cache file of the
+            plugin, next to the cache, or in the temporary directory when
+            the cache is not in a directory. While the file is younger than
+            the lowest of I(cache_timeout) and I(cache_ttls), the inventory
+            is loaded from this file instead of from the cache plugin.
+          - The file is compressed and memory mapped, so it loads a lot
+            faster than the cache plugin, and the custom properties and
+            host variables are only loaded when they are used.
+        type: bool
+        default: False
+        env:
+          - name: MM_CACHE_COLUMNAR
+        required: False
+      snapshot:
+        description:
+          - A snapshot of the inventory, made by running this plugin as a
+            script. While the snapshot is fresh and was made with the same
+            settings, the inventory is loaded from it, without Micetro and
+            without the cache.
+          - A file ending in C(.json) is JSON, other files are YAML.
+          - The file has the layout of C(ansible-inventory --list), not
+            the one of the C(yaml) inventory plugin, so only this option
+            reads it.
+        type: path
+        env:
+          - name: MM_SNAPSHOT
+        required: False
+      snapshot_max_age:
+        description:
+          - Age in seconds of the oldest I(snapshot) that is used, with 0
+            a snapshot of any age is used.
+        type: int
+        default: 3600
+        env:
+          - name: MM_SNAPSHOT_MAX_AGE
+        required: False
+      cache_ttls:
+        description:
+          - Cache timeouts in seconds for some of the ranges, instead of
+            I(cache_timeout). The keys are ranges like in I(ranges), so a
+            network in CIDR notation sets the timeout for all ranges in it.
+          - When a range is in more than one entry, the lowest timeout is
+            used.
+          - The cache plugin removes entries after I(cache_timeout). With
+            I(cache_incremental) or I(limit_aware) it keeps them
+            I(cache_max_age) longer, with I(cache_stale_while_revalidate)
+            I(cache_max_stale) longer, whichever is longest. A longer
+            timeout has no effect.
+        type: dict
+        default: {}
+        required: False
+      cache_stale_while_revalidate:
+        description:
+          - When the cache has expired, use the expired inventory and
+            refresh the cache in a background process, so Ansible does
+            not wait for Micetro.
+          - Only one refresh runs at a time and the refreshed cache is
+            used as a whole, when the refresh is done.
+        type: bool
+        default: False
+        env:
+          - name: MM_CACHE_STALE_WHILE_REVALIDATE
+        required: False
+      cache_max_stale:
+        description:
+          - With I(cache_stale_while_revalidate), the number of seconds
+            an expired cache is still used. After that the inventory is
+            fetched right away, like without stale-while-revalidate.
+        type: int
+        default: 86400
+        env:
+          - name: MM_CACHE_MAX_STALE
+        required: False
+      cache_incremental:
+        description:
+          - When enabled, bring an expired cache up to date with the
+            changes in the history of Micetro since it was fetched,
+            instead of fetching all hosts again. Only the ranges with
+            changed addresses are fetched, and only the changed addresses
+            in them.
+          - When the history does not go back far enough, has too many
+            changes, or has changes to ranges, custom property
+            definitions or zones, everything is fetched again.
+          - This keeps the cache I(cache_max_age) longer, see
+            I(cache_ttls).
+        type: bool
+        default: False
+        env:
+          - name: MM_CACHE_INCREMENTAL
+        required: False
+      cache_max_age:
+        description:
+          - Only used with I(cache_incremental) or I(limit_aware), the
+            number of seconds an expired cache is kept for incremental
+            syncs and for the index of the hosts and groups. Without
+            these an expired cache is not kept.
+        type: int
+        default: 604800
+        env:
+          - name: MM_CACHE_MAX_AGE
+        required: False
+      hostvars_fields:
+        description:
+          - IPAM fields of the hosts to set as host variables. The name of
+            the variable is the field with a C(mm_) prefix in snake case,
+            e.g. C(customProperties) is C(mm_custom_properties).
+          - Any field of an IPAM record can be used, e.g.
+            C(customProperties), C(dnsHosts), C(dhcpReservations),
+            C(dhcpLeases), C(state), C(usage), C(device), C(interface),
+            C(lastSeenDate) and C(lastDiscoveryDate). C(dnsHosts) are
+            the names of the DNS records. C(range) is the name of the
+            smallest range of the host.
+          - The values are cached per host, without the field names. The
+            variables are only made for the hosts a run uses.
+        type: list
+        elements: str
+        default: []
+        env:
+          - name: MM_HOSTVARS_FIELDS
+        required: False
+      page_size:
+        description:
+          - The number of IPAM records fetched per call. Large ranges are
+            fetched in pages, so the inventory never holds more than a
+            page of IPAM records from Micetro at a time.
+          - With 0 all IPAM records of a range are fetched at once.
+        type: int
+        default: 10000
+        env:
+          - name: MM_PAGE_SIZE
+        required: False
+      query_plan:
+        description:
+          - How the IPAM records of the ranges are fetched.
+          - C(per_range) fetches every range on its own.
+          - C(global) fetches all IPAM records at once and selects the
+            ones in the ranges locally.
+          - C(auto) estimates the cost of the plans from the utilization
+            of the ranges and the filters, and picks the cheapest one,
+            which can also fetch a parent range instead of its child
+            ranges. The plan is shown with C(-vvv).
+        type: str
+        default: auto
+        choices: ['auto', 'per_range', 'global']
+        env:
+          - name: MM_QUERY_PLAN
+        required: False
+      limit_aware:
+        description:
+          - With a limit (C(--limit)) only fetch the ranges of the hosts
+            and groups in the limit, instead of all ranges.
+          - The ranges of the hosts and groups come from an index in the
+            cache, made by the last run without a limit, so this needs
+            the cache. When a pattern in the limit matches nothing in the
+            index, or there is no index yet, all ranges are fetched.
+        type: bool
+        default: False
+        env:
+          - name: MM_LIMIT_AWARE
+        required: False
+      providers:
+        description:
+          - More Micetro servers to get the inventory from, all at the same
+            time, instead of the one of I(host).
+          - Every entry is a dict with a unique C(name) and any of
+            C(host), C(user), C(password), C(validate_certs), C(ca_bundle),
+            C(client_cert), C(client_key), C(ranges) and C(filters). Settings
+            that are not in an entry are the ones of the plugin.
+          - The names of the hosts of an entry get the C(prefix) of the
+            entry, when set. Every host is in the group
+            C(mm_provider_<name>) of its entry.
+          - Every entry has its own cache, so an entry that is slow to
+            refresh does not keep the others from being read from the
+            cache.
+        type: list
+        elements: dict
+        default: []
+        required: False
+      host_collisions:
+        description:
+          - What to do with a host that is in more than one entry of
+            I(providers), after the prefixes.
+          - With C(first) the host of the first entry is used. With
+            C(last) the address of the last entry is used, and the host is
+            in the groups of all entries. With C(error) the inventory
+            fails. With C(first) and C(last) a warning is shown.
+        type: str
+        default: first
+        choices: ['first', 'last', 'error']
+        required: False
+      max_workers:
+        description:
+          - Number of ranges that are fetched from Micetro at the same time.
+          - With 1 the ranges are fetched one after the other.
+        type: int
+        default: 4
+        env:
+          - name: MM_MAX_WORKERS
+        required: False
       filters:
         description:
           - A list of filter value pairs.
@@ -97,6 +379,16 @@ DOCUMENTATION = '''
           - To avoid parsing errors, the custom-key and custom-value
             are both sanitized, so both are converted to lowercase and
             all special characters are translated to "_"
+          - "The value can also be a list of values, of which one has
+            to match, or a regular expression as C({regex: '^lon'}),
+            which is searched in the value itself without case."
+          - Filters are combined with C(and), C(or) and C(not) keys, with
+            a list of filters for C(and) and C(or), and a filter for
+            C(not).
+          - Filters with a custom-key and custom-value of only letters
+            and digits are handled by Micetro, so only the matching
+            hosts are transferred. The other filters are applied by
+            the plugin.
         type: list
         env:
           - name: MM_FILTERS
@@ -128,6 +420,21 @@ ranges:
 The "filters" are an "and" function, a host is only available in the inventory
 when all filter-conditions are met.
 
+plugin: mm_inventory
+host: "http://micetro.example.net"
+user: apiuser
+password: apipasswd
+filters:
+  - location:
+      - London
+      - Amsterdam
+  - or:
+      - owner: johndoe
+      - owner:
+          regex: '^ton '
+  - not:
+      environment: test
+
 The "ranges" are an "or" function, a host is available in the inventory
 when either ranges-conditions are met.
 
@@ -162,9 +469,437 @@ cache_connection = /tmp/inv_cache
 # The inventory path must always be @mm_inventory if you are reading
 # all settings from environment variables.
 # ansible-inventory -i @mm_inventory --list
+
+# Make a snapshot of the inventory, and use it while it is less than a
+# day old:
+#
+# python mm_inventory.py /path/to/mm_inventory.yml /path/to/snapshot.json
+
+plugin: mm_inventory
+host: "http://micetro.example.net"
+user: apiuser
+password: apipasswd
+snapshot: /path/to/snapshot.json
+snapshot_max_age: 86400
 '''
 
 
+#CLIENT_START
+# Everything between the CLIENT_START and CLIENT_END markers is the
+# Micetro API client. The plugins carry a copy of it, so only edit it
+# here and run `doit` to update the modules and the plugins.
+
+# Maximum number of tries to connect to the Men&Mice API
+MAXTRIES = 5
+
+# Methods that are sent again when the connection fails after the request
+# was sent, as sending them twice does no harm. Other requests are only
+# sent again when the connection failed before they were sent.
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Redirects that are followed, with the same method and body, to the same
+# host only, so the credentials are never sent elsewhere. E.g. an mmurl
+# with http:// that redirects to https://
+REDIRECTS = (301, 302, 307, 308)
+MAX_REDIRECTS = 5
+
+# Connections to the API are kept open and reused for the next call to
+# the same Micetro. The SSL context is created once per set of TLS
+# options and new connections resume the last TLS session, so only the
+# first connection pays for a full TLS handshake. The TLS sessions survive
+# a fork, the connections themselves are never shared between processes.
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+_SSL_CONTEXTS = {}
+_TLS_SESSIONS = {}
+
+# Counters of the API traffic of this process
+METRICS = {
+    'requests': 0,
+    'connections': 0,
+    'handshakes': 0,
+    'resumed': 0,
+    'handshake_time': 0.0,
+}
+
+
+# JSON codecs to encode the requests and decode the responses with. A
+# codec is a tuple with a dumps and a loads function, where dumps may
+# return bytes and loads accepts bytes. The fastest installed codec is
+# used, unless another one is selected with MM_JSON_CODEC.
+JSON_CODECS = {}
+
+
+def _std_loads(data):
+    """Decode JSON with the standard library."""
+    # Sometimes (older Python) the data is not a string but a
+    # byte array.
+    if isinstance(data, bytes):
+        data = data.decode('utf8')
+    return json.loads(data)
+
+
+def register_json_codec(name, dumps, loads):
+    """Make a JSON codec available to the API client."""
+    JSON_CODECS[name] = (dumps, loads)
+
+
+register_json_codec('json', json.dumps, _std_loads)
+if ujson is not None:
+    register_json_codec('ujson', ujson.dumps, ujson.loads)
+if orjson is not None:
+    register_json_codec('orjson', orjson.dumps, orjson.loads)
+
+JSON_CODEC = os.environ.get('MM_JSON_CODEC') or next(
+    name for name in ('orjson', 'ujson', 'json') if name in JSON_CODECS)
+if JSON_CODEC not in JSON_CODECS:
+    raise AnsibleError("Unknown JSON codec '%s' in MM_JSON_CODEC, available are: %s" % (
+        JSON_CODEC, ", ".join(sorted(JSON_CODECS))))
+
+
+def _count(metric, value=1):
+    """Update one of the API metrics."""
+    with _POOL_LOCK:
+        METRICS[metric] += value
+
+
+def metrics_summary():
+    """Return the API metrics as a human readable string."""
+    return ("%(requests)d API calls, %(connections)d connections, "
+            "%(handshakes)d TLS handshakes (%(resumed)d resumed) "
+            "in %(handshake_time).3fs" % METRICS)
+
+
+def _tls_options(provider):
+    """Return the TLS options of a provider as a hashable tuple."""
+    return (bool(provider.get('validate_certs') or False),
+            provider.get('ca_bundle') or None,
+            provider.get('client_cert') or None,
+            provider.get('client_key') or None)
+
+
+def _ssl_context(tlsopts):
+    """Get the SSL context for a set of TLS options, create it if needed."""
+    with _POOL_LOCK:
+        context = _SSL_CONTEXTS.get(tlsopts)
+        if context is None:
+            validate, cafile, certfile, keyfile = tlsopts
+            context = ssl.create_default_context(cafile=cafile)
+            if not validate:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if certfile:
+                context.load_cert_chain(certfile, keyfile)
+            _SSL_CONTEXTS[tlsopts] = context
+    return context
+
+
+def _is_cert_error(err):
+    """Check if an exception is a failed certificate validation."""
+    return (isinstance(err, ssl.CertificateError) or
+            'CERTIFICATE_VERIFY_FAILED' in to_native(err))
+
+
+class RequestNotSent(socket.error):
+    """The connection to the API failed before the request was sent."""
+
+
+class _HTTPSConnection(http_client.HTTPSConnection):
+    """HTTPS connection that resumes TLS sessions and counts handshakes."""
+
+    def __init__(self, host, port, timeout, tlsopts, proxy=None):
+        self._mm_context = _ssl_context(tlsopts)
+        self._mm_session_key = (host, port, tlsopts)
+        if proxy is None:
+            http_client.HTTPSConnection.__init__(self, host, port,
+                                                 timeout=timeout,
+                                                 context=self._mm_context)
+        else:
+            http_client.HTTPSConnection.__init__(self, proxy.hostname, proxy.port or 80,
+                                                 timeout=timeout,
+                                                 context=self._mm_context)
+            self.set_tunnel(host, port, _proxy_headers(proxy))
+
+    def connect(self):
+        """Connect to the API and do the TLS handshake."""
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        server = self.host
+
+        # Through a proxy the TLS connection goes over a CONNECT tunnel
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+            server = self._tunnel_host
+        kwargs = {'server_hostname': server}
+
+        # Resuming a session is available as of Python 3.6
+        session = _TLS_SESSIONS.get(self._mm_session_key)
+        if session is not None and hasattr(ssl.SSLSocket, 'session'):
+            kwargs['session'] = session
+
+        start = time.time()
+        self.sock = self._mm_context.wrap_socket(sock, **kwargs)
+        _count('handshake_time', time.time() - start)
+        _count('handshakes')
+        if getattr(self.sock, 'session_reused', False):
+            _count('resumed')
+
+    def save_session(self):
+        """Keep the TLS session, to resume it on the next connection.
+
+        With TLS 1.3 the session ticket arrives after the handshake, so
+        this is done after a response has been read.
+        """
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            _TLS_SESSIONS[self._mm_session_key] = session
+
+
+def _proxy(parts):
+    """Return the proxy to reach an API URL through, or None.
+
+    Like open_url, this honours the http_proxy, https_proxy and no_proxy
+    environment variables.
+    """
+    proxy = getproxies().get(parts.scheme)
+    if not proxy or proxy_bypass(parts.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlparse(proxy)
+
+
+def _proxy_headers(proxy):
+    """Return the headers to authenticate at a proxy with."""
+    if not proxy.username:
+        return {}
+    credentials = "%s:%s" % (unquote(proxy.username), unquote(proxy.password or ''))
+    return {'Proxy-Authorization': 'Basic %s' % to_native(base64.b64encode(to_bytes(credentials)))}
+
+
+def _get_connection(parts, provider, proxy):
+    """Get an idle connection from the pool, or create a new one.
+
+    Returns the pool key, the connection and whether it was reused.
+    """
+    tlsopts = _tls_options(provider)
+    key = (os.getpid(), parts.scheme, parts.hostname, parts.port, tlsopts,
+           proxy.netloc if proxy else None)
+    with _POOL_LOCK:
+        idle = _POOL.get(key)
+        if idle:
+            return key, idle.pop(), True
+
+    timeout = provider.get('timeout') or 10
+    if parts.scheme == 'https':
+        conn = _HTTPSConnection(parts.hostname, parts.port or 443, timeout, tlsopts, proxy)
+    elif proxy:
+        conn = http_client.HTTPConnection(proxy.hostname, proxy.port or 80,
+                                          timeout=timeout)
+    else:
+        conn = http_client.HTTPConnection(parts.hostname, parts.port or 80,
+                                          timeout=timeout)
+    _count('connections')
+    return key, conn, False
+
+
+def _is_dropped(conn):
+    """Check if the server closed an idle connection from the pool.
+
+    An idle connection has nothing to read, so a readable socket means
+    the server closed it (or sent something unexpected).
+    """
+    try:
+        readable = select.select([conn.sock], [], [], 0)[0]
+    except (socket.error, ValueError, TypeError):
+        return True
+    return bool(readable)
+
+
+def _release_connection(key, conn):
+    """Return a connection to the pool."""
+    if isinstance(conn, _HTTPSConnection) and conn.sock is not None:
+        conn.save_session()
+    with _POOL_LOCK:
+        _POOL.setdefault(key, []).append(conn)
+
+
+def _http_transport(method, apiurl, provider, body, headers):
+    """Send a request to the Micetro API over a pooled connection.
+
+    Returns the HTTP status code, the reason and the response body.
+    Connection errors are raised to the caller, as RequestNotSent when
+    the request was not sent. Redirects to the same host are followed,
+    other redirects are returned.
+    """
+    redirects = 0
+    while True:
+        code, reason, response, location = _http_request(method, apiurl, provider, body, headers)
+        if code not in REDIRECTS or not location:
+            return code, reason, response
+        target = urljoin(apiurl, location)
+        if urlparse(target).hostname != urlparse(apiurl).hostname:
+            return code, reason, response
+        redirects += 1
+        if redirects > MAX_REDIRECTS:
+            raise AnsibleError("Too many redirects for %s" % apiurl)
+        apiurl = target
+
+
+def _http_request(method, apiurl, provider, body, headers):
+    """Send one request over a pooled connection.
+
+    Returns the HTTP status code, the reason, the response body and the
+    Location header.
+    """
+    parts = urlparse(apiurl)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+
+    # An HTTP proxy gets the full URL, HTTPS goes through a tunnel
+    proxy = _proxy(parts)
+    if proxy and parts.scheme == 'http':
+        path = apiurl
+        headers = dict(headers, **_proxy_headers(proxy))
+
+    while True:
+        key, conn, reused = _get_connection(parts, provider, proxy)
+        if reused and _is_dropped(conn):
+            conn.close()
+            continue
+        try:
+            if conn.sock is None:
+                conn.connect()
+        except (socket.error, http_client.HTTPException) as err:
+            conn.close()
+            if _is_cert_error(err):
+                raise
+            raise RequestNotSent(to_native(err))
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            response = resp.read()
+        except (socket.error, http_client.HTTPException):
+            conn.close()
+            # The server may have closed an idle connection in the
+            # meantime, so retry on a fresh connection when the request
+            # can be sent twice
+            if reused and method in IDEMPOTENT:
+                continue
+            raise
+        _release_connection(key, conn)
+        return resp.status, resp.reason, response, resp.getheader('Location')
+
+
+# Request fields that are never written to a cassette
+SCRUB_FIELDS = ('password', 'newPassword', 'oldPassword')
+
+
+def _scrub(data):
+    """Replace the credentials in a request or response."""
+    if isinstance(data, dict):
+        return dict((key, '********' if key in SCRUB_FIELDS else _scrub(val))
+                    for key, val in data.items())
+    if isinstance(data, list):
+        return [_scrub(val) for val in data]
+    return data
+
+
+class Cassette(object):
+    """Transport that records the API traffic to a file, or replays it.
+
+    The cassette is a file with a JSON document per API call, holding
+    the request, the response and the time the call took. The address
+    of Micetro and the headers are not recorded and the credentials are
+    scrubbed from the requests and responses.
+
+    When replaying, the calls are matched on the method, the URL and the
+    request body. Calls with the same request get the recorded responses
+    in order, after the last one that one is repeated. The recorded
+    time is waited for, multiplied by the latency factor.
+    """
+
+    def __init__(self, path, mode='replay', latency=1.0, transport=None):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.transport = transport or _http_transport
+        self.lock = threading.Lock()
+        self.calls = {}
+        if mode == 'replay':
+            with open(path) as fhandle:
+                for line in fhandle:
+                    if line.strip():
+                        call = json.loads(line)
+                        self.calls.setdefault(self._key(call), []).append(call)
+        elif mode != 'record':
+            raise AnsibleError("Unknown cassette mode '%s'" % mode)
+
+    @staticmethod
+    def _request(method, apiurl, body):
+        """Return the request as it is stored in a cassette."""
+        if isinstance(body, bytes):
+            body = body.decode('utf8')
+        return {
+            'method': method,
+            'url': apiurl.split('/mmws/api/', 1)[-1],
+            'body': _scrub(json.loads(body)) if body else None,
+        }
+
+    @staticmethod
+    def _key(call):
+        """Return the key to match a call on."""
+        return (call['method'], call['url'], json.dumps(call['body'], sort_keys=True))
+
+    def __call__(self, method, apiurl, provider, body, headers):
+        """Record or replay an API call."""
+        call = self._request(method, apiurl, body)
+        if self.mode == 'record':
+            start = time.time()
+            code, reason, response = self.transport(method, apiurl, provider, body, headers)
+            elapsed = time.time() - start
+            response_text = to_native(response)
+            try:
+                response_text = json.dumps(_scrub(json.loads(response_text)))
+            except ValueError:
+                pass
+            call.update({
+                'status': code,
+                'reason': reason,
+                'response': response_text,
+                'elapsed': round(elapsed, 6),
+            })
+            with self.lock:
+                with open(self.path, 'a') as fhandle:
+                    fhandle.write(json.dumps(call, sort_keys=True) + '\n')
+            return code, reason, response
+
+        with self.lock:
+            recorded = self.calls.get(self._key(call))
+            if not recorded:
+                raise AnsibleError("No recorded response for %s %s in %s" % (method, call['url'], self.path))
+            if len(recorded) > 1:
+                call = recorded.pop(0)
+            else:
+                call = recorded[0]
+        if self.latency:
+            time.sleep(call['elapsed'] * self.latency)
+        return call['status'], call['reason'], to_bytes(call['response'])
+
+
+# The transport sends the API calls to Micetro, which is done by
+# _http_transport() unless it is replaced. A transport is called with
+# the method, the URL, the provider, the body and the headers and returns
+# the HTTP status code, the reason and the response body. Set MM_CASSETTE
+# to record (MM_CASSETTE_MODE=record) or replay the API calls.
+TRANSPORT = None
+if os.environ.get('MM_CASSETTE'):
+    TRANSPORT = Cassette(os.environ['MM_CASSETTE'],
+                         mode=os.environ.get('MM_CASSETTE_MODE', 'replay'),
+                         latency=float(os.environ.get('MM_CASSETTE_LATENCY', 1.0)))
+
+
 def doapi(url, method, provider, databody):
     """Run an API call.
 
@@ -179,89 +914,1108 @@ def doapi(url, method, provider, databody):
         - The Ansible result dict
 
     When connection errors arise, there will be a multiple of tries,
-    each a couple of seconds apart, this to handle high-availability
+    each a couple of seconds apart, this to handle high-availability.
+    Requests that are not idempotent are only tried again when they
+    were not sent.
     """
-    headers = {'Content-Type': 'application/json'}
+    credentials = "%s:%s" % (provider['user'], provider['password'])
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Basic %s' % to_native(base64.b64encode(to_bytes(credentials))),
+    }
     apiurl = "%s/mmws/api/%s" % (provider['mmurl'], url)
     result = {}
 
-    # Maximum and current number of tries to connect to the Men&Mice API
-    MAXTRIES = 5
-    tries = 0
+    dumps, loads = JSON_CODECS[JSON_CODEC]
+
+    # A GET without parameters has no body at all
+    body = None
+    if databody or method != 'GET':
+        body = dumps(databody)
 
-    while tries <= 4:
+    tries = 0
+    while True:
         tries += 1
         try:
-            resp = open_url(apiurl,
-                            method=method,
-                            force_basic_auth=True,
-                            url_username=provider['user'],
-                            url_password=provider['password'],
-                            data=json.dumps(databody),
-                            validate_certs=False,
-                            headers=headers)
-
-            # Response codes of the API are:
-            #  - 200 => All OK, data returned in the body
-            #  - 204 => All OK, no data returned in the body
-            #  - *   => Something is wrong, error data in the body
-            # But sometimes there is a situation where the response code
-            # was 201 and with data in the body, so that is picked up as well
-
-            # Get all API data and format return message
-            response = resp.read()
-            if resp.code == 200:
-                # 200 => Data in the body
-                # Sometimes (older Python) the data is not a string but a
-                # byte array.
-                if isinstance(response, bytes):
-                    response = response.decode('utf8')
-                result['message'] = json.loads(response)
-            elif resp.code == 201:
-                # 201 => Sometimes data in the body??
-                try:
-                    result['message'] = json.loads(response)
-                except ValueError:
-                    result['message'] = ""
-            else:
-                # No response from API (204 => No data)
-                try:
-                    result['message'] = resp.reason
-                except AttributeError:
-                    result['message'] = ""
-            result['changed'] = True
-        except HTTPError as err:
-            errbody = json.loads(err.read().decode())
-            result['changed'] = False
-            result['warnings'] = "%s: %s (%s)" % (err.msg,
-                                                  errbody['error']['message'],
-                                                  errbody['error']['code']
-                                                  )
-        except URLError as err:
-            raise AnsibleError("Failed lookup url for %s : %s" % (apiurl, to_native(err)))
-        except SSLValidationError as err:
-            raise AnsibleError("Error validating the server's certificate for %s: %s" % (apiurl, to_native(err)))
-        except ConnectionError as err:
+            code, reason, response = (TRANSPORT or _http_transport)(method, apiurl, provider,
+                                                                    body, headers)
+            break
+        except (socket.error, http_client.HTTPException) as err:
+            if _is_cert_error(err):
+                raise AnsibleError("Error validating the server's certificate for %s: %s" % (apiurl, to_native(err)))
+            # Micetro may have handled a request that failed after it was
+            # sent, so only send it again when that does no harm
+            if method not in IDEMPOTENT and not isinstance(err, RequestNotSent):
+                raise AnsibleError("Error connecting to %s, the %s request may have been handled: %s" % (
+                    apiurl, method, to_native(err)))
             if tries == MAXTRIES:
                 raise AnsibleError("Error connecting to %s: %s" % (apiurl, to_native(err)))
-            else:
-                # There was a connection error, wait a little and retry
-                time.sleep(0.25)
-
-        if result.get('message', "") == "No Content":
+            # There was a connection error, wait a little and retry
+            time.sleep(0.25)
+    _count('requests')
+
+    # Response codes of the API are:
+    #  - 200 => All OK, data returned in the body
+    #  - 204 => All OK, no data returned in the body
+    #  - *   => Something is wrong, error data in the body
+    # But sometimes there is a situation where the response code
+    # was 201 and with data in the body, so that is picked up as well
+    if code == 200:
+        # 200 => Data in the body
+        result['message'] = loads(response)
+        result['changed'] = True
+    elif code == 201:
+        # 201 => Sometimes data in the body??
+        try:
+            result['message'] = loads(response)
+        except ValueError:
             result['message'] = ""
+        result['changed'] = True
+    elif code < 300:
+        # No response from API (204 => No data)
+        result['message'] = reason or ""
+        result['changed'] = True
+    elif code < 400:
+        # A redirect that was not followed, to another host or from
+        # another transport
+        raise AnsibleError("%s redirects elsewhere (%d %s), set mmurl to the URL Micetro is reached on" % (
+            apiurl, code, reason))
+    else:
+        # Error from the API, the details are in the body
+        try:
+            errbody = loads(response)
+            errmsg = "%s (%s)" % (errbody['error']['message'],
+                                  errbody['error']['code'])
+        except (ValueError, KeyError, TypeError):
+            errmsg = to_native(response)
+        result['changed'] = False
+        result['warnings'] = "%s: %s" % (reason, errmsg)
+
+    if result.get('message', "") == "No Content":
+        result['message'] = ""
+
+    return result
+#CLIENT_END
+
+
+# Sanitized strings, the same names and values return for every host
+_SANITIZED_MAX = 65536
+_UNSAFE_CHARS = re.compile(r'[ -\/\\&*^%$#@!+=`~:;<>?,\."\'()\[\]\{\}]')
+
+
+def _intern(data):
+    """Intern a string, so equal names share memory."""
+    try:
+        return six.moves.intern(data)
+    except TypeError:
+        # Python 2 only interns byte strings
+        return data
+
+
+class _Memo(dict):
+    """Remember the results of a function of one argument.
+
+    A missing result is computed when it is looked up, so looking up a
+    known one runs no Python code at all. At most _SANITIZED_MAX results
+    are remembered.
+    """
+
+    def __init__(self, func):
+        dict.__init__(self)
+        self.func = func
+
+    def __missing__(self, data):
+        result = self.func(data)
+        if len(self) >= _SANITIZED_MAX:
+            self.clear()
+        self[data] = result
         return result
 
 
+_SANITIZED = _Memo(lambda data: _intern(_UNSAFE_CHARS.sub('_', data.lower())))
+
+
 def _sanitize(data):
-    """Clean and sanitize a string."""
-    data = data.lower()
-    data = re.sub(r'[ -\/\\&*^%$#@!+=`~:;<>?,\."\'()\[\]\{\}]', '_', data)
+    """Clean and sanitize a string.
 
-    return data
+    The results are remembered and interned, the custom property names
+    and values and the range names repeat for many hosts.
+    """
+    return _SANITIZED[data]
+
+
+def _sanitize_names(custprops):
+    """Return the custom properties with sanitized names, for a filter."""
+    return dict(zip(map(_SANITIZED.__getitem__, custprops), custprops.values()))
+
+
+class HostTable(object):
+    """The hosts and groups of the inventory, every host only once.
+
+    The hosts are in a table and group members are the indexes of the
+    hosts in that table, so a host name is stored once, no matter how
+    many groups it is in. Every host is in the 'mm_hosts' group, that
+    group is not stored.
+
+    The custom properties of the hosts are only kept when they are
+    needed, for the constructed groups and variables. The values of the
+    IPAM fields in hostvars_fields are kept as a tuple per host, in the
+    order of the fields.
 
+    The blob of `to_blob()` is what is cached:
 
-class InventoryModule(BaseInventoryPlugin, Cacheable):
+        {
+            'version': 2,
+            'hosts': [hostname1, hostname2, ...],
+            'addresses': [address1, address2, ...],
+            'groups': {
+                'custgrp1': [0, 4, ...],
+                ...
+            },
+            'properties': [{custprop: custval, ...}, ...],
+            'values': [(value1, value2, ...), ...],
+        }
+    """
+
+    __slots__ = ('names', 'addresses', 'index', 'groups', 'properties', 'values')
+
+    VERSION = 2
+
+    def __init__(self):
+        self.names = []
+        self.addresses = []
+        self.index = {}
+        self.groups = {}
+        self.properties = []
+        self.values = []
+
+    def add_host(self, name, address, properties=None, values=None):
+        """Add a host, or update its address, and return its index."""
+        if properties is not None:
+            properties = dict((_intern(key), _intern(value)) for key, value in properties.items())
+        if values is not None:
+            values = tuple(_intern(value) for value in values)
+        idx = self.index.get(name)
+        if idx is None:
+            idx = len(self.names)
+            self.index[name] = idx
+            self.names.append(_intern(name))
+            self.addresses.append(address)
+            self.properties.append(properties)
+            self.values.append(values)
+        else:
+            self.addresses[idx] = address
+            if properties is not None:
+                self.properties[idx] = properties
+            if values is not None:
+                self.values[idx] = values
+        return idx
+
+    def add_member(self, group, idx):
+        """Add the host with an index to a group."""
+        members = self.groups.get(group)
+        if members is None:
+            members = self.groups[group] = set()
+        members.add(idx)
+
+    def add_blob(self, blob, prefix='', collisions='first', group=None):
+        """Add the hosts and groups of another blob, with a prefix.
+
+        When a host is already in the table, collisions decides: with
+        'first' the host in the table stays, with 'last' the address of
+        the blob wins, with 'error' a ValueError is raised. All hosts of
+        the blob are also added to group, when given. Returns the names
+        of the hosts that were already in the table.
+        """
+        mapping = []
+        collided = []
+        properties = blob.get('properties') or [None] * len(blob['hosts'])
+        values = blob.get('values') or [None] * len(blob['hosts'])
+        for name, address, props, vals in zip(blob['hosts'], blob['addresses'], properties, values):
+            name = prefix + name
+            if name in self.index:
+                collided.append(name)
+                if collisions == 'error':
+                    raise ValueError("host %s is already in the inventory" % name)
+                if collisions == 'first':
+                    mapping.append(None)
+                    continue
+            mapping.append(self.add_host(name, address, props, vals))
+        for grp, members in blob['groups'].items():
+            for idx in members:
+                if mapping[idx] is not None:
+                    self.add_member(grp, mapping[idx])
+        if group:
+            for idx in mapping:
+                if idx is not None:
+                    self.add_member(group, idx)
+        return collided
+
+    def to_blob(self):
+        """Return the hosts and groups as a dict to cache."""
+        blob = {
+            'version': self.VERSION,
+            'hosts': self.names,
+            'addresses': self.addresses,
+            'groups': dict((group, sorted(members)) for group, members in self.groups.items()),
+        }
+        if any(props is not None for props in self.properties):
+            blob['properties'] = self.properties
+        if any(vals is not None for vals in self.values):
+            blob['values'] = self.values
+        return blob
+
+
+# The columnar cache file has a header and compressed sections:
+#
+#   magic (8 bytes), header length (4 bytes, little endian), header (JSON)
+#   sections, at the offsets in the header
+#
+# The header has the version, the time the file was written, the
+# timeout, the key of the settings and the offset, compressed length and
+# uncompressed length of every section. The sections are string tables
+# (strings separated by NUL), arrays of unsigned 32 bit integers (little
+# endian) and JSON, each compressed with zlib.
+_COLUMNAR_MAGIC = b'MMINVCOL'
+_COLUMNAR_VERSION = 1
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _pack_strings(strings):
+    return u'\0'.join(strings).encode('utf-8')
+
+
+def _unpack_strings(data):
+    if not data:
+        return []
+    return [_intern(name) for name in data.decode('utf-8').split(u'\0')]
+
+
+def _pack_array(numbers):
+    numbers = array(_UINT32, numbers)
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return numbers.tostring() if six.PY2 else numbers.tobytes()
+
+
+def _unpack_array(data):
+    numbers = array(_UINT32)
+    if six.PY2:
+        numbers.fromstring(data)
+    else:
+        numbers.frombytes(data)
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return numbers
+
+
+def _write_columnar(path, blob, key, ttl):
+    """Write the blob of a HostTable to a columnar cache file."""
+    groups = list(blob['groups'])
+    sections = [
+        ('hosts', _pack_strings(blob['hosts'])),
+        ('addresses', _pack_strings(blob['addresses'])),
+        ('group_names', _pack_strings(groups)),
+        ('group_sizes', _pack_array(len(blob['groups'][group]) for group in groups)),
+        ('group_members', _pack_array(idx for group in groups for idx in blob['groups'][group])),
+    ]
+    for name in ('properties', 'values'):
+        if blob.get(name):
+            sections.append((name, json.dumps(blob[name], separators=(',', ':')).encode('utf-8')))
+
+    header = {'version': _COLUMNAR_VERSION, 'timestamp': time.time(), 'ttl': ttl, 'key': key,
+              'fields': blob.get('fields') or [], 'sections': {}}
+    body = []
+    offset = 0
+    for name, data in sections:
+        packed = zlib.compress(data, 1)
+        header['sections'][name] = [offset, len(packed), len(data)]
+        body.append(packed)
+        offset += len(packed)
+    header = json.dumps(header).encode('utf-8')
+    _write_atomic(path, [_COLUMNAR_MAGIC + struct.pack('<I', len(header)) + header] + body)
+
+
+def _write_atomic(path, chunks):
+    """Write a file at once, a reader sees the old or the new one."""
+    fdesc, tmpname = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.mminv')
+    try:
+        with os.fdopen(fdesc, 'wb') as fhandle:
+            for chunk in chunks:
+                fhandle.write(chunk)
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        os.unlink(tmpname)
+        raise
+
+
+class _Columnar(object):
+    """A columnar cache file, used like the blob of a HostTable.
+
+    The file is memory mapped and a section is only decompressed when
+    it is used, so the custom properties and the values of the fields
+    cost nothing when they are not needed.
+    """
+
+    def __init__(self, path, key):
+        """Open a columnar cache file, raises ValueError when it is not valid."""
+        with open(path, 'rb') as fhandle:
+            self.map = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(_COLUMNAR_MAGIC)] != _COLUMNAR_MAGIC:
+            raise ValueError("not a columnar cache file")
+        start = len(_COLUMNAR_MAGIC) + 4
+        length = struct.unpack('<I', self.map[len(_COLUMNAR_MAGIC):start])[0]
+        self.header = json.loads(self.map[start:start + length].decode('utf-8'))
+        if self.header.get('version') != _COLUMNAR_VERSION or self.header.get('key') != key:
+            raise ValueError("columnar cache file of another version or settings")
+        self.start = start + length
+        self.loaded = {}
+
+    def expired(self):
+        """Return if the file is older than its timeout, 0 never expires."""
+        ttl = self.header['ttl']
+        return bool(ttl) and time.time() - self.header['timestamp'] >= ttl
+
+    def _section(self, name):
+        if name not in self.header['sections']:
+            return None
+        offset, length, dummy = self.header['sections'][name]
+        offset += self.start
+        return zlib.decompress(self.map[offset:offset + length])
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            if name in ('hosts', 'addresses'):
+                value = _unpack_strings(self._section(name))
+            elif name == 'groups':
+                names = _unpack_strings(self._section('group_names'))
+                sizes = _unpack_array(self._section('group_sizes'))
+                members = _unpack_array(self._section('group_members'))
+                value = {}
+                offset = 0
+                for group, size in zip(names, sizes):
+                    value[group] = members[offset:offset + size]
+                    offset += size
+            elif name == 'fields':
+                value = self.header['fields']
+            else:
+                data = self._section(name)
+                if data is None:
+                    raise KeyError(name)
+                value = json.loads(data.decode('utf-8'))
+            self.loaded[name] = value
+        return self.loaded[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+def _field_variable(field):
+    """Return the name of the host variable of an IPAM field, like mm_dns_hosts."""
+    return 'mm_' + re.sub(r'([A-Z])', r'_\1', field).lower()
+
+
+def _project(ipam, fields):
+    """Return the values of the fields of an IPAM record, as a list.
+
+    The DNS hosts are only their names. The range is the smallest range
+    with the address, which is filled in when the host is added.
+    """
+    values = []
+    for field in fields:
+        if field == 'range':
+            values.append(None)
+        elif field == 'dnsHosts':
+            values.append([host['dnsRecord']['name'] for host in ipam.get('dnsHosts') or []])
+        else:
+            values.append(ipam.get(field))
+    return values
+
+
+class _LazyVars(dict):
+    """The variables of a host, with the IPAM fields added on first use.
+
+    Ansible only uses all variables of the hosts in the plays that run,
+    so the variables of the IPAM fields of the other hosts are never
+    made. Every way to read the variables adds them first.
+    """
+
+    __slots__ = ('_pending',)
+
+    def __init__(self, variables, pending):
+        super(_LazyVars, self).__init__(variables)
+        self._pending = pending
+
+    def _load(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            for name, value in pending:
+                # Variables that were set after are kept
+                dict.setdefault(self, name, value)
+
+    def __reduce__(self):
+        self._load()
+        return (dict, (dict(self.items()),))
+
+
+def _loaded(name):
+    method = getattr(dict, name)
+
+    def loaded(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+    loaded.__name__ = name
+    return loaded
+
+
+for _name in ('__getitem__', '__contains__', '__iter__', '__len__', '__eq__', '__ne__', '__repr__',
+              '__or__', '__ror__', 'keys', 'items', 'values', 'get', 'copy', 'pop', 'popitem',
+              'setdefault', 'has_key', 'iterkeys', 'iteritems', 'itervalues'):
+    if hasattr(dict, _name):
+        setattr(_LazyVars, _name, _loaded(_name))
+
+
+# A snapshot has the groups of the inventory like `ansible-inventory
+# --list`, with the variables of the hosts and the provenance of the
+# snapshot in _meta. A file ending in .json is JSON, other files are YAML.
+# This is not the layout of the yaml inventory plugin, only the snapshot
+# option reads it.
+_SNAPSHOT_VERSION = 1
+_SOURCE_VARS = frozenset(('inventory_file', 'inventory_dir'))
+
+
+def _snapshot(inventory, provenance):
+    """Return the inventory data of Ansible as a snapshot."""
+    snapshot = {'_meta': {'hostvars': {}, 'provenance': provenance}}
+    for name, group in inventory.groups.items():
+        entry = {}
+        if group.hosts:
+            entry['hosts'] = [host.name for host in group.hosts]
+        if group.child_groups:
+            entry['children'] = [child.name for child in group.child_groups]
+        if group.vars:
+            entry['vars'] = dict(group.vars)
+        snapshot[name] = entry
+    for name, host in inventory.hosts.items():
+        # The variables Ansible sets for the source are left out
+        hostvars = dict((var, value) for var, value in host.vars.items() if var not in _SOURCE_VARS)
+        if hostvars:
+            snapshot['_meta']['hostvars'][name] = hostvars
+    return snapshot
+
+
+def _write_snapshot(path, snapshot):
+    """Write a snapshot, in JSON or in YAML with a comment header."""
+    if path.endswith('.json'):
+        data = json.dumps(snapshot, cls=AnsibleJSONEncoder, sort_keys=True, separators=(',', ':'))
+    else:
+        provenance = snapshot['_meta']['provenance']
+        data = "# Snapshot of the Micetro inventory %s, made %s\n# Only the snapshot option of mm_inventory reads this file\n%s" % (
+            provenance['source'], provenance['created'],
+            yaml.dump(snapshot, Dumper=AnsibleDumper, default_flow_style=False, allow_unicode=True))
+    _write_atomic(path, [to_bytes(data)])
+
+
+def _read_snapshot(path):
+    """Return the snapshot in a file."""
+    with open(path, 'rb') as fhandle:
+        data = fhandle.read()
+    if path.endswith('.json'):
+        return JSON_CODECS[JSON_CODEC][1](data)
+    return yaml.load(data, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+# Filter names and values that can be sent to Micetro as they are
+_SAFE_FILTER = re.compile(r'^[A-Za-z0-9]+$')
+
+
+def _all(predicates):
+    """A predicate that is true when all predicates are true."""
+    if len(predicates) == 1:
+        return predicates[0]
+    first, rest = predicates[0], _all(predicates[1:])
+    return lambda props: first(props) and rest(props)
+
+
+def _any(predicates):
+    """A predicate that is true when any of the predicates is true."""
+    if len(predicates) == 1:
+        return predicates[0]
+    first, rest = predicates[0], _any(predicates[1:])
+    return lambda props: first(props) or rest(props)
+
+
+def _compile_match(custprop, wanted):
+    """Compile the match of a custom property with a wanted value.
+
+    The wanted value is a value, a list of values or a dict with a
+    regular expression ({'regex': '^lon'}). Values are compared
+    sanitized, a regular expression is searched in the value itself,
+    without case. The outcome is remembered per value, as the values
+    repeat for many hosts.
+    """
+    custprop = _sanitize(str(custprop))
+    if isinstance(wanted, dict):
+        if list(wanted) != ['regex']:
+            raise AnsibleParserError("Invalid filter for %s: %s" % (custprop, wanted))
+        try:
+            search = re.compile(wanted['regex'], re.IGNORECASE).search
+        except re.error as err:
+            raise AnsibleParserError("Invalid regex for %s: %s" % (custprop, to_native(err)))
+        matched = _Memo(lambda data: search(data) is not None)
+    elif isinstance(wanted, list):
+        values = frozenset(_sanitize(str(value)) for value in wanted)
+        matched = _Memo(lambda data: _sanitize(data) in values)
+    else:
+        value = _sanitize(str(wanted))
+        matched = _Memo(lambda data: _sanitize(data) == value)
+    return lambda props: custprop in props and matched[props[custprop]]
+
+
+def _compile_filter(flt):
+    """Compile a filter to a predicate on the custom properties of a host.
+
+    A list of filters and the keys of a dict are an "and" function. The
+    keys 'and', 'or' and 'not' combine the filters under them, all other
+    keys are matched with _compile_match(). The predicate is called with
+    the properties from _sanitize_names().
+    """
+    if isinstance(flt, list):
+        return _all([_compile_filter(item) for item in flt] or [lambda props: True])
+    if not isinstance(flt, dict) or not flt:
+        raise AnsibleParserError("Invalid filter: %s" % flt)
+    predicates = []
+    for key, value in flt.items():
+        if key == 'and':
+            predicates.append(_compile_filter(value))
+        elif key == 'or':
+            if not isinstance(value, list) or not value:
+                raise AnsibleParserError("Invalid filter, 'or' needs a list: %s" % flt)
+            predicates.append(_any([_compile_filter(item) for item in value]))
+        elif key == 'not':
+            negate = _compile_filter(value)
+            predicates.append(lambda props: not negate(props))
+        else:
+            predicates.append(_compile_match(key, value))
+    return _all(predicates)
+
+
+def _split_filters(filters):
+    """Split the filters in a Micetro filter expression and a predicate.
+
+    A filter on a custom property with a name and value of only letters
+    and digits is the same after sanitizing, apart from the case, and
+    Micetro compares without case. When such a filter is part of the
+    top-level "and", it is sent to Micetro, combined with
+    'state=Assigned', so only the matching IPAM records are returned.
+    The other filters are compiled to a predicate for the returned
+    records, or None when Micetro handles everything.
+    """
+    terms = ['state=Assigned']
+    local = []
+    for flt in filters or []:
+        if not isinstance(flt, dict):
+            local.append(flt)
+            continue
+        for custprop, custval in flt.items():
+            if custprop not in ('and', 'or', 'not') and isinstance(custval, (six.string_types, int)) \
+                    and _SAFE_FILTER.match(str(custprop)) and _SAFE_FILTER.match(str(custval)):
+                terms.append('%s=%s' % (custprop, custval))
+            else:
+                local.append({custprop: custval})
+    return ' and '.join(terms), _compile_filter(local) if local else None
+
+
+# Changes of these object types in the history of Micetro can change any
+# host, they need a full sync
+_FULL_SYNC_TYPES = ('Ranges', 'PropertyDefinitions', 'DNSZones')
+
+# With more changes a full sync is faster than an incremental one
+_HISTORY_LIMIT = 1000
+
+# With more changed addresses in a range, the whole range is fetched
+_DELTA_LIMIT = 100
+
+# The cost of a call to Micetro, in the number of IPAM records that can
+# be transferred in the same time
+_QUERY_COST = 250
+
+# The part of the IPAM records that is estimated to pass every filter
+# term Micetro handles
+_FILTER_SELECTIVITY = 0.5
+
+
+def _history_entries(provider, databody):
+    """Get entries from the history of Micetro.
+
+    Returns None when there is no history, or when it is not like
+    expected.
+    """
+    result = doapi('command/GetHistory', 'GET', provider, databody)
+    if result.get('warnings') or not result.get('message'):
+        return None
+    try:
+        entries = result['message']['result'].get('historyEntries', [])
+        for entry in entries:
+            if not isinstance(entry['id'], int) or 'objType' not in entry:
+                return None
+    except (AttributeError, KeyError, TypeError):
+        return None
+    return entries
+
+
+def _history_head(provider):
+    """Return the id of the last change in the history of Micetro.
+
+    Returns None when there is no history.
+    """
+    entries = _history_entries(provider, {'sortOrder': 'Descending', 'limit': 1})
+    if entries is None:
+        return None
+    return entries[0]['id'] if entries else 0
+
+
+def _history_since(provider, mark):
+    """Return the changes since a mark in the history.
+
+    Returns the id of the last change, a list of (id, version, number,
+    address) of the changed IPAM records and a list of (id, action, ref,
+    name) of the changed DNS records.
+
+    Returns None when an incremental sync is not possible: without a
+    history, when the history does not go back to the mark, with too
+    many changes or with a change that needs a full sync.
+    """
+    entries = _history_entries(provider, {'filter': 'id>=%d' % mark, 'limit': _HISTORY_LIMIT + 1})
+    if entries is None or len(entries) > _HISTORY_LIMIT:
+        return None
+
+    # The change of the mark itself is still there, when the history
+    # goes back far enough
+    if entries and entries[0]['id'] != (mark or 1):
+        return None
+    if mark and not entries:
+        return None
+
+    changes = []
+    dns = []
+    for entry in entries:
+        if entry['id'] <= mark:
+            continue
+        if entry['objType'] in _FULL_SYNC_TYPES:
+            return None
+        if entry['objType'] == 'IPAMRecords':
+            try:
+                version, number = _ip2int(entry.get('objName') or '')
+            except (socket.error, ValueError):
+                return None
+            changes.append((entry['id'], version, number, entry['objName']))
+        elif entry['objType'] == 'DNSRecords':
+            if not entry.get('objRef'):
+                return None
+            dns.append((entry['id'], entry.get('action'), entry['objRef'], entry.get('objName')))
+    return (entries[-1]['id'] if entries else mark), changes, dns
+
+
+def _dns_changes(provider, dns, shards):
+    """Return the changed IPAM records of changes of DNS records.
+
+    A change of an A or AAAA record changes the host of the address it
+    points to, which is found by getting the record, and the host of the
+    address it pointed to before, which is found by its name in the
+    cached hosts of the shards. Returns a list like _history_since, or
+    None when the changes cannot be resolved.
+    """
+    if len(set(ref for change, action, ref, name in dns)) > _DELTA_LIMIT:
+        return None
+    cached = {}
+    for shard in shards:
+        for record in shard['records']:
+            cached.setdefault(record[1], []).append(record[0])
+
+    current = {}
+    changes = []
+    for change, action, ref, name in dns:
+        if ref not in current:
+            current[ref] = None
+            if action != 'Deleted':
+                result = doapi(ref, 'GET', provider, {})
+                if not result.get('warnings') and result.get('message'):
+                    current[ref] = result['message']['result'].get('dnsRecord')
+        record = current[ref]
+        addresses = list(cached.get(name, []))
+        if record is None:
+            # A deleted record is only found by its name
+            if not name:
+                return None
+        elif record.get('type') in ('A', 'AAAA'):
+            addresses.extend(cached.get(record.get('name'), []))
+            addresses.append(record.get('data'))
+        for address in addresses:
+            try:
+                version, number = _ip2int(address or '')
+            except (socket.error, ValueError):
+                return None
+            changes.append((change, version, number, address))
+    return changes
+
+
+def _ip2int(address):
+    """Convert an IPv4 or IPv6 address to a (version, integer) tuple."""
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    number = int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+    return (6 if family == socket.AF_INET6 else 4), number
+
+
+def _parse_cidr(network):
+    """Parse a network in CIDR notation, a single address is a host network.
+
+    Returns (version, first, last, prefixlen), or None when the network
+    is not in CIDR notation.
+    """
+    address, sep, prefixlen = network.strip().partition('/')
+    try:
+        version, number = _ip2int(address)
+        bits = 32 if version == 4 else 128
+        prefixlen = int(prefixlen) if sep else bits
+    except (socket.error, ValueError):
+        return None
+    if not 0 <= prefixlen <= bits:
+        return None
+    hostmask = (1 << (bits - prefixlen)) - 1
+    first = number & ~hostmask
+    return version, first, first | hostmask, prefixlen
+
+
+class RangeTree(object):
+    """All Micetro ranges in a binary prefix trie (radix tree).
+
+    Every range is stored in the node of the longest prefix that covers
+    it, for a range in CIDR notation that is its own network. So all
+    ranges inside a network are in the subtree of the node of that
+    network, and the ranges containing an address are on the path to
+    that address.
+
+    The tree is built from the `ranges` of a `Ranges` call, or from the
+    `table()` of another tree, which is what is cached.
+    """
+
+    def __init__(self, ranges):
+        self.ranges = {}
+        self.order = []
+        self.roots = {4: [None, None, []], 6: [None, None, []]}
+        for rng in ranges:
+            version, first = _ip2int(rng['from'])
+            last = _ip2int(rng['to'])[1]
+            entry = {
+                'ref': rng['ref'],
+                'name': rng['name'],
+                'parent': rng.get('parentRef') or '',
+                'version': version,
+                'first': first,
+                'last': last,
+                'utilization': rng.get('utilizationPercentage'),
+                'children': [],
+            }
+            self.ranges[entry['ref']] = entry
+            self._node(version, first, self._bits(version) - (first ^ last).bit_length(), True)[2].append(entry)
+
+        # Ranges in address order, children of a range after their parent
+        self.order = sorted(self.ranges.values(), key=lambda entry: (entry['version'], entry['first'], -entry['last']))
+        for entry in self.order:
+            if entry['parent'] in self.ranges:
+                self.ranges[entry['parent']]['children'].append(entry)
+
+        # The estimated number of IPAM records in every range. The
+        # utilization is a whole percentage, for a large range it is
+        # better to count the records in its child ranges.
+        for entry in reversed(self.order):
+            entry['used'] = None
+            if entry['utilization'] is not None:
+                below = [child['used'] for child in entry['children']]
+                if None not in below:
+                    own = (entry['last'] - entry['first'] + 1) * int(entry['utilization']) // 100
+                    entry['used'] = max(own, sum(below))
+
+    @staticmethod
+    def _bits(version):
+        return 32 if version == 4 else 128
+
+    def _node(self, version, number, prefixlen, create=False):
+        """Find the node of a prefix, or None when it is not in the tree."""
+        node = self.roots[version]
+        bits = self._bits(version)
+        for depth in range(prefixlen):
+            bit = (number >> (bits - 1 - depth)) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, []]
+            node = node[bit]
+        return node
+
+    def table(self):
+        """Return the ranges as a list, to cache and build a tree from."""
+        table = []
+        for entry in self.order:
+            table.append({
+                'ref': entry['ref'],
+                'name': entry['name'],
+                'parentRef': entry['parent'],
+                'from': self._int2ip(entry['version'], entry['first']),
+                'to': self._int2ip(entry['version'], entry['last']),
+                'utilizationPercentage': entry['utilization'],
+            })
+        return table
+
+    @staticmethod
+    def _int2ip(version, number):
+        if version == 4:
+            return socket.inet_ntop(socket.AF_INET, binascii.unhexlify("%08x" % number))
+        return socket.inet_ntop(socket.AF_INET6, binascii.unhexlify("%032x" % number))
+
+    def lookup(self, address):
+        """Return the smallest range that contains an address, or None."""
+        try:
+            version, number = _ip2int(address)
+        except (socket.error, ValueError):
+            return None
+        found = None
+        node = self.roots[version]
+        bits = self._bits(version)
+        depth = 0
+        while node is not None:
+            for entry in node[2]:
+                if entry['first'] <= number <= entry['last']:
+                    if found is None or entry['last'] - entry['first'] <= found['last'] - found['first']:
+                        found = entry
+            if depth == bits:
+                break
+            node = node[(number >> (bits - 1 - depth)) & 1]
+            depth += 1
+        return found
+
+    def select(self, networks):
+        """Return the references of the ranges in the wanted networks.
+
+        A network in CIDR notation selects all ranges inside it, so a
+        supernet selects everything below it. Other networks are matched
+        on the name of the range, which selects the range and all ranges
+        below it. Without networks all ranges are selected.
+        """
+        if not networks:
+            return set(self.ranges)
+        selected = set()
+        names = {}
+        for entry in self.order:
+            names.setdefault(entry['name'], []).append(entry)
+        for network in networks:
+            network = str(network).strip()
+            cidr = _parse_cidr(network)
+            if cidr is None:
+                stack = list(names.get(network, []))
+                while stack:
+                    entry = stack.pop()
+                    selected.add(entry['ref'])
+                    stack.extend(entry['children'])
+                continue
+            version, first, last, prefixlen = cidr
+            stack = [self._node(version, first, prefixlen)]
+            while stack:
+                node = stack.pop()
+                if node is None:
+                    continue
+                selected.update(entry['ref'] for entry in node[2]
+                                if first <= entry['first'] and entry['last'] <= last)
+                stack.extend(node[:2])
+        return selected
+
+    def plan(self, selected):
+        """Return the ranges to fetch to get all addresses of a selection.
+
+        These are the ranges without child ranges, and the ranges with
+        addresses that are not in a child range.
+        """
+        fetch = []
+        for entry in self.order:
+            if entry['ref'] not in selected:
+                continue
+            covered = sum(child['last'] - child['first'] + 1 for child in entry['children'])
+            if covered < entry['last'] - entry['first'] + 1:
+                fetch.append(entry)
+        return fetch
+
+    def covering(self, entry, refs):
+        """Return the first of a range and its parents that is in refs."""
+        while entry is not None and entry['ref'] not in refs:
+            entry = self.ranges.get(entry['parent'])
+        return entry
+
+    def groups(self, entry, selected):
+        """Return the names of a range and its selected parents."""
+        names = []
+        while entry is not None and entry['ref'] in selected:
+            names.append(entry['name'])
+            entry = self.ranges.get(entry['parent'])
+        return names
+
+
+def _plan_queries(tree, targets, mode, filter_terms, page_size):
+    """Plan the GetIPAMRecords queries to fetch the targets, a list of ranges.
+
+    A query for a range returns the IPAM records of the range and of all
+    ranges below it, a query without a range returns all IPAM records. The
+    cost of a query is a fixed cost per call (and per page) plus the
+    estimated number of IPAM records it returns, from the utilization of
+    the range and the filter terms. The plans are:
+
+    - per-range: a query for every target
+    - global:    one query for all IPAM records
+    - hybrid:    a query for the ranges where querying the range is
+                 cheaper than querying the targets below it
+
+    Mode auto picks the cheapest plan, without a utilization for every
+    range it is per-range. Returns the name of the plan, the queries as
+    (range or None, [targets]) and the estimated cost of every plan.
+    """
+    factor = _FILTER_SELECTIVITY ** filter_terms
+
+    def cost(used):
+        records = used * factor
+        pages = int(records // page_size) + 1 if page_size else 1
+        return _QUERY_COST * pages + records
+
+    per_range = [(target, [target]) for target in targets]
+    if mode == 'per_range' or not targets or any(entry['used'] is None for entry in tree.order):
+        return 'per-range', per_range, {}
+
+    roots = [entry for entry in tree.order if entry['parent'] not in tree.ranges]
+    costs = {
+        'per-range': sum(cost(target['used']) for target in targets),
+        'global': cost(sum(root['used'] for root in roots)),
+    }
+    if mode == 'global':
+        return 'global', [(None, list(targets))], costs
+
+    # Bottom up: the cheapest queries for the targets in every subtree
+    wanted = set(target['ref'] for target in targets)
+    best = {}
+    for entry in reversed(tree.order):
+        below = [best[child['ref']] for child in entry['children'] if child['ref'] in best]
+        found = [target for plan in below for target in plan[2]]
+        if entry['ref'] in wanted:
+            # The query for a target returns all ranges below it anyway
+            found.insert(0, entry)
+            best[entry['ref']] = (cost(entry['used']), [(entry, found)], found)
+        elif below:
+            split = (sum(plan[0] for plan in below), [query for plan in below for query in plan[1]], found)
+            whole = (cost(entry['used']), [(entry, found)], found)
+            best[entry['ref']] = whole if whole[0] < split[0] else split
+    hybrid = [query for root in roots if root['ref'] in best for query in best[root['ref']][1]]
+    costs['hybrid'] = sum(best[root['ref']][0] for root in roots if root['ref'] in best)
+
+    if costs['global'] < costs['hybrid']:
+        return 'global', [(None, list(targets))], costs
+    if all(found == [entry] for entry, found in hybrid):
+        return 'per-range', hybrid, costs
+    return 'hybrid', hybrid, costs
+
+
+# The sources of one inventory load that get their hosts from the same
+# Micetro share what they fetch: the ranges, and the IPAM records of
+# every query per filter sent to Micetro and hostvars_fields, before the
+# filters of the plugin. So sources with overlapping ranges fetch them
+# once, only the filters of the plugin and the groups are per source. A
+# new load, like with refresh_inventory, starts over. Every entry has
+# the mark in the history of the source that fetched it, or None.
+_SHARED = {'inventory': None, 'fetched': {}}
+_SHARED_LOCK = threading.Lock()
+
+
+def _forget(ref):
+    """Drop the shared results when the inventory of their load is gone."""
+    with _SHARED_LOCK:
+        if _SHARED['inventory'] is ref:
+            _SHARED['inventory'] = None
+            _SHARED['fetched'] = {}
+
+
+def _shared(inventory):
+    """Return the shared results of the load of an inventory."""
+    with _SHARED_LOCK:
+        owner = _SHARED['inventory']
+        if owner is None or owner() is not inventory:
+            try:
+                _SHARED['inventory'] = weakref.ref(inventory, _forget)
+            except TypeError:
+                return {}
+            _SHARED['fetched'] = {}
+        return _SHARED['fetched']
+
+
+def _lowest(head, mark):
+    """Return the earliest of two marks in the history, None when unknown."""
+    if head is None or mark is None:
+        return None
+    return min(head, mark)
+
+
+def _shared_records(entries, child, head):
+    """Return the records of a range from the query of another source.
+
+    A query for a range, or without a range, has the records of all
+    ranges below it, the ones of the range are found in the records
+    sorted by address. With a head the records need a mark in the
+    history too. Returns the records and their mark, or None.
+    """
+    with _SHARED_LOCK:
+        entries = list(entries)
+    for entry in entries:
+        if head is not None and entry['mark'] is None:
+            continue
+        query = entry['range']
+        if query is not None and query['ref'] == child['ref']:
+            return entry['records'], entry['mark']
+        if query is not None and not (query['version'] == child['version'] and
+                                      query['first'] <= child['first'] and child['last'] <= query['last']):
+            continue
+        with _SHARED_LOCK:
+            if entry['keys'] is None:
+                ordered = sorted(((_ip2int(record[0]), record) for record in entry['records']),
+                                 key=lambda item: item[0])
+                entry['keys'] = [key for key, record in ordered]
+                entry['sorted'] = [record for key, record in ordered]
+        low = bisect.bisect_left(entry['keys'], (child['version'], child['first']))
+        high = bisect.bisect_right(entry['keys'], (child['version'], child['last']))
+        return entry['sorted'][low:high], entry['mark']
+    return None
+
+
+class _Resolved(dict):
+    """The Jinja2 filters or tests, every one found only once."""
+
+    def __init__(self, plugins):
+        super(_Resolved, self).__init__()
+        self.plugins = plugins
+
+    def __missing__(self, name):
+        plugin = self[name] = self.plugins[name]
+        return plugin
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.plugins
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     # used internally by Ansible, it should match the file name
     # Is not required
     NAME = 'mm_inventory'
@@ -270,6 +2024,35 @@ class InventoryModule(BaseInventoryPlugin, Cacheable):
     # will read all settings from environment variables.
     no_config_file_supplied = False
 
+    # Ansible 2.7- has another cache interface, set by parse()
+    _old_cache = False
+
+    # Cache settings, set by parse()
+    _cache_ttl = 0
+    _stale_while_revalidate = False
+    _max_stale = 0
+    _incremental = False
+
+    # The entry in providers a copy of the plugin fetches, set by parse()
+    _settings = None
+
+    # If the last inventory only has the hosts of the limit
+    _limited = False
+
+    # Use a fresh snapshot instead of Micetro, off to make a snapshot
+    _use_snapshot = True
+
+    # Keep the custom properties of the hosts, for constructed groups and
+    # variables, and the compiled Jinja2 expressions of this load
+    _keep_properties = False
+    _compiled = None
+
+    # The shards in the cache, the names of the shards served while
+    # expired, and if this is the background refresh
+    _manifest = None
+    _stale = ()
+    _revalidating = False
+
     def verify_file(self, path):
         """Verify if the configuration file is valid."""
         valid_names = ['mm_inventory', 'mmsuite', 'mandm', 'menandmice',
@@ -286,31 +2069,33 @@ class InventoryModule(BaseInventoryPlugin, Cacheable):
 
         return valid
 
-    def get_inventory(self):
+    def get_inventory(self, cache_key=None):
         """Create a inventory dictionairy with all host and group information.
 
-           Return a dictionary that contains:
-                invent = {
-                    'hosts': [{'name': hostname, 'address': ipaddress}, ...],
-                    'groups': {
-                        "all": [hostname1, hostname2, ...],
-                        "mm_hosts": [hostname1, hostname2, ...],
-                        "custgrp1":  [hostname1, hostname5, ...],
-                        "custgrp3":  [hostname4, hostname7, ...],
-                        .
-                        .
-                        .
-                    }
-                }
-
-             This is the dictionairy that will cached, if requested (2.8+)
+           Return the blob of a HostTable, with the table of the ranges
+           in 'ranges'.
+
+           With a cache_key the cache is used, in shards: one with the
+           ranges and one per range with its hosts. Every shard has its
+           own timeout, only the ranges with an expired shard are fetched.
         """
         # Read inventory from the Micetro server
 
-        # Get the needed connection information
-        mmurl = self.get_option('host')
-        user = self.get_option('user')
-        password = self.get_option('password')
+        # Get the needed connection information, of the plugin or of the
+        # entry in providers this copy of the plugin fetches
+        settings = self._settings or {}
+
+        def setting(name):
+            if name in settings:
+                return settings[name]
+            try:
+                return self.get_option(name)
+            except KeyError:
+                return None
+
+        mmurl = setting('host')
+        user = setting('user')
+        password = setting('password')
 
         # If provider information is not present, quit
         if not (mmurl and user and password):
@@ -322,113 +2107,775 @@ class InventoryModule(BaseInventoryPlugin, Cacheable):
         provider = {
             'mmurl': mmurl,
             'user': user,
-            'password': password
-        }
-
-        # Check if filters are supplied
-        try:
-            filters = self.get_option('filters')
-        except KeyError as err:
-            filters = []
-
-        # Check if ranges are supplied
-        try:
-            ranges = self.get_option('ranges')
-        except KeyError as err:
-            ranges = []
-
-        # Start with an (almost) empty inventory
-        invent = {
-            'hosts': [],
-            'groups': {
-                "all": [],
-                "mm_hosts": []
-            }
+            'password': password,
+            'validate_certs': setting('validate_certs'),
+            'ca_bundle': setting('ca_bundle'),
+            'client_cert': setting('client_cert'),
+            'client_key': setting('client_key'),
         }
 
-        # Get all IP ranges
-        http_method = 'GET'
-        url = 'Ranges'
-        databody = {}
-        result = doapi(url, http_method, provider, databody)
-
-        # Find all child ranges, to prevent checking everything
-        children = []
-        for res in result['message']['result']['ranges']:
-            if res['childRanges']:
-                for child in res['childRanges']:
-                    # Check if it's a wanted range
-                    if ranges:
-                        if child['name'] in ranges:
-                            children.append({'ref': child['ref'], 'name': child['name']})
-                    else:
-                        children.append({'ref': child['ref'], 'name': child['name']})
+        # Check if filters and ranges are supplied
+        filters = setting('filters') or []
+        ranges = setting('ranges') or []
+
+        # The IPAM fields that become host variables are in the cache too
+        fields = list(self.get_option('hostvars_fields') or [])
+
+        # Start with an empty inventory
+        hosts = HostTable()
+
+        # What the other sources of this load fetched from this Micetro
+        registry = _shared(getattr(self, 'inventory', None))
+        micetro = (mmurl.rstrip('/'), user)
+
+        # Let Micetro do as much of the filtering as it can
+        server_filter, predicate = _split_filters(filters)
+        display.vvv("Micetro inventory: filter %s%s" % (server_filter, ', and more locally' if predicate else ''))
+
+        # The ranges are a shard of their own in the cache
+        default_ttl = self._cache_ttl
+        self._read_manifest(cache_key)
+        ranges_shard = self._read_shard(cache_key, 'ranges', default_ttl)
+        cached_ranges = ranges_shard or self._read_shard(cache_key, 'ranges')
+
+        def read_shards(tree):
+            """Find the wanted ranges and read their shards.
+
+            Only the ranges in the wanted subtrees that have addresses of
+            their own are fetched, for most ranges that are the ranges
+            without child ranges. The timeout of the cache of a range is
+            the lowest timeout of the cache_ttls entries the range is in,
+            or cache_timeout. The shards are only valid for the same
+            filters. Returns the selected ranges, the ranges to fetch and
+            the fresh and the expired shards.
+            """
+            selected = tree.select(ranges)
+            children = tree.plan(selected)
+            if limit is not None:
+                # Ranges that are new since the index may have any host
+                known = set(index['planned'])
+                children = [child for child in children if child['ref'] in limit or child['ref'] not in known]
+            wanted = set(child['ref'] for child in children)
+            matches = {}
+            if cache_key:
+                for network, ttl in (self.get_option('cache_ttls') or {}).items():
+                    for ref in tree.select([network]):
+                        if ref in wanted:
+                            matches.setdefault(ref, []).append(int(ttl))
+            ttls = dict((ref, min(matches[ref]) if ref in matches else default_ttl) for ref in wanted)
+
+            fresh = {}
+            expired = {}
+            for child in children:
+                shard = self._read_shard(cache_key, child['ref'], ttls[child['ref']])
+                if shard is None:
+                    shard = self._read_shard(cache_key, child['ref'])
+                    if shard is not None and shard.get('filters') == filters and shard.get('fields', []) == fields:
+                        expired[child['ref']] = shard
+                elif shard.get('filters') == filters and shard.get('fields', []) == fields:
+                    fresh[child['ref']] = shard
+            return selected, children, fresh, expired
+
+        # With a limit on the hosts of this run, only the ranges of these
+        # hosts are needed. The index of the ranges per host and group is
+        # made by the last build without a limit.
+        limit = None
+        index = None
+        if self.get_option('limit_aware') and cache_key:
+            index = self._read_shard(cache_key, 'index')
+            if index is not None and index.get('filters') == filters and index.get('ranges') == ranges and 'planned' in index:
+                limit = self._limit_ranges(index)
+        self._limited = limit is not None
+        if limit is not None:
+            display.vvv("Micetro inventory: the limit needs %d ranges" % len(limit))
+
+        tree = None
+        if cached_ranges is not None:
+            tree = RangeTree(cached_ranges['ranges'])
+            selected, children, shards, expired = read_shards(tree)
+
+        # An expired cache is brought up to date with the changes in the
+        # history of Micetro since it was fetched, when the history goes
+        # back that far. The mark is the id of the last change that is in
+        # a shard.
+        head = None
+        changes = None
+        if self._incremental and tree is not None and (ranges_shard is None or len(shards) < len(children)):
+            marks = [shard.get('mark') for shard in [cached_ranges] + list(expired.values())]
+            if None not in marks:
+                since = _history_since(provider, min(marks))
+                if since is not None:
+                    head, changes, dns = since
+                    if dns:
+                        resolved = _dns_changes(provider, dns, expired.values())
+                        changes = None if resolved is None else changes + resolved
+
+        if changes is None:
+            # A full sync, remember where the history is before fetching
+            if head is None and self._incremental and cache_key and (tree is None or ranges_shard is None or len(shards) < len(children)):
+                head = _history_head(provider)
+            if ranges_shard is None:
+                # Get all IP ranges and put them in a prefix tree, once
+                # per load for all sources of this Micetro
+                with _SHARED_LOCK:
+                    table, mark = registry.get(micetro + ('ranges',), (None, None))
+                if table is None or (head is not None and mark is None):
+                    http_method = 'GET'
+                    url = 'Ranges'
+                    databody = {}
+                    result = doapi(url, http_method, provider, databody)
+                    table, mark = result['message']['result']['ranges'], head
+                    with _SHARED_LOCK:
+                        registry[micetro + ('ranges',)] = (table, mark)
+                tree = RangeTree(table)
+                self._write_shard(cache_key, 'ranges', {'ranges': tree.table(), 'mark': _lowest(head, mark)})
+                selected, children, shards, expired = read_shards(tree)
+            expired = {}
+        elif ranges_shard is None:
+            # No ranges changed
+            self._write_shard(cache_key, 'ranges', {'ranges': cached_ranges['ranges'], 'mark': head})
+
+        # Find what to fetch for every range that is not cached: all its
+        # addresses, or only the changed ones
+        jobs = []
+        unchanged = 0
+        for child in children:
+            if child['ref'] in shards:
+                continue
+            shard = expired.get(child['ref'])
+            if shard is not None:
+                changed = set(address for change, version, number, address in changes
+                              if change > shard['mark'] and version == child['version'] and
+                              child['first'] <= number <= child['last'])
+                if not changed:
+                    unchanged += 1
+                    shards[child['ref']] = {'filters': filters, 'fields': fields, 'records': shard['records'], 'mark': head}
+                    self._write_shard(cache_key, child['ref'], shards[child['ref']])
+                    continue
+                if len(changed) <= _DELTA_LIMIT:
+                    jobs.append((child, changed))
+                    continue
+            jobs.append((child, None))
+
+        # The ranges another source of this load fetched with the same
+        # filter for Micetro are not fetched again
+        records_key = micetro + ('records', server_filter, tuple(fields))
+        shared = {}
+        for child, changed in jobs:
+            if changed is None:
+                found = _shared_records(registry.get(records_key, ()), child, head)
+                if found is not None:
+                    shared[child['ref']] = found
+        display.vvv("Micetro inventory: %d ranges cached, %d unchanged, %d changed, %d shared, %d to fetch" % (
+            len(children) - len(jobs) - unchanged, unchanged, sum(1 for job in jobs if job[1]), len(shared),
+            sum(1 for job in jobs if not job[1]) - len(shared)))
+
+        # Plan the queries for the ranges that are fetched whole, from the
+        # utilization of the ranges. The changed addresses are fetched per
+        # range.
+        page_size = self.get_option('page_size') or 0
+        strategy, planned_queries, costs = _plan_queries(
+            tree, [child for child, changed in jobs if changed is None and child['ref'] not in shared],
+            self.get_option('query_plan'),
+            server_filter.count(' and '), page_size)
+        queries = [(query, found, None) for query, found in planned_queries]
+        queries.extend((child, [child], changed) for child, changed in jobs if changed)
+        display.vvv("Micetro inventory: %s query plan with %d queries%s" % (
+            strategy, len(planned_queries),
+            ", estimated cost " + ", ".join("%s %d" % (name, costs[name]) for name in sorted(costs)) if costs else ''))
+        for query, found in planned_queries:
+            display.vvvv("Micetro inventory: query %s for %d ranges" % (query['name'] if query else 'all', len(found)))
 
         # Now that we have all child-ranges, find all active IP's in these
-        # ranges
-        http_method = "GET"
-        url = "command/GetIPAMRecords"
+        # ranges. The queries are done in parallel, but the results are
+        # handled in the order of the ranges, so the groups are the same
+        # every time.
+        def matches(record):
+            """Apply the filters Micetro could not handle, on all custom properties."""
+            return predicate(_sanitize_names(record[2]))
+
+        def fetch(query):
+            """Fetch the assigned IP addresses of a query, or the changed ones.
+
+            The IPAM records are fetched in pages of page_size records, and
+            every page is reduced to the records of hosts, as [address,
+            hostname, custom properties], before the next page is fetched.
+            The records of a whole query are shared with the other sources
+            of this load, before the filters of the plugin.
+            """
+            child, found, changed = query
+            start = time.time()
+            databody = {'filter': server_filter}
+            if child is not None:
+                databody['rangeRef'] = child['name']
+            if changed:
+                databody['filter'] += " and (%s)" % " or ".join("address=%s" % address for address in sorted(changed))
+            records = []
+            offset = 0
+            while True:
+                if page_size:
+                    databody.update({'limit': page_size, 'offset': offset})
+                result = doapi("command/GetIPAMRecords", "GET", provider, databody)
+                if result.get('warnings'):
+                    raise AnsibleError("Cannot get the IPAM records of %s: %s" % (
+                        child['name'] if child else 'all ranges', result['warnings']))
+                page = result['message']['result']
+                for ipam in page['ipamRecords']:
+                    # In Ansible 2.9 with Python3 the loop goes one further
+                    # as with the rest of the combinations. :-( ?????
+                    # This ends up with an empty `ipam['dnsHosts']` and that
+                    # results in a `list index out of range`.
+                    # So, I added an extra check for that.
+                    if not ipam['dnsHosts']:
+                        continue
+
+                    # Ansible only needs one combo, so only take the first
+                    # one from the returned result
+                    record = [ipam['address'], ipam['dnsHosts'][0]['dnsRecord']['name'], ipam['customProperties']]
+                    if fields:
+                        record.append(_project(ipam, fields))
+                    records.append(record)
+
+                # The last page is short, or ends at the total
+                offset += len(page['ipamRecords'])
+                total = page.get('totalResults')
+                if not page_size or len(page['ipamRecords']) < page_size or (total is not None and offset >= total):
+                    break
+            display.vvv("Micetro inventory: range %s fetched in %.3fs" % (
+                child['name'] if child else 'all', time.time() - start))
+            if not changed:
+                with _SHARED_LOCK:
+                    registry.setdefault(records_key, []).append(
+                        {'range': child, 'records': records, 'mark': head, 'keys': None, 'sorted': None})
+            if predicate is not None:
+                records = [record for record in records if matches(record)]
+            return records
+
+        workers = min(self.get_option('max_workers') or 1, len(queries))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(fetch, queries)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [fetch(query) for query in queries]
+
+        # The shared ranges, like they are fetched by a query of their own
+        for child, changed in jobs:
+            if child['ref'] in shared:
+                records = shared[child['ref']][0]
+                queries.append((child, [child], None))
+                results.append(records if predicate is None else [record for record in records if matches(record)])
+
+        # A query returns the addresses of all ranges below its range,
+        # every address goes to the smallest range it is fetched for. So
+        # a range with child ranges only keeps its own addresses.
+        planned = set(entry['ref'] for entry in tree.plan(selected))
+        fetched = dict((child['ref'], []) for child, changed in jobs)
+        for (query, found, changed), result in zip(queries, results):
+            wanted = set(target['ref'] for target in found)
+            for record in result:
+                entry = tree.covering(tree.lookup(record[0]), planned)
+                if entry is not None and entry['ref'] in wanted:
+                    fetched[entry['ref']].append(record)
+        del results
+
+        for child, changed in jobs:
+            records = fetched.pop(child['ref'])
+            # Only the changed addresses are fetched, replace them in the
+            # cached records
+            if changed:
+                records.extend(record for record in expired[child['ref']]['records']
+                               if record[0] not in changed)
+                records.sort(key=lambda record: _ip2int(record[0]))
+            mark = _lowest(head, shared[child['ref']][1]) if child['ref'] in shared else head
+            shards[child['ref']] = {'filters': filters, 'fields': fields, 'records': records, 'mark': mark}
+            self._write_shard(cache_key, child['ref'], shards[child['ref']])
+
+        # The index for limits has the smallest fetched range of every
+        # host, and the ranges of the hosts of every group
+        build_index = self.get_option('limit_aware') and cache_key and limit is None
+        host_ranges = {}
+
+        seen = set()
         for child in children:
-            # Construct the JSON databody
-            databody = {'filter': 'state=Assigned', 'rangeRef': child['name']}
-            result = doapi(url, http_method, provider, databody)
-
-            # All IPAM records in the range are retrieved. Split it out
-            for ipam in result['message']['result']['ipamRecords']:
-                # In Ansible 2.9 with Python3 the loop goes one further
-                # as with the rest of the combinations. :-( ?????
-                # This ends up with an empty `ipam['dnsHosts']` and that
-                # results in a `list index out of range`.
-                # So, I added an extra check for that.
-                if not ipam['dnsHosts']:
+            for record in shards[child['ref']]['records']:
+                address, hostname, custprops = record[:3]
+                # A range with addresses of its own also returns the
+                # addresses of its child ranges, only handle them once
+                if address in seen:
                     continue
+                seen.add(address)
 
-                # Ansible only needs one combo, so only take the first one
-                # from the returned result
-                address = ipam['address']
-                hostname = ipam['dnsHosts'][0]['dnsRecord']['name']
+                smallest = tree.lookup(address) or child
+                values = None
+                if fields:
+                    values = [smallest['name'] if field == 'range' else value for field, value in zip(fields, record[3])]
+                idx = hosts.add_host(hostname, address, custprops if self._keep_properties else None, values)
+                if build_index:
+                    host_ranges[idx] = tree.covering(smallest, planned)['ref']
 
                 # Create all custom property groups. These groups are all
                 # called mm_<cp_name>_<cp_value> and to prevent case mixup
                 # the names are converted to lowercase and sanitized
-                add_host = True
-                for custprop in ipam['customProperties']:
-                    custval = ipam['customProperties'][custprop]
-
-                    # Create and clean custom property group
-                    custgroup = "mm_%s_%s" % (custprop, custval)
-                    custgroup = _sanitize(custgroup)
-
-                    # Clean custom properties
-                    custprop = _sanitize(custprop)
-                    custval = _sanitize(custval)
-
-                    # Also create a group per range
-                    rangegrp = 'range_' + _sanitize(child['name'])
-
-                    # Apply filters, if requested. No filter means filters == None
-                    if filters:
-                        for f in filters:
-                            # Is the property in the filter and a wanted value
-                            add_host = f.get(custprop, None) == custval
-
-                    # If filter wants this host, add the custom group
-                    if add_host:
-                        invent['hosts'].append({'name': hostname, 'address': address})
-                        if custgroup not in invent['groups']:
-                            invent['groups'][custgroup] = []
-                        invent['groups'][custgroup].append(hostname)
-
-                        if rangegrp not in invent['groups']:
-                            invent['groups'][rangegrp] = []
-                        invent['groups'][rangegrp].append(hostname)
-
-                # If filter wants this host, add the host
-                if add_host:
-                    invent['groups']['all'].append(hostname)
-                    invent['groups']['mm_hosts'].append(hostname)
+                for custprop, custval in custprops.items():
+                    hosts.add_member(_sanitize("mm_%s_%s" % (custprop, custval)), idx)
+
+                # Also create a group per range, for the smallest range
+                # with the address and the selected ranges above it
+                for name in tree.groups(smallest, selected):
+                    hosts.add_member(_sanitize('range_' + name), idx)
+
+        # The index only changes when the hosts changed
+        if build_index and (self._manifest_changed or index is None):
+            self._write_shard(cache_key, 'index', {
+                'filters': filters,
+                'ranges': ranges,
+                'planned': sorted(planned),
+                'hosts': dict((hosts.names[idx], ref) for idx, ref in host_ranges.items()),
+                'groups': dict((group, sorted(set(host_ranges[idx] for idx in members)))
+                               for group, members in hosts.groups.items()),
+            })
+
+        # Switch to the new shards, after they are all written
+        self._write_manifest(cache_key)
 
         # Return collected results
+        display.vvv("Micetro inventory: %s" % metrics_summary())
+        invent = hosts.to_blob()
+        invent['ranges'] = tree.table()
+        invent['fields'] = fields
+        return invent
+
+    def _limit_ranges(self, index):
+        """Return the ranges the limit of this run needs, or None for all.
+
+        The patterns of the limit are host names, group names, wildcards
+        and regular expressions (~regex), like Ansible has them. When a
+        pattern matches nothing in the index, it may be a new host, and
+        all ranges are needed.
+        """
+        subset = context.CLIARGS.get('subset') if context and context.CLIARGS else None
+        if not subset:
+            return None
+        from ansible.inventory.manager import split_host_pattern
+
+        refs = set()
+        for pattern in split_host_pattern(subset):
+            # Exclusions only remove hosts, intersections are with hosts
+            # from the other patterns
+            if pattern.startswith('!'):
+                continue
+            pattern = pattern.lstrip('&')
+            if pattern.startswith('@') or pattern in ('all', '*', 'mm_hosts', 'ungrouped'):
+                return None
+
+            # A subscript (webservers[0:2]) selects from a group
+            match = re.match(r'^(.+)\[(-?\d+|-?\d*:-?\d*)\]$', pattern)
+            if match and not pattern.startswith('~'):
+                pattern = match.group(1)
+
+            if pattern.startswith('~'):
+                try:
+                    matches = re.compile(pattern[1:]).search
+                except re.error:
+                    return None
+            elif any(char in pattern for char in '*?['):
+                matches = re.compile(fnmatch.translate(pattern)).match
+            else:
+                matches = None
+
+            found = False
+            if matches is None:
+                if pattern in index['hosts']:
+                    refs.add(index['hosts'][pattern])
+                    found = True
+                if pattern in index['groups']:
+                    refs.update(index['groups'][pattern])
+                    found = True
+            else:
+                for name, ref in index['hosts'].items():
+                    if matches(name):
+                        refs.add(ref)
+                        found = True
+                for name, group_refs in index['groups'].items():
+                    if matches(name):
+                        refs.update(group_refs)
+                        found = True
+            if not found:
+                return None
+        return refs
+
+    # Every shard is in one of two slots. A new version of a shard is
+    # written to the other slot, and the manifest with the slot of every
+    # shard is written last. So a refresh replaces all its shards at once
+    # and a reader never sees a mix of old and new shards.
+
+    def _shard_key(self, cache_key, name, slot=None):
+        """Return the cache key of a shard, safe for a file name."""
+        key = "%s_%s" % (cache_key, re.sub(r'[^A-Za-z0-9]', '_', name))
+        if slot:
+            key = "%s_%s" % (key, slot)
+        return key
+
+    def _read_manifest(self, cache_key):
+        """Read the slots of the cached shards."""
+        self._manifest = {'version': HostTable.VERSION, 'shards': {}}
+        self._manifest_changed = False
+        self._stale = []
+        if not cache_key:
+            return
+        try:
+            manifest = self._cache[self._shard_key(cache_key, 'manifest')]
+        except KeyError:
+            return
+        if isinstance(manifest, dict) and manifest.get('version') == HostTable.VERSION:
+            self._manifest['shards'] = dict(manifest['shards'])
+
+    def _write_manifest(self, cache_key):
+        """Save the slots of the shards, when a shard was written."""
+        if not cache_key or not self._manifest_changed:
+            return
+        key = self._shard_key(cache_key, 'manifest')
+        # The cache plugin writes the keys in order, the manifest last
+        self._cache.pop(key, None)
+        self._cache[key] = self._manifest
+        if self._old_cache:
+            self.cache.set(key, self._manifest)
+
+    def _read_shard(self, cache_key, name, ttl=None):
+        """Return a cached shard that is younger than its timeout, or None.
+
+        With stale-while-revalidate an expired shard is returned as well,
+        up to the maximum staleness, and remembered to refresh. Without a
+        timeout the shard is returned no matter how old it is.
+        """
+        if not cache_key:
+            return None
+        slot = self._manifest['shards'].get(name)
+        if slot is None:
+            return None
+        try:
+            shard = self._cache[self._shard_key(cache_key, name, slot)]
+        except KeyError:
+            # Not in the cache, or expired by the cache plugin
+            return None
+        if not isinstance(shard, dict) or shard.get('version') != HostTable.VERSION:
+            return None
+
+        # A timeout of 0 never expires, like with the cache plugins
+        age = time.time() - shard.get('timestamp', 0)
+        if ttl is None or not ttl or age < ttl:
+            return shard
+        if self._stale_while_revalidate and not self._revalidating and age < ttl + self._max_stale:
+            self._stale.append(name)
+            return shard
+        return None
+
+    def _write_shard(self, cache_key, name, shard):
+        """Save a shard in the other slot, with the time it was fetched."""
+        if not cache_key:
+            return
+        shard['version'] = HostTable.VERSION
+        shard['timestamp'] = time.time()
+        slot = 'b' if self._manifest['shards'].get(name) == 'a' else 'a'
+        key = self._shard_key(cache_key, name, slot)
+        self._cache[key] = shard
+        self._manifest['shards'][name] = slot
+        self._manifest_changed = True
+        if self._old_cache:
+            # This feature will be removed in version 2.12, but
+            # is needed for the older style cache handling.
+            self.cache.set(key, shard)
+
+    def _revalidate(self, cache_key):
+        """Refresh the stale shards in a detached background process.
+
+        A lock makes sure only one refresh runs at a time, when another
+        refresh is running this one is skipped.
+        """
+        if fcntl is None or not hasattr(os, 'fork'):
+            return
+        lockfile = os.path.join(self._cache_dir(), "%s.lock" % cache_key)
+
+        display.vvv("Micetro inventory: refreshing %d stale shards in the background" % len(self._stale))
+        try:
+            pid = os.fork()
+        except OSError as err:
+            display.warning("Micetro inventory: cannot refresh the cache: %s" % to_native(err))
+            return
+        if pid:
+            # The first child exits right away, after starting the refresh
+            os.waitpid(pid, 0)
+            return
+
+        # Detach from the terminal and from Ansible, with a second fork
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fdesc in (0, 1, 2):
+                os.dup2(devnull, fdesc)
+
+            with open(lockfile, 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # Another refresh is running
+                    os._exit(0)
+                self._revalidating = True
+                self.get_inventory(cache_key)
+                if not self._old_cache:
+                    self.update_cache_if_changed()
+        finally:
+            os._exit(0)
+
+    # Constructed groups and variables. Every Jinja2 expression of
+    # compose, groups and keyed_groups is compiled once per load, instead
+    # of once per host, and evaluated over the host table.
+
+    def _compile(self, expression):
+        """Return a Jinja2 expression compiled to a function of the variables."""
+        if self._compiled is None:
+            # The filters and tests are plugins that Ansible finds by name
+            # on every use, find them once
+            environment = self.templar.environment.overlay()
+            environment.filters = _Resolved(environment.filters)
+            environment.tests = _Resolved(environment.tests)
+            self._compiled = {None: environment}
+        function = self._compiled.get(expression)
+        if function is None:
+            try:
+                function = self._compiled[None].compile_expression(expression, undefined_to_none=False)
+            except Exception as err:
+                # Fails for every host, like with templating
+                error = AnsibleError("template error while templating string: %s" % to_native(err))
+
+                def function(**variables):
+                    raise error
+            self._compiled[expression] = function
+        return function
+
+    def _evaluate(self, expression, variables):
+        """Evaluate a Jinja2 expression on the variables of a host."""
+        result = self._compile(expression)(**variables)
+        if isinstance(result, jinja2.Undefined):
+            # Raises the undefined variable error
+            result._fail_with_undefined_error()
+        return result
+
+    def _compose(self, template, variables, disable_lookups=True):
+        """Return the value of a Jinja2 expression, as templating returns it."""
+        result = self._evaluate(template, variables)
+        # Templating makes text of the result, unless it is native
+        concat = getattr(self.templar.environment, 'concat', None)
+        if concat is not None:
+            result = concat(iter([result]))
+        return result
+
+    def _add_host_to_composed_groups(self, groups, variables, host, strict=False, fetch_hostvars=True):
+        """Add a host to the groups with a condition that is true for it."""
+        if not groups or not isinstance(groups, dict):
+            return
+        for group_name in groups:
+            try:
+                result = bool(self._evaluate(groups[group_name], variables))
+            except Exception as err:
+                if strict:
+                    raise AnsibleParserError("Could not add host %s to group %s: %s" % (host, group_name, to_native(err)))
+                continue
+            if result:
+                group_name = self.inventory.add_group(self._sanitize_group_name(group_name))
+                self.inventory.add_child(group_name, host)
+
+    def _construct(self, invent, compose, groups, keyed_groups, strict):
+        """Add the constructed variables and groups to all hosts.
+
+        The variables of a host are ansible_host, inventory_hostname,
+        mm_custom_properties and the variables of hostvars_fields, and the
+        variables of compose, in order.
+        """
+        keyed_args = {}
+        if 'fetch_hostvars' in Constructable._add_host_to_keyed_groups.__code__.co_varnames:
+            # All variables of the host are passed, no need to get them
+            keyed_args['fetch_hostvars'] = False
+        try:
+            extra_vars = self._vars if self.get_option('use_extra_vars') else {}
+        except (KeyError, AttributeError):
+            extra_vars = {}
+        properties = invent.get('properties') or [None] * len(invent['hosts'])
+        values = invent.get('values') or [None] * len(invent['hosts'])
+        fields = [_field_variable(field) for field in invent.get('fields') or []]
+        for name, address, props, vals in zip(invent['hosts'], invent['addresses'], properties, values):
+            variables = {
+                'inventory_hostname': name,
+                'ansible_host': address,
+                'mm_custom_properties': props or {},
+            }
+            if vals is not None:
+                variables.update(zip(fields, vals))
+            variables.update(extra_vars)
+            for varname in compose or {}:
+                try:
+                    value = self._compose(compose[varname], variables)
+                except Exception as err:
+                    if strict:
+                        raise AnsibleError("Could not set %s for host %s: %s" % (varname, name, to_native(err)))
+                    continue
+                self.inventory.set_variable(name, varname, value)
+                variables[varname] = value
+            self._add_host_to_composed_groups(groups, variables, name, strict)
+            self._add_host_to_keyed_groups(keyed_groups, variables, name, strict, **keyed_args)
+
+    def _fetch_inventory(self, cache_key):
+        """Get the inventory of the Micetro, or of all Micetros in providers.
+
+        Every Micetro in providers is fetched by a copy of the plugin, all
+        at the same time, with a cache of its own. Returns the blob of the
+        inventory and the copies of the plugin with their cache keys.
+        """
+        workers = [(self, cache_key)]
+        providers = self.get_option('providers') or []
+        if providers:
+            workers = []
+            for settings in providers:
+                if not isinstance(settings, dict) or not settings.get('name'):
+                    raise AnsibleParserError("Every entry in providers needs a name")
+                worker = copy.copy(self)
+                worker._settings = settings
+                workers.append((worker, cache_key and "%s_%s" % (cache_key, settings['name'])))
+            if len(set(settings['name'] for settings in providers)) < len(providers):
+                raise AnsibleParserError("The names in providers are not unique")
+
+        if len(workers) == 1:
+            invents = [workers[0][0].get_inventory(workers[0][1])]
+        else:
+            pool = ThreadPool(len(workers))
+            try:
+                invents = pool.map(lambda job: job[0].get_inventory(job[1]), workers)
+            finally:
+                pool.close()
+                pool.join()
+
+        invent = invents[0]
+        if providers:
+            # Merge the hosts of all providers, in the order of providers
+            collisions = self.get_option('host_collisions')
+            hosts = HostTable()
+            for settings, blob in zip(providers, invents):
+                try:
+                    collided = hosts.add_blob(blob, prefix=settings.get('prefix') or '', collisions=collisions,
+                                              group=_sanitize('mm_provider_' + settings['name']))
+                except ValueError as err:
+                    raise AnsibleParserError("Micetro inventory: provider %s: %s" % (settings['name'], to_native(err)))
+                if collided:
+                    display.warning("Micetro inventory: %d hosts of provider %s are already in the inventory, "
+                                    "the %s one is used (e.g. %s)" % (len(collided), settings['name'],
+                                                                      collisions, collided[0]))
+            invent = hosts.to_blob()
+            invent['fields'] = invents[0].get('fields') or []
+
+        return invent, workers
+
+    def _cache_dir(self):
+        """Return the directory for the files of the plugin next to the cache."""
+        directory = self.get_option('cache_connection')
+        if not directory or not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+        return directory
+
+    def _columnar(self, cache_key):
+        """Return the path, the key and the timeout of the columnar cache file.
+
+        The key changes with every setting that changes the inventory. The
+        timeout is the lowest of cache_timeout and cache_ttls, like for the
+        shards, with 0 for no timeout.
+        """
+        ttls = [int(ttl) for ttl in [self._cache_ttl] + list((self.get_option('cache_ttls') or {}).values()) if int(ttl)]
+        ttl = min(ttls) if ttls else 0
+        key = hashlib.sha1(json.dumps([cache_key, ttl, self._settings_key()]).encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir(), "%s.mminv" % cache_key), key, ttl
+
+    def _settings_key(self):
+        """Return a hash of the settings that make the inventory.
+
+        The passwords are left out, so the hash can be shown.
+        """
+        settings = dict((name, self.get_option(name)) for name in (
+            'host', 'user', 'ranges', 'filters', 'hostvars_fields', 'providers', 'host_collisions',
+            'compose', 'groups', 'keyed_groups', 'strict'))
+        settings['providers'] = [dict((key, value) for key, value in provider.items() if key != 'password')
+                                 if isinstance(provider, dict) else provider
+                                 for provider in settings['providers'] or []]
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _provenance(self, source):
+        """Return the provenance of a snapshot of the inventory of source."""
+        now = time.time()
+        return {
+            'version': _SNAPSHOT_VERSION,
+            'timestamp': now,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)),
+            'source': source if self.no_config_file_supplied else os.path.abspath(source),
+            'host': self.get_option('host'),
+            'providers': [dict((key, provider.get(key)) for key in ('name', 'host'))
+                          for provider in self.get_option('providers') or []],
+            'ranges': self.get_option('ranges'),
+            'filters': self.get_option('filters'),
+            'settings': self._settings_key(),
+        }
+
+    def _load_snapshot(self, path):
+        """Add the inventory of a snapshot, when it is fresh and of these settings.
+
+        Returns if the snapshot was used.
+        """
+        try:
+            snapshot = _read_snapshot(path)
+            provenance = snapshot['_meta']['provenance']
+            age = time.time() - provenance['timestamp']
+        except (IOError, OSError, ValueError, KeyError, TypeError, yaml.YAMLError) as err:
+            display.vvv("Micetro inventory: cannot use the snapshot %s: %s" % (path, to_native(err)))
+            return False
+        max_age = self.get_option('snapshot_max_age')
+        if provenance.get('version') != _SNAPSHOT_VERSION or provenance.get('settings') != self._settings_key():
+            display.vvv("Micetro inventory: the snapshot %s is of other settings" % path)
+            return False
+        if max_age and age > max_age:
+            display.vvv("Micetro inventory: the snapshot %s is %d seconds old" % (path, age))
+            return False
+
+        display.vvv("Micetro inventory: from the snapshot %s of %s" % (path, provenance.get('created')))
+        for group, entry in snapshot.items():
+            if group != '_meta':
+                self.inventory.add_group(group)
+        for group, entry in snapshot.items():
+            if group == '_meta':
+                continue
+            for name in entry.get('hosts') or []:
+                self.inventory.add_host(name, group=group)
+            for child in entry.get('children') or []:
+                self.inventory.add_child(group, child)
+            for var, value in (entry.get('vars') or {}).items():
+                self.inventory.set_variable(group, var, value)
+        for name, variables in snapshot['_meta'].get('hostvars', {}).items():
+            self.inventory.add_host(name)
+            for var, value in variables.items():
+                self.inventory.set_variable(name, var, value)
+        return True
+
+    def _read_columnar(self, path, key, ttl):
+        """Return the columnar cache file, or None when it is missing or expired."""
+        try:
+            invent = _Columnar(path, key)
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+        if invent.expired():
+            return None
+        display.vvv("Micetro inventory: from the columnar cache %s" % path)
         return invent
 
     def parse(self, inventory, loader, path, cache=True):
@@ -436,6 +2883,12 @@ class InventoryModule(BaseInventoryPlugin, Cacheable):
         if not self.no_config_file_supplied and os.path.isfile(path):
             self._read_config_data(path)
 
+        # A fresh snapshot is used without Micetro and without the cache
+        snapshot = self.get_option('snapshot')
+        if snapshot and self._use_snapshot and self._load_snapshot(snapshot):
+            self.inventory.reconcile_inventory()
+            return
+
         # Load cache plugin (Ansible 2.8+)
         # Ansible 2.7- uses a slightly different approach, so that is
         # taken into account.
@@ -445,57 +2898,128 @@ class InventoryModule(BaseInventoryPlugin, Cacheable):
         except AttributeError as err:
             old_cache = True
 
-        # Update if caching is enabled and the cache needs refreshing
-        use_cache = self.get_option('cache') and cache
-        update_cache = False
-        if use_cache:
-            try:
-                # Get the unique cache key
-                cache_key = self.get_cache_key(path)
-            except KeyError:
-                # This occurs if the cache_key is not in the cache or if
-                # the cache_key expired, so the cache needs to be updated
-                update_cache = True
+        self._old_cache = old_cache
+
+        # With stale-while-revalidate, incremental syncs and the index for
+        # limits the cache plugin has to keep expired entries, the
+        # timeouts are handled by the shards themselves
+        self._cache_ttl = self.get_option('cache_timeout') or 0
+        self._stale_while_revalidate = self.get_option('cache_stale_while_revalidate')
+        self._max_stale = self.get_option('cache_max_stale') or 0
+        self._incremental = self.get_option('cache_incremental')
+        keep = self._max_stale if self._stale_while_revalidate else 0
+        if self._incremental or self.get_option('limit_aware'):
+            keep = max(keep, self.get_option('cache_max_age') or 0)
+        if keep and self._cache_ttl and not old_cache:
+            self.set_option('cache_timeout', self._cache_ttl + keep)
+            self.load_cache_plugin()
 
-        # If cache_key was read
+        # When caching is enabled, the cache is used for all shards that
+        # have not expired. If user did not define cache, always run
+        use_cache = self.get_option('cache') and cache
+        cache_key = None
         if use_cache:
-            try:
-                # Read the current inventory from the cache.
-                # If this fails, that is either because of a non-existing
-                # or an expired cache
-                invent = self._cache[cache_key]
-            except KeyError:
-                # This occurs if the cache_key is not in the cache or if
-                # the cache_key expired, so the cache needs to be updated
-                update_cache = True
-
-        # Update cache if needed. If user did not define cache, always run
-        if update_cache or not use_cache:
-            invent = self.get_inventory()
-
-        # Inventory blob is in. Create a complete inventory
-        for host in invent['hosts']:
-            # Host is a dict with hostname and IP
-            self.inventory.add_host(host['name'])
-            self.inventory.set_variable(host['name'], 'ansible_host', host['address'])
-        for grp in invent['groups']:
+            # Get the unique cache key
+            cache_key = self.get_cache_key(path)
+
+        # The constructed groups and variables need the custom properties
+        compose = self.get_option('compose')
+        groups = self.get_option('groups')
+        keyed_groups = self.get_option('keyed_groups')
+        self._keep_properties = bool(compose or groups or keyed_groups)
+
+        # The columnar cache file has the whole inventory of the last
+        # build, while it is fresh not even the shards are read
+        columnar = None
+        invent = None
+        workers = []
+        if use_cache and self.get_option('cache_columnar'):
+            columnar = self._columnar(cache_key)
+            invent = self._read_columnar(*columnar)
+        if invent is None:
+            invent, workers = self._fetch_inventory(cache_key)
+            # A limited or stale inventory is not the whole inventory
+            if columnar and not any(worker._limited or worker._stale for worker, dummy in workers):
+                try:
+                    _write_columnar(columnar[0], invent, columnar[1], columnar[2])
+                except (IOError, OSError) as err:
+                    display.warning("Micetro inventory: cannot write the columnar cache: %s" % to_native(err))
+
+        # Inventory blob is in. Create a complete inventory, with every
+        # host and every group membership added once
+        names = invent['hosts']
+        self.inventory.add_group('mm_hosts')
+        for name, address in zip(names, invent['addresses']):
+            self.inventory.add_host(name, group='mm_hosts')
+            self.inventory.set_variable(name, 'ansible_host', address)
+        for grp, members in invent['groups'].items():
             self.inventory.add_group(grp)
-            for host in invent['groups'][grp]:
-                self.inventory.add_host(host, group=grp)
-
-        # Update cache if needed and requested
-        if use_cache:
-            if not old_cache:
-                self.update_cache_if_changed()
-
-            # When the cache needs updating
-            if update_cache:
-                if not old_cache:
-                    self._cache[cache_key] = invent
-                else:
-                    # This feature will be removed in version 2.12, but
-                    # is needed for the older style cache handling.
-                    self.cache.set(cache_key, invent)
+            for idx in members:
+                self.inventory.add_child(grp, names[idx])
+        if self._keep_properties:
+            self._construct(invent, compose, groups, keyed_groups, self.get_option('strict'))
+
+        # The variables of the IPAM fields are only made for the hosts
+        # Ansible uses
+        if invent.get('values'):
+            variables = [_field_variable(field) for field in invent['fields']]
+            for name, values in zip(names, invent['values']):
+                if values is not None:
+                    host = self.inventory.get_host(name)
+                    host.vars = _LazyVars(host.vars, list(zip(variables, values)))
+
+        # Write the changed shards to the cache plugin
+        if use_cache and not old_cache:
+            self.update_cache_if_changed()
+
+        # Refresh the expired shards that were used, after the cache is
+        # written
+        for worker, worker_key in workers:
+            if use_cache and worker._stale:
+                worker._revalidate(worker_key)
 
         # Clean up the inventory before returning
         self.inventory.reconcile_inventory()
+
+
+def export_snapshot(source, output, cache=True):
+    """Make the inventory of a source and write it as a snapshot.
+
+    Returns the snapshot.
+    """
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+
+    inventory_loader.add_directory(os.path.dirname(os.path.abspath(__file__)))
+    plugin = inventory_loader.get('mm_inventory')
+    if not plugin.verify_file(source):
+        raise AnsibleError("%s is not a Micetro inventory source" % source)
+    plugin._use_snapshot = False
+    inventory = InventoryData()
+    plugin.parse(inventory, DataLoader(), source, cache=cache)
+    snapshot = _snapshot(inventory, plugin._provenance(source))
+    _write_snapshot(output, snapshot)
+    return snapshot
+
+
+def main():
+    """Write a snapshot of the inventory, for runners without Micetro."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('source', help='The mm_inventory.yml file, or @mm_inventory for the environment variables')
+    parser.add_argument('output', help='The snapshot for the snapshot option, JSON when it ends in .json and YAML otherwise')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Get the inventory from Micetro, not from the cache')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    args = parser.parse_args()
+
+    display.verbosity = args.verbose
+    try:
+        snapshot = export_snapshot(args.source, args.output, cache=args.cache)
+    except (AnsibleError, IOError, OSError) as err:
+        sys.exit("Error: %s" % to_native(err))
+    print("%d hosts and %d groups written to %s" % (
+        len(snapshot['_meta']['hostvars']), len(snapshot) - 1, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,422 @@ STATEBOOL = {
 }
 
 
+#CLIENT_START
+# Everything between the CLIENT_START and CLIENT_END markers is the
+# Micetro API client. The plugins carry a copy of it, so only edit it
+# here and run `doit` to update the modules and the plugins.
+
+# Maximum number of tries to connect to the Men&Mice API
+MAXTRIES = 5
+
+# Methods that are sent again when the connection fails after the request
+# was sent, as sending them twice does no harm. Other requests are only
+# sent again when the connection failed before they were sent.
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Redirects that are followed, with the same method and body, to the same
+# host only, so the credentials are never sent elsewhere. E.g. an mmurl
+# with http:// that redirects to https://
+REDIRECTS = (301, 302, 307, 308)
+MAX_REDIRECTS = 5
+
+# Connections to the API are kept open and reused for the next call to
+# the same Micetro. The SSL context is created once per set of TLS
+# options and new connections resume the last TLS session, so only the
+# first connection pays for a full TLS handshake. The TLS sessions survive
+# a fork, the connections themselves are never shared between processes.
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+_SSL_CONTEXTS = {}
+_TLS_SESSIONS = {}
+
+# Counters of the API traffic of this process
+METRICS = {
+    'requests': 0,
+    'connections': 0,
+    'handshakes': 0,
+    'resumed': 0,
+    'handshake_time': 0.0,
+}
+
+
+# JSON codecs to encode the requests and decode the responses with. A
+# codec is a tuple with a dumps and a loads function, where dumps may
+# return bytes and loads accepts bytes. The fastest installed codec is
+# used, unless another one is selected with MM_JSON_CODEC.
+JSON_CODECS = {}
+
+
+def _std_loads(data):
+    """Decode JSON with the standard library."""
+    # Sometimes (older Python) the data is not a string but a
+    # byte array.
+    if isinstance(data, bytes):
+        data = data.decode('utf8')
+    return json.loads(data)
+
+
+def register_json_codec(name, dumps, loads):
+    """Make a JSON codec available to the API client."""
+    JSON_CODECS[name] = (dumps, loads)
+
+
+register_json_codec('json', json.dumps, _std_loads)
+if ujson is not None:
+    register_json_codec('ujson', ujson.dumps, ujson.loads)
+if orjson is not None:
+    register_json_codec('orjson', orjson.dumps, orjson.loads)
+
+JSON_CODEC = os.environ.get('MM_JSON_CODEC') or next(
+    name for name in ('orjson', 'ujson', 'json') if name in JSON_CODECS)
+if JSON_CODEC not in JSON_CODECS:
+    raise AnsibleError("Unknown JSON codec '%s' in MM_JSON_CODEC, available are: %s" % (
+        JSON_CODEC, ", ".join(sorted(JSON_CODECS))))
+
+
+def _count(metric, value=1):
+    """Update one of the API metrics."""
+    with _POOL_LOCK:
+        METRICS[metric] += value
+
+
+def metrics_summary():
+    """Return the API metrics as a human readable string."""
+    return ("%(requests)d API calls, %(connections)d connections, "
+            "%(handshakes)d TLS handshakes (%(resumed)d resumed) "
+            "in %(handshake_time).3fs" % METRICS)
+
+
+def _tls_options(provider):
+    """Return the TLS options of a provider as a hashable tuple."""
+    return (bool(provider.get('validate_certs') or False),
+            provider.get('ca_bundle') or None,
+            provider.get('client_cert') or None,
+            provider.get('client_key') or None)
+
+
+def _ssl_context(tlsopts):
+    """Get the SSL context for a set of TLS options, create it if needed."""
+    with _POOL_LOCK:
+        context = _SSL_CONTEXTS.get(tlsopts)
+        if context is None:
+            validate, cafile, certfile, keyfile = tlsopts
+            context = ssl.create_default_context(cafile=cafile)
+            if not validate:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if certfile:
+                context.load_cert_chain(certfile, keyfile)
+            _SSL_CONTEXTS[tlsopts] = context
+    return context
+
+
+def _is_cert_error(err):
+    """Check if an exception is a failed certificate validation."""
+    return (isinstance(err, ssl.CertificateError) or
+            'CERTIFICATE_VERIFY_FAILED' in to_native(err))
+
+
+class RequestNotSent(socket.error):
+    """The connection to the API failed before the request was sent."""
+
+
+class _HTTPSConnection(http_client.HTTPSConnection):
+    """HTTPS connection that resumes TLS sessions and counts handshakes."""
+
+    def __init__(self, host, port, timeout, tlsopts, proxy=None):
+        self._mm_context = _ssl_context(tlsopts)
+        self._mm_session_key = (host, port, tlsopts)
+        if proxy is None:
+            http_client.HTTPSConnection.__init__(self, host, port,
+                                                 timeout=timeout,
+                                                 context=self._mm_context)
+        else:
+            http_client.HTTPSConnection.__init__(self, proxy.hostname, proxy.port or 80,
+                                                 timeout=timeout,
+                                                 context=self._mm_context)
+            self.set_tunnel(host, port, _proxy_headers(proxy))
+
+    def connect(self):
+        """Connect to the API and do the TLS handshake."""
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        server = self.host
+
+        # Through a proxy the TLS connection goes over a CONNECT tunnel
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+            server = self._tunnel_host
+        kwargs = {'server_hostname': server}
+
+        # Resuming a session is available as of Python 3.6
+        session = _TLS_SESSIONS.get(self._mm_session_key)
+        if session is not None and hasattr(ssl.SSLSocket, 'session'):
+            kwargs['session'] = session
+
+        start = time.time()
+        self.sock = self._mm_context.wrap_socket(sock, **kwargs)
+        _count('handshake_time', time.time() - start)
+        _count('handshakes')
+        if getattr(self.sock, 'session_reused', False):
+            _count('resumed')
+
+    def save_session(self):
+        """Keep the TLS session, to resume it on the next connection.
+
+        With TLS 1.3 the session ticket arrives after the handshake, so
+        this is done after a response has been read.
+        """
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            _TLS_SESSIONS[self._mm_session_key] = session
+
+
+def _proxy(parts):
+    """Return the proxy to reach an API URL through, or None.
+
+    Like open_url, this honours the http_proxy, https_proxy and no_proxy
+    environment variables.
+    """
+    proxy = getproxies().get(parts.scheme)
+    if not proxy or proxy_bypass(parts.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlparse(proxy)
+
+
+def _proxy_headers(proxy):
+    """Return the headers to authenticate at a proxy with."""
+    if not proxy.username:
+        return {}
+    credentials = "%s:%s" % (unquote(proxy.username), unquote(proxy.password or ''))
+    return {'Proxy-Authorization': 'Basic %s' % to_native(base64.b64encode(to_bytes(credentials)))}
+
+
+def _get_connection(parts, provider, proxy):
+    """Get an idle connection from the pool, or create a new one.
+
+    Returns the pool key, the connection and whether it was reused.
+    """
+    tlsopts = _tls_options(provider)
+    key = (os.getpid(), parts.scheme, parts.hostname, parts.port, tlsopts,
+           proxy.netloc if proxy else None)
+    with _POOL_LOCK:
+        idle = _POOL.get(key)
+        if idle:
+            return key, idle.pop(), True
+
+    timeout = provider.get('timeout') or 10
+    if parts.scheme == 'https':
+        conn = _HTTPSConnection(parts.hostname, parts.port or 443, timeout, tlsopts, proxy)
+    elif proxy:
+        conn = http_client.HTTPConnection(proxy.hostname, proxy.port or 80,
+                                          timeout=timeout)
+    else:
+        conn = http_client.HTTPConnection(parts.hostname, parts.port or 80,
+                                          timeout=timeout)
+    _count('connections')
+    return key, conn, False
+
+
+def _is_dropped(conn):
+    """Check if the server closed an idle connection from the pool.
+
+    An idle connection has nothing to read, so a readable socket means
+    the server closed it (or sent something unexpected).
+    """
+    try:
+        readable = select.select([conn.sock], [], [], 0)[0]
+    except (socket.error, ValueError, TypeError):
+        return True
+    return bool(readable)
+
+
+def _release_connection(key, conn):
+    """Return a connection to the pool."""
+    if isinstance(conn, _HTTPSConnection) and conn.sock is not None:
+        conn.save_session()
+    with _POOL_LOCK:
+        _POOL.setdefault(key, []).append(conn)
+
+
+def _http_transport(method, apiurl, provider, body, headers):
+    """Send a request to the Micetro API over a pooled connection.
+
+    Returns the HTTP status code, the reason and the response body.
+    Connection errors are raised to the caller, as RequestNotSent when
+    the request was not sent. Redirects to the same host are followed,
+    other redirects are returned.
+    """
+    redirects = 0
+    while True:
+        code, reason, response, location = _http_request(method, apiurl, provider, body, headers)
+        if code not in REDIRECTS or not location:
+            return code, reason, response
+        target = urljoin(apiurl, location)
+        if urlparse(target).hostname != urlparse(apiurl).hostname:
+            return code, reason, response
+        redirects += 1
+        if redirects > MAX_REDIRECTS:
+            raise AnsibleError("Too many redirects for %s" % apiurl)
+        apiurl = target
+
+
+def _http_request(method, apiurl, provider, body, headers):
+    """Send one request over a pooled connection.
+
+    Returns the HTTP status code, the reason, the response body and the
+    Location header.
+    """
+    parts = urlparse(apiurl)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+
+    # An HTTP proxy gets the full URL, HTTPS goes through a tunnel
+    proxy = _proxy(parts)
+    if proxy and parts.scheme == 'http':
+        path = apiurl
+        headers = dict(headers, **_proxy_headers(proxy))
+
+    while True:
+        key, conn, reused = _get_connection(parts, provider, proxy)
+        if reused and _is_dropped(conn):
+            conn.close()
+            continue
+        try:
+            if conn.sock is None:
+                conn.connect()
+        except (socket.error, http_client.HTTPException) as err:
+            conn.close()
+            if _is_cert_error(err):
+                raise
+            raise RequestNotSent(to_native(err))
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            response = resp.read()
+        except (socket.error, http_client.HTTPException):
+            conn.close()
+            # The server may have closed an idle connection in the
+            # meantime, so retry on a fresh connection when the request
+            # can be sent twice
+            if reused and method in IDEMPOTENT:
+                continue
+            raise
+        _release_connection(key, conn)
+        return resp.status, resp.reason, response, resp.getheader('Location')
+
+
+# Request fields that are never written to a cassette
+SCRUB_FIELDS = ('password', 'newPassword', 'oldPassword')
+
+
+def _scrub(data):
+    """Replace the credentials in a request or response."""
+    if isinstance(data, dict):
+        return dict((key, '********' if key in SCRUB_FIELDS else _scrub(val))
+                    for key, val in data.items())
+    if isinstance(data, list):
+        return [_scrub(val) for val in data]
+    return data
+
+
+class Cassette(object):
+    """Transport that records the API traffic to a file, or replays it.
+
+    The cassette is a file with a JSON document per API call, holding
+    the request, the response and the time the call took. The address
+    of Micetro and the headers are not recorded and the credentials are
+    scrubbed from the requests and responses.
+
+    When replaying, the calls are matched on the method, the URL and the
+    request body. Calls with the same request get the recorded responses
+    in order, after the last one that one is repeated. The recorded
+    time is waited for, multiplied by the latency factor.
+    """
+
+    def __init__(self, path, mode='replay', latency=1.0, transport=None):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.transport = transport or _http_transport
+        self.lock = threading.Lock()
+        self.calls = {}
+        if mode == 'replay':
+            with open(path) as fhandle:
+                for line in fhandle:
+                    if line.strip():
+                        call = json.loads(line)
+                        self.calls.setdefault(self._key(call), []).append(call)
+        elif mode != 'record':
+            raise AnsibleError("Unknown cassette mode '%s'" % mode)
+
+    @staticmethod
+    def _request(method, apiurl, body):
+        """Return the request as it is stored in a cassette."""
+        if isinstance(body, bytes):
+            body = body.decode('utf8')
+        return {
+            'method': method,
+            'url': apiurl.split('/mmws/api/', 1)[-1],
+            'body': _scrub(json.loads(body)) if body else None,
+        }
+
+    @staticmethod
+    def _key(call):
+        """Return the key to match a call on."""
+        return (call['method'], call['url'], json.dumps(call['body'], sort_keys=True))
+
+    def __call__(self, method, apiurl, provider, body, headers):
+        """Record or replay an API call."""
+        call = self._request(method, apiurl, body)
+        if self.mode == 'record':
+            start = time.time()
+            code, reason, response = self.transport(method, apiurl, provider, body, headers)
+            elapsed = time.time() - start
+            response_text = to_native(response)
+            try:
+                response_text = json.dumps(_scrub(json.loads(response_text)))
+            except ValueError:
+                pass
+            call.update({
+                'status': code,
+                'reason': reason,
+                'response': response_text,
+                'elapsed': round(elapsed, 6),
+            })
+            with self.lock:
+                with open(self.path, 'a') as fhandle:
+                    fhandle.write(json.dumps(call, sort_keys=True) + '\n')
+            return code, reason, response
+
+        with self.lock:
+            recorded = self.calls.get(self._key(call))
+            if not recorded:
+                raise AnsibleError("No recorded response for %s %s in %s" % (method, call['url'], self.path))
+            if len(recorded) > 1:
+                call = recorded.pop(0)
+            else:
+                call = recorded[0]
+        if self.latency:
+            time.sleep(call['elapsed'] * self.latency)
+        return call['status'], call['reason'], to_bytes(call['response'])
+
+
+# The transport sends the API calls to Micetro, which is done by
+# _http_transport() unless it is replaced. A transport is called with
+# the method, the URL, the provider, the body and the headers and returns
+# the HTTP status code, the reason and the response body. Set MM_CASSETTE
+# to record (MM_CASSETTE_MODE=record) or replay the API calls.
+TRANSPORT = None
+if os.environ.get('MM_CASSETTE'):
+    TRANSPORT = Cassette(os.environ['MM_CASSETTE'],
+                         mode=os.environ.get('MM_CASSETTE_MODE', 'replay'),
+                         latency=float(os.environ.get('MM_CASSETTE_LATENCY', 1.0)))
+
+
 def doapi(url, method, provider, databody):
     """Run an API call.
 
@@ -25,78 +441,88 @@ def doapi(url, method, provider, databody):
         - The Ansible result dict
 
     When connection errors arise, there will be a multiple of tries,
-    each a couple of seconds apart, this to handle high-availability
+    each a couple of seconds apart, this to handle high-availability.
+    Requests that are not idempotent are only tried again when they
+    were not sent.
     """
-    headers = {'Content-Type': 'application/json'}
+    credentials = "%s:%s" % (provider['user'], provider['password'])
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Basic %s' % to_native(base64.b64encode(to_bytes(credentials))),
+    }
     apiurl = "%s/mmws/api/%s" % (provider['mmurl'], url)
     result = {}
 
-    # Maximum and current number of tries to connect to the Men&Mice API
-    maxtries = 5
-    tries = 0
+    dumps, loads = JSON_CODECS[JSON_CODEC]
+
+    # A GET without parameters has no body at all
+    body = None
+    if databody or method != 'GET':
+        body = dumps(databody)
 
-    while tries <= 4:
+    tries = 0
+    while True:
         tries += 1
         try:
-            resp = open_url(apiurl,
-                            method=method,
-                            force_basic_auth=True,
-                            url_username=provider['user'],
-                            url_password=provider['password'],
-                            data=json.dumps(databody),
-                            validate_certs=False,
-                            headers=headers)
-
-            # Response codes of the API are:
-            #  - 200 => All OK, data returned in the body
-            #  - 204 => All OK, no data returned in the body
-            #  - *   => Something is wrong, error data in the body
-            # But sometimes there is a situation where the response code
-            # was 201 and with data in the body, so that is picked up as well
-
-            # Get all API data and format return message
-            response = resp.read()
-            if resp.code == 200:
-                # 200 => Data in the body
-                # Sometimes (older Python) the data is not a string but a
-                # byte array.
-                if isinstance(response, bytes):
-                    response = response.decode('utf8')
-                result['message'] = json.loads(response)
-            elif resp.code == 201:
-                # 201 => Sometimes data in the body??
-                try:
-                    result['message'] = json.loads(response)
-                except ValueError:
-                    result['message'] = ""
-            else:
-                # No response from API (204 => No data)
-                try:
-                    result['message'] = resp.reason
-                except AttributeError:
-                    result['message'] = ""
-            result['changed'] = True
-        except HTTPError as err:
-            errbody = json.loads(err.read().decode())
-            result['changed'] = False
-            result['warnings'] = "%s: %s (%s)" % (err.msg,
-                                                  errbody['error']['message'],
-                                                  errbody['error']['code']
-                                                  )
-        except URLError as err:
-            raise AnsibleError("Failed lookup url for %s : %s" % (apiurl, to_native(err)))
-        except SSLValidationError as err:
-            raise AnsibleError("Error validating the server's certificate for %s: %s" % (apiurl, to_native(err)))
-        except ConnectionError as err:
-            if tries == maxtries:
+            code, reason, response = (TRANSPORT or _http_transport)(method, apiurl, provider,
+                                                                    body, headers)
+            break
+        except (socket.error, http_client.HTTPException) as err:
+            if _is_cert_error(err):
+                raise AnsibleError("Error validating the server's certificate for %s: %s" % (apiurl, to_native(err)))
+            # Micetro may have handled a request that failed after it was
+            # sent, so only send it again when that does no harm
+            if method not in IDEMPOTENT and not isinstance(err, RequestNotSent):
+                raise AnsibleError("Error connecting to %s, the %s request may have been handled: %s" % (
+                    apiurl, method, to_native(err)))
+            if tries == MAXTRIES:
                 raise AnsibleError("Error connecting to %s: %s" % (apiurl, to_native(err)))
             # There was a connection error, wait a little and retry
             time.sleep(0.25)
+    _count('requests')
 
-        if result.get('message', "") == "No Content":
+    # Response codes of the API are:
+    #  - 200 => All OK, data returned in the body
+    #  - 204 => All OK, no data returned in the body
+    #  - *   => Something is wrong, error data in the body
+    # But sometimes there is a situation where the response code
+    # was 201 and with data in the body, so that is picked up as well
+    if code == 200:
+        # 200 => Data in the body
+        result['message'] = loads(response)
+        result['changed'] = True
+    elif code == 201:
+        # 201 => Sometimes data in the body??
+        try:
+            result['message'] = loads(response)
+        except ValueError:
             result['message'] = ""
+        result['changed'] = True
+    elif code < 300:
+        # No response from API (204 => No data)
+        result['message'] = reason or ""
+        result['changed'] = True
+    elif code < 400:
+        # A redirect that was not followed, to another host or from
+        # another transport
+        raise AnsibleError("%s redirects elsewhere (%d %s), set mmurl to the URL Micetro is reached on" % (
+            apiurl, code, reason))
+    else:
+        # Error from the API, the details are in the body
+        try:
+            errbody = loads(response)
+            errmsg = "%s (%s)" % (errbody['error']['message'],
+                                  errbody['error']['code'])
+        except (ValueError, KeyError, TypeError):
+            errmsg = to_native(response)
+        result['changed'] = False
+        result['warnings'] = "%s: %s" % (reason, errmsg)
+
+    if result.get('message', "") == "No Content":
+        result['message'] = ""
 
-        return result
+    return result
+#CLIENT_END
 
 
 def getrefs(objtype, provider):
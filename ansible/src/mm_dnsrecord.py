@@ -124,6 +124,23 @@ DOCUMENTATION = r'''
           required: True
           type: str
           no_log: True
+        validate_certs:
+          description: Validate the TLS certificate of the API server.
+          required: False
+          type: bool
+          default: False
+        ca_bundle:
+          description: File with the CA certificates to validate the API server with.
+          required: False
+          type: path
+        client_cert:
+          description: File with the client certificate to present to the API server.
+          required: False
+          type: path
+        client_key:
+          description: File with the private key of the client certificate.
+          required: False
+          type: path
 '''
 
 EXAMPLES = r'''
@@ -211,7 +228,11 @@ def run_module():
             type='dict', required=True,
             options=dict(mmurl=dict(type='str', required=True, no_log=False),
                          user=dict(type='str', required=True, no_log=False),
-                         password=dict(type='str', required=True, no_log=True)
+                         password=dict(type='str', required=True, no_log=True),
+                         validate_certs=dict(type='bool', required=False, default=False),
+                         ca_bundle=dict(type='path', required=False),
+                         client_cert=dict(type='path', required=False),
+                         client_key=dict(type='path', required=False, no_log=False)
                          )))
 
     # Seed the result dict in the object
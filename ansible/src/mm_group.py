@@ -82,6 +82,23 @@ DOCUMENTATION = r'''
           required: True
           type: str
           no_log: True
+        validate_certs:
+          description: Validate the TLS certificate of the API server.
+          required: False
+          type: bool
+          default: False
+        ca_bundle:
+          description: File with the CA certificates to validate the API server with.
+          required: False
+          type: path
+        client_cert:
+          description: File with the client certificate to present to the API server.
+          required: False
+          type: path
+        client_key:
+          description: File with the private key of the client certificate.
+          required: False
+          type: path
 '''
 
 EXAMPLES = r'''
@@ -137,7 +154,11 @@ def run_module():
             type='dict', required=True,
             options=dict(mmurl=dict(type='str', required=True, no_log=False),
                          user=dict(type='str', required=True, no_log=False),
-                         password=dict(type='str', required=True, no_log=True)
+                         password=dict(type='str', required=True, no_log=True),
+                         validate_certs=dict(type='bool', required=False, default=False),
+                         ca_bundle=dict(type='path', required=False),
+                         client_cert=dict(type='path', required=False),
+                         client_key=dict(type='path', required=False, no_log=False)
                          )))
 
     # Seed the result dict in the object
@@ -183,13 +204,11 @@ def run_module():
         display.vvv("Users:", users)
 
     # Get list of all groups in the system
-    groups = []
-    if module.params['groups']:
-        resp = mm.getrefs("Groups", provider)
-        if resp.get('warnings', None):
-            module.fail_json(msg="Collecting groups: %s" % resp.get('warnings'))
-        groups = resp['message']['result']['groups']
-        display.vvv("Groups:", groups)
+    resp = mm.getrefs("Groups", provider)
+    if resp.get('warnings', None):
+        module.fail_json(msg="Collecting groups: %s" % resp.get('warnings'))
+    groups = resp['message']['result']['groups']
+    display.vvv("Groups:", groups)
 
     # If roles are requested, get all roles
     roles = []
@@ -258,17 +277,25 @@ def run_module():
                                          "objType": "Roles",
                                          "name": role['name']})
         if group_exists:
-            # Group already present, just update.
-            http_method = "PUT"
-            url = "Groups/%s" % group_ref
-            databody = {"ref": group_ref,
-                        "saveComment": "Ansible API",
-                        "properties": [
-                            {"name": 'name', "value": module.params['name']},
-                            {"name": 'description', "value": module.params['desc']}
-                        ],
-                        }
-            result = mm.doapi(url, http_method, provider, databody)
+            # Group already present, update it when needed
+            change = False
+            if group_data['name'] != module.params['name']:
+                change = True
+            if group_data['description'] != module.params['desc']:
+                change = True
+
+            if change:
+                http_method = "PUT"
+                url = "Groups/%s" % group_ref
+                databody = {"ref": group_ref,
+                            "saveComment": "Ansible API",
+                            "properties": [
+                                {"name": 'name', "value": module.params['name']},
+                                {"name": 'description', "value": module.params['desc']}
+                            ],
+                            }
+                result = mm.doapi(url, http_method, provider, databody)
+            result['changed'] = change
 
             # Now figure out if users or roles need to be added or deleted
             # The ones in the playbook are in `wanted_(users|roles)`
@@ -317,17 +344,6 @@ def run_module():
                     url = "%s/%s" % (group_ref, thisuser['ref'])
                     result = mm.doapi(url, http_method, provider, databody)
                     result['changed'] = True
-
-            # Check idempotency
-            change = False
-            if group_data['name'] != module.params['name']:
-                change = True
-            if group_data['description'] != module.params['desc']:
-                change = True
-
-            if change:
-                result = mm.doapi(url, http_method, provider, databody)
-            result['changed'] = change
         else:
             # Group not present, create
             http_method = "POST"
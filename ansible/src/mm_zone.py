@@ -117,6 +117,23 @@ DOCUMENTATION = r'''
           required: True
           type: str
           no_log: True
+        validate_certs:
+          description: Validate the TLS certificate of the API server.
+          required: False
+          type: bool
+          default: False
+        ca_bundle:
+          description: File with the CA certificates to validate the API server with.
+          required: False
+          type: path
+        client_cert:
+          description: File with the client certificate to present to the API server.
+          required: False
+          type: path
+        client_key:
+          description: File with the private key of the client certificate.
+          required: False
+          type: path
 '''
 
 EXAMPLES = r'''
@@ -178,7 +195,11 @@ def run_module():
             type='dict', required=True,
             options=dict(mmurl=dict(type='str', required=True, no_log=False),
                          user=dict(type='str', required=True, no_log=False),
-                         password=dict(type='str', required=True, no_log=True)
+                         password=dict(type='str', required=True, no_log=True),
+                         validate_certs=dict(type='bool', required=False, default=False),
+                         ca_bundle=dict(type='path', required=False),
+                         client_cert=dict(type='path', required=False),
+                         client_key=dict(type='path', required=False, no_log=False)
                          )))
 
     # Seed the result dict in the object
@@ -253,15 +274,16 @@ def run_module():
     # otherwise it does and needs to be changed.
     if resp.get('totalResults', 1) != 0:
         # Zone exists. Update
+        zone = resp['dnsZones'][0]
 
         # Create the API call.
         #   `name`        is read-only, so not in the call
         #   `dynamicname` is read-only, so not in the call
         #   `authority`   is read-only, so not in the call
         http_method = "PUT"
-        url = "%s" % resp['dnsZone']['ref']
+        url = "%s" % zone['ref']
         databody = {
-            "ref": resp['dnsZone']['ref'],
+            "ref": zone['ref'],
             "saveComment": "Ansible API",
             "properties": [
                 {"name": "type", "value": module.params['servtype']}
@@ -291,10 +313,10 @@ def run_module():
 
             # Check if it is in the current values, either in the "normal" set or
             # the custom properties
-            cur = resp['dnsZone'].get(name, None)
+            cur = zone.get(name, None)
             if not cur:
                 # Not found yet, try custumprops
-                cur = resp['dnsZone']['customProperties'].get(name, None)
+                cur = zone['customProperties'].get(name, None)
 
             # Check if it is in the current values
             if val != cur:
@@ -0,0 +1,708 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""Benchmarks for the Micetro modules and plugins.
+
+Run as:
+
+    ./benchmark.py codec [--records 20000] [--repeat 5] [--output codec.json]
+    ./benchmark.py cassette FILE [--latency 1.0] [--output cassette.json]
+    ./benchmark.py faults [--profile lossy] [--updates 500] [--output faults.json]
+    ./benchmark.py filters [--records 100000] [--repeat 3] [--output filters.json]
+    ./benchmark.py constructed [--hosts 50000] [--output constructed.json]
+    ./benchmark.py inventory [--ranges 200] [--hosts 100000] [--output inventory.json]
+
+Every benchmark prints a table and can save the results as JSON, to
+compare them across commits.
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import faults
+import mmsim
+import mmtest
+
+
+def ipam_record(num, custprops):
+    """Create an IPAM record like GetIPAMRecords returns it."""
+    address = "172.%d.%d.%d" % (16 + num // 65536, (num // 256) % 256, num % 256)
+    hostname = "testhost%d.example.net." % num
+    return {
+        'addrRef': "IPAMRecords/%d" % (num + 1),
+        'address': address,
+        'claimed': False,
+        'dnsHosts': [{
+            'dnsRecord': {
+                'ref': "DNSRecords/%d" % (num + 1),
+                'name': hostname,
+                'type': 'A',
+                'ttl': '',
+                'data': address,
+                'comment': 'From The API side',
+                'aging': 0,
+                'enabled': True,
+                'dnsZoneRef': 'DNSZones/3',
+            },
+            'ptrStatus': 'OK',
+            'relatedRecords': [],
+        }],
+        'dhcpReservations': [],
+        'dhcpLeases': [],
+        'discoveryType': 'None',
+        'lastSeenDate': '',
+        'lastDiscoveryDate': '',
+        'lastKnownClientIdentifier': '',
+        'device': '',
+        'interface': '',
+        'ptrStatus': 'OK',
+        'extraneousPTR': False,
+        'customProperties': custprops[num % len(custprops)],
+        'state': 'Assigned',
+        'usage': 9,
+    }
+
+
+def codec_payloads(records):
+    """Create the payloads to decode.
+
+    The IPAM records carry the custom properties of the requests in the
+    `json` directory, the requests themselves are decoded as well.
+    """
+    custprops = [{'location': 'London', 'owner': 'Ton Kersten', 'place': 'Groesbeek'},
+                 {'location': 'home', 'owner': 'Beppie di Klaveri', 'place': 'At the attick'},
+                 {'location': 'Amsterdam', 'owner': 'johndoe', 'place': 'Groesbeek'}]
+    ipam = {'result': {'ipamRecords': [ipam_record(num, custprops) for num in range(records)],
+                       'totalResults': records}}
+    ranges = {'result': {'ranges': [{
+        'ref': "Ranges/%d" % num,
+        'name': "172.%d.%d.0/24" % (16 + num // 256, num % 256),
+        'from': "172.%d.%d.0" % (16 + num // 256, num % 256),
+        'to': "172.%d.%d.255" % (16 + num // 256, num % 256),
+        'parentRef': 'Ranges/1',
+        'childRanges': [],
+        'dhcpScopes': [],
+        'subnet': True,
+        'locked': False,
+        'autoAssign': False,
+        'hasSchedule': False,
+        'hasMonitor': False,
+        'customProperties': custprops[num % len(custprops)],
+        'inheritAccess': True,
+        'isContainer': False,
+        'utilizationPercentage': num % 100,
+        'hasRogueAddresses': False,
+        'cloudNetworkRef': '',
+        'cloudAllocationPools': [],
+        'discoveredProperties': [],
+        'created': '2020-06-12 10:00:00',
+        'lastModified': '2020-06-12 10:00:00',
+    } for num in range(300)], 'totalResults': 300}}
+
+    payloads = {
+        'GetIPAMRecords': json.dumps(ipam).encode('utf8'),
+        'Ranges': json.dumps(ranges).encode('utf8'),
+    }
+    jsondir = os.path.join(mmtest.TOPDIR, 'json')
+    requests = [json.load(open(fname)) for fname in sorted(glob.glob(os.path.join(jsondir, '*.json')))]
+    payloads['requests'] = json.dumps(requests).encode('utf8')
+    return payloads
+
+
+def best_of(repeat, func, *args):
+    """Run a function a number of times and return the fastest run."""
+    best = None
+    for dummy in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_codec(args):
+    """Measure the decode and encode throughput of the JSON codecs."""
+    client = mmtest.load_client()
+    payloads = codec_payloads(args.records)
+
+    results = []
+    for name in sorted(client.JSON_CODECS):
+        dumps, loads = client.JSON_CODECS[name]
+        for payload, data in sorted(payloads.items()):
+            decoded = loads(data)
+            decode = best_of(args.repeat, loads, data)
+            encode = best_of(args.repeat, dumps, decoded)
+            results.append({
+                'codec': name,
+                'payload': payload,
+                'bytes': len(data),
+                'decode_time': decode,
+                'decode_mb_s': len(data) / decode / 1e6,
+                'encode_time': encode,
+                'encode_mb_s': len(data) / encode / 1e6,
+            })
+
+    print("Default codec: %s" % client.JSON_CODEC)
+    print("%-8s %-16s %12s %12s %12s" % ('codec', 'payload', 'bytes', 'decode MB/s', 'encode MB/s'))
+    for res in results:
+        print("%(codec)-8s %(payload)-16s %(bytes)12d %(decode_mb_s)12.1f %(encode_mb_s)12.1f" % res)
+    return {'default_codec': client.JSON_CODEC, 'records': args.records, 'results': results}
+
+
+def endpoint(url):
+    """Return the endpoint of a URL, without references and parameters."""
+    url = url.split('?', 1)[0]
+    return re.sub(r'/\d+(?=/|$)', '/*', url)
+
+
+def bench_cassette(args):
+    """Summarize the API calls in a cassette and the time to replay them."""
+    calls = []
+    with open(args.cassette) as fhandle:
+        for line in fhandle:
+            if line.strip():
+                calls.append(json.loads(line))
+
+    endpoints = {}
+    for call in calls:
+        name = "%s %s" % (call['method'], endpoint(call['url']))
+        stats = endpoints.setdefault(name, {'endpoint': name, 'calls': 0, 'recorded': 0.0, 'bytes': 0})
+        stats['calls'] += 1
+        stats['recorded'] += call['elapsed']
+        stats['bytes'] += len(call['response'])
+
+    results = sorted(endpoints.values(), key=lambda stats: -stats['recorded'])
+    print("%-50s %8s %12s %12s" % ('endpoint', 'calls', 'bytes', 'recorded s'))
+    for stats in results:
+        print("%(endpoint)-50s %(calls)8d %(bytes)12d %(recorded)12.3f" % stats)
+    recorded = sum(call['elapsed'] for call in calls)
+    print("Total: %d calls, %.3fs recorded, %.3fs when replayed with latency %s" % (
+        len(calls), recorded, recorded * args.latency, args.latency))
+    return {'cassette': args.cassette, 'calls': len(calls), 'recorded': recorded,
+            'latency': args.latency, 'replayed': recorded * args.latency,
+            'results': results}
+
+
+def percentile(values, pct):
+    """Return a percentile of a list of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def run_workload(name, transport, operations):
+    """Run the operations of a workload and summarize them.
+
+    Every operation is a function that returns True when it succeeded.
+    Exceptions count as failures.
+    """
+    times = []
+    success = 0
+    start = time.perf_counter()
+    for operation in operations:
+        opstart = time.perf_counter()
+        try:
+            if operation():
+                success += 1
+        except Exception:
+            pass
+        times.append(time.perf_counter() - opstart)
+    total = time.perf_counter() - start
+    summary = transport.summary()
+    return {
+        'workload': name,
+        'operations': len(times),
+        'success_rate': 100.0 * success / len(times) if times else 0.0,
+        'p50': percentile(times, 50),
+        'p99': percentile(times, 99),
+        'total_time': total,
+        'calls': summary['calls'],
+        'faults': summary['faults'],
+    }
+
+
+def bench_faults(args):
+    """Measure success rate and latencies of workloads under faults."""
+    client = mmtest.load_client()
+    sim = mmsim.Micetro(mmtest.PROVIDER['user'], mmtest.PROVIDER['password'])
+    mmsim.generate(sim, ranges=args.ranges, ipam_records=args.ipam_records,
+                   dns_records=args.ipam_records // 2)
+    addresses = [address for dummy, address in sim.ipam_index]
+    workdir = tempfile.mkdtemp(prefix='faults')
+
+    def update(address, num):
+        databody = {'saveComment': 'Ansible API',
+                    'properties': {'location': mmsim.LOCATIONS[num % len(mmsim.LOCATIONS)]}}
+        result = client.doapi('IPAMRecords/%s' % address, 'PUT', mmtest.PROVIDER, databody)
+        return not result.get('warnings')
+
+    def inventory():
+        return mmtest.build_inventory(transport, workdir).hosts
+
+    results = []
+    try:
+        for profile in args.profile:
+            transport = faults.FaultyTransport(sim.transport, faults.PROFILES[profile],
+                                               seed=args.seed, scale=args.scale)
+            client.TRANSPORT = transport
+            operations = [lambda num=num: update(addresses[num % len(addresses)], num)
+                          for num in range(args.updates)]
+            res = run_workload('%d IPAMRecords updates' % args.updates, transport, operations)
+            res['profile'] = profile
+            results.append(res)
+
+            transport = faults.FaultyTransport(sim.transport, faults.PROFILES[profile],
+                                               seed=args.seed, scale=args.scale)
+            res = run_workload('inventory build', transport, [inventory])
+            res['profile'] = profile
+            results.append(res)
+    finally:
+        client.TRANSPORT = None
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%-8s %-26s %6s %9s %9s %9s %9s %7s  %s" % (
+        'profile', 'workload', 'ops', 'success%', 'p50 ms', 'p99 ms', 'total s', 'calls', 'faults'))
+    for res in results:
+        print("%-8s %-26s %6d %9.1f %9.1f %9.1f %9.2f %7d  %s" % (
+            res['profile'], res['workload'], res['operations'], res['success_rate'],
+            res['p50'] * 1000, res['p99'] * 1000, res['total_time'], res['calls'],
+            ", ".join("%s %d" % item for item in sorted(res['faults'].items())) or '-'))
+    return {'ranges': args.ranges, 'ipam_records': args.ipam_records, 'scale': args.scale,
+            'seed': args.seed, 'results': results}
+
+
+# Filter sets for the filters benchmark, the ones with only equalities
+# are also run with the filter loop of earlier versions
+FILTER_SETS = [
+    ('equal', [{'location': 'London'}]),
+    ('and', [{'location': 'London'}, {'owner': 'ton_kersten'}, {'environment': 'production'}]),
+    ('list', [{'location': ['London', 'Amsterdam', 'Groesbeek']}]),
+    ('regex', [{'owner': {'regex': '^(ton|john)'}}]),
+    ('or/not', [{'or': [{'location': 'London'}, {'environment': ['test', 'development']}]},
+                {'not': {'owner': {'regex': 'doe$'}}}]),
+]
+
+
+def legacy_filter(sanitize, filters, custprops):
+    """The filter loop of earlier versions, once per custom property."""
+    add_host = True
+    for custprop in custprops:
+        custval = sanitize(custprops[custprop])
+        custprop = sanitize(custprop)
+        for flt in filters:
+            add_host = flt.get(custprop, None) == custval
+    return add_host
+
+
+def bench_filters(args):
+    """Measure compiling and evaluating inventory filters."""
+    plugin = mmtest.load_plugin('mm_inventory')
+    rnd = random.Random(args.seed)
+    records = [{
+        'location': rnd.choice(mmsim.LOCATIONS),
+        'owner': rnd.choice(mmsim.OWNERS),
+        'environment': rnd.choice(mmsim.ENVIRONMENTS),
+    } for dummy in range(args.records)]
+
+    def compiled(filters):
+        predicate = plugin._compile_filter(filters)
+        return sum(1 for custprops in records if predicate(plugin._sanitize_names(custprops)))
+
+    def legacy(filters):
+        return sum(1 for custprops in records if legacy_filter(plugin._sanitize, filters, custprops))
+
+    results = []
+    for name, filters in FILTER_SETS:
+        engines = [('compiled', compiled)]
+        if all(isinstance(value, str) for flt in filters for value in flt.values()):
+            engines.append(('legacy', legacy))
+        for engine, func in engines:
+            elapsed = best_of(args.repeat, func, filters)
+            results.append({
+                'filter': name,
+                'engine': engine,
+                'records': args.records,
+                'matched': func(filters),
+                'compile_time': best_of(args.repeat, plugin._compile_filter, filters) if engine == 'compiled' else 0.0,
+                'time': elapsed,
+                'records_s': args.records / elapsed,
+            })
+
+    print("%-8s %-9s %9s %9s %12s %9s %12s" % ('filter', 'engine', 'records', 'matched', 'compile us', 'time s', 'records/s'))
+    for res in results:
+        print("%-8s %-9s %9d %9d %12.1f %9.3f %12.0f" % (
+            res['filter'], res['engine'], res['records'], res['matched'],
+            res['compile_time'] * 1e6, res['time'], res['records_s']))
+    return {'records': args.records, 'seed': args.seed, 'results': results}
+
+
+# The compose, groups and keyed_groups of the constructed benchmark
+CONSTRUCTED = {
+    'compose': {
+        'location': "mm_custom_properties.location | lower",
+        'octet': "ansible_host.split('.')[-1]",
+    },
+    'groups': {
+        'london': "location == 'london'",
+        'production': "mm_custom_properties.environment == 'production'",
+        'high': "octet | int > 200",
+    },
+    'keyed_groups': [
+        {'key': 'mm_custom_properties.owner', 'prefix': 'owner'},
+        {'key': 'location', 'prefix': 'loc'},
+    ],
+}
+
+
+def bench_constructed(args):
+    """Measure the constructed groups and variables of the inventory.
+
+    The expressions are evaluated with the plugin, which compiles every
+    expression once, and with the templating of Ansible, once per host.
+    Templating is slow, it only runs on the first --templated hosts.
+    """
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.plugins.inventory import Constructable
+    from ansible.plugins.loader import inventory_loader
+    from ansible.template import Templar
+
+    inventory_loader.add_directory(os.path.dirname(mmtest.PLUGINS['mm_inventory']))
+    plugin_class = type(inventory_loader.get('mm_inventory'))
+
+    class Templated(plugin_class):
+        """The plugin with the templating of Ansible, once per host."""
+        _compose = Constructable._compose
+        _add_host_to_composed_groups = Constructable._add_host_to_composed_groups
+
+    rnd = random.Random(args.seed)
+    invent = {'hosts': [], 'addresses': [], 'groups': {}, 'properties': []}
+    for num in range(args.hosts):
+        invent['hosts'].append("host%d.example.net" % num)
+        invent['addresses'].append("10.%d.%d.%d" % (num // 65536, (num // 256) % 256, num % 256))
+        invent['properties'].append({
+            'location': rnd.choice(mmsim.LOCATIONS),
+            'owner': rnd.choice(mmsim.OWNERS),
+            'environment': rnd.choice(mmsim.ENVIRONMENTS),
+        })
+
+    sample = min(args.templated, args.hosts)
+    results = []
+    memberships = {}
+    for engine, cls, count in (('compiled', plugin_class, args.hosts), ('templated', Templated, sample)):
+        hosts = dict((key, values[:count]) for key, values in invent.items() if key != 'groups')
+        hosts['groups'] = {}
+        plugin = inventory_loader.get('mm_inventory')
+        plugin.__class__ = cls
+        plugin.set_options(direct={'plugin': 'mm_inventory'})
+        plugin.templar = Templar(loader=DataLoader())
+        plugin.inventory = InventoryData()
+        for name in hosts['hosts']:
+            plugin.inventory.add_host(name)
+
+        start = time.time()
+        plugin._construct(hosts, CONSTRUCTED['compose'], CONSTRUCTED['groups'], CONSTRUCTED['keyed_groups'], True)
+        elapsed = time.time() - start
+
+        groups = dict((name, set(host.name for host in group.hosts))
+                      for name, group in plugin.inventory.groups.items() if name not in ('all', 'ungrouped'))
+        memberships[engine] = groups
+        results.append({
+            'engine': engine,
+            'hosts': count,
+            'groups': len(groups),
+            'members': sum(len(members) for members in groups.values()),
+            'time': elapsed,
+            'hosts_s': count / elapsed,
+        })
+
+    # Both engines put the sample in the same groups
+    names = set(invent['hosts'][:sample])
+    compiled = dict((name, members & names) for name, members in memberships['compiled'].items())
+    same = dict((name, members) for name, members in compiled.items() if members) == memberships['templated']
+    print("%-10s %9s %7s %9s %9s %10s" % ('engine', 'hosts', 'groups', 'members', 'time s', 'hosts/s'))
+    for res in results:
+        print("%-10s %9d %7d %9d %9.3f %10.0f" % (
+            res['engine'], res['hosts'], res['groups'], res['members'], res['time'], res['hosts_s']))
+    print("Same groups: %s" % ('yes' if same else 'NO'))
+    return {'hosts': args.hosts, 'seed': args.seed, 'same_groups': same, 'results': results}
+
+
+class Timers(object):
+    """Time the calls to methods of classes, summed per name."""
+
+    def __init__(self):
+        self.times = {}
+        self.patched = []
+
+    def wrap(self, cls, method, name):
+        """Add the time of every call of a method to the time of name."""
+        original = getattr(cls, method)
+        self.times.setdefault(name, 0.0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.times[name] += time.perf_counter() - start
+        setattr(cls, method, timed)
+        self.patched.append((cls, method, original))
+
+    def reset(self):
+        for name in self.times:
+            self.times[name] = 0.0
+
+    def restore(self):
+        for cls, method, original in reversed(self.patched):
+            setattr(cls, method, original)
+        self.patched = []
+
+
+def bench_inventory(args):
+    """Measure inventory builds with the inventory plugin.
+
+    The plugin runs against the simulator with a synthetic estate,
+    without a cache, filling the cache and from the cache, and the same
+    with the columnar cache file. Every build runs twice: once for the
+    times and once with tracemalloc for the peak memory, which is a lot
+    slower. With --no-memory the second run is skipped.
+    """
+    from ansible.inventory.data import InventoryData
+    from ansible.plugins.loader import inventory_loader
+
+    sim = mmsim.Micetro(mmtest.PROVIDER['user'], mmtest.PROVIDER['password'])
+    start = time.perf_counter()
+    mmsim.generate(sim, ranges=args.ranges, ipam_records=args.hosts, dns_records=args.hosts,
+                   custom_props=args.custom_properties, seed=args.seed)
+    print("Estate of %d ranges and %d hosts generated in %.1fs" % (args.ranges, args.hosts, time.perf_counter() - start))
+
+    workdir = tempfile.mkdtemp(prefix='inventory')
+    cachedir = os.path.join(workdir, 'cache')
+    options = {'max_workers': args.max_workers}
+    if args.filter:
+        options['filters'] = dict(FILTER_SETS)[args.filter]
+    cached = dict(options, cache=True, cache_plugin='jsonfile', cache_connection=cachedir)
+    columnar = dict(cached, cache_columnar=True)
+    scenarios = [('no cache', options, True), ('cache fill', cached, True), ('cached', cached, False),
+                 ('columnar fill', columnar, True), ('columnar', columnar, False)]
+
+    inventory_loader.add_directory(os.path.dirname(mmtest.PLUGINS['mm_inventory']))
+    plugin_class = type(inventory_loader.get('mm_inventory'))
+    plugin_module = sys.modules[plugin_class.__module__]
+    timers = Timers()
+    timers.wrap(plugin_class, '_read_manifest', 'cache_read')
+    timers.wrap(plugin_class, '_read_shard', 'cache_read')
+    timers.wrap(plugin_module._Columnar, '__init__', 'cache_read')
+    timers.wrap(plugin_module._Columnar, '__getitem__', 'cache_read')
+    timers.wrap(plugin_class, '_write_shard', 'cache_write')
+    timers.wrap(plugin_module, '_write_columnar', 'cache_write')
+    timers.wrap(plugin_class, 'update_cache_if_changed', 'cache_write')
+    timers.wrap(InventoryData, 'add_host', 'add_host')
+    timers.wrap(InventoryData, 'set_variable', 'add_host')
+    timers.wrap(InventoryData, 'add_group', 'add_group')
+    timers.wrap(InventoryData, 'add_child', 'add_group')
+
+    results = []
+    try:
+        for name, scenario, empty in scenarios:
+            if empty:
+                shutil.rmtree(cachedir, ignore_errors=True)
+            timers.reset()
+            calls = len(sim.calls)
+            start = time.perf_counter()
+            inventory = mmtest.build_inventory(sim.transport, workdir, **scenario)
+            elapsed = time.perf_counter() - start
+            res = dict(timers.times)
+            res.update({
+                'scenario': name,
+                'hosts': len(inventory.hosts),
+                'groups': len(inventory.groups),
+                'calls': len(sim.calls) - calls,
+                'time': elapsed,
+            })
+            del inventory
+
+            res['peak_memory'] = 0
+            if args.memory:
+                if empty:
+                    shutil.rmtree(cachedir, ignore_errors=True)
+                tracemalloc.start()
+                mmtest.build_inventory(sim.transport, workdir, **scenario)
+                res['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results.append(res)
+    finally:
+        timers.restore()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%-13s %7s %7s %6s %9s %9s %9s %9s %9s %9s" % (
+        'scenario', 'hosts', 'groups', 'calls', 'time s', 'read s', 'write s', 'hosts s', 'groups s', 'peak MB'))
+    for res in results:
+        print("%-13s %7d %7d %6d %9.3f %9.3f %9.3f %9.3f %9.3f %9.1f" % (
+            res['scenario'], res['hosts'], res['groups'], res['calls'], res['time'], res['cache_read'],
+            res['cache_write'], res['add_host'], res['add_group'], res['peak_memory'] / 1e6))
+    return {'ranges': args.ranges, 'hosts': args.hosts, 'custom_properties': args.custom_properties,
+            'filter': args.filter, 'max_workers': args.max_workers, 'seed': args.seed, 'results': results}
+
+
+def bench_freeip(args):
+    """Measure getting free addresses with mm_freeip, one by one and in bulk.
+
+    Every mode gets --count addresses in the same range of a new
+    simulator, with the latency of a fault profile on every call. The
+    one by one and bulk claim modes claim the addresses temporarily, the
+    permanent modes claim them permanently. The ping modes have Micetro
+    check every address, the others find them all with a scan.
+    """
+    plugin = mmtest.load_plugin('mm_freeip')
+    modes = [
+        ('one by one', {'claim': 60}),
+        ('bulk claim', {'claim': 60, 'bulk': True, 'max_workers': args.max_workers}),
+        ('bulk', {'bulk': True, 'max_workers': args.max_workers}),
+        ('bulk permanent', {'bulk': True, 'permanent_claim': True, 'max_workers': args.max_workers}),
+        ('perm. ping', {'bulk': True, 'ping': True, 'permanent_claim': True,
+                        'max_workers': args.max_workers}),
+    ]
+    results = []
+    try:
+        for profile in args.profile or ['lan', 'wan']:
+            for mode, options in modes:
+                sim = mmsim.Micetro(mmtest.PROVIDER['user'], mmtest.PROVIDER['password'])
+                mmsim.generate(sim, ranges=args.ranges, ipam_records=args.ipam_records,
+                               dns_records=args.ipam_records // 2, seed=args.seed)
+                transport = faults.FaultyTransport(sim.transport, faults.PROFILES[profile],
+                                                   seed=args.seed, scale=args.scale)
+                plugin.TRANSPORT = transport
+                start = time.perf_counter()
+                addresses = plugin.LookupModule().run([mmtest.PROVIDER, args.network], multi=args.count, **options)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'profile': profile,
+                    'mode': mode,
+                    'addresses': len(set(addresses)),
+                    'calls': len(transport.calls),
+                    'writes': sum(1 for call in transport.calls if call['method'] != 'GET'),
+                    'time': elapsed,
+                })
+    finally:
+        plugin.TRANSPORT = None
+
+    print("%-8s %-15s %9s %6s %7s %9s" % ('profile', 'mode', 'addresses', 'calls', 'writes', 'time s'))
+    for res in results:
+        print("%-8s %-15s %9d %6d %7d %9.3f" % (
+            res['profile'], res['mode'], res['addresses'], res['calls'], res['writes'], res['time']))
+    return {'network': args.network, 'count': args.count, 'max_workers': args.max_workers,
+            'scale': args.scale, 'seed': args.seed, 'results': results}
+
+
+def main():
+    """Start here."""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output', help='Save the results as JSON in this file')
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    codec = commands.add_parser('codec', parents=[common],
+                                help='JSON encode and decode throughput')
+    codec.add_argument('--records', type=int, default=20000,
+                       help='Number of IPAM records in the GetIPAMRecords payload')
+    codec.add_argument('--repeat', type=int, default=5)
+    codec.set_defaults(func=bench_codec)
+
+    cassette = commands.add_parser('cassette', parents=[common],
+                                   help='API calls and recorded time of a cassette')
+    cassette.add_argument('cassette', help='Cassette recorded with MM_CASSETTE')
+    cassette.add_argument('--latency', type=float, default=1.0,
+                          help='Latency factor for the replay')
+    cassette.set_defaults(func=bench_cassette)
+
+    fault = commands.add_parser('faults', parents=[common],
+                                help='Success rate and latencies under injected faults')
+    fault.add_argument('--profile', action='append', choices=sorted(faults.PROFILES),
+                       help='Fault profile, can be given more than once (default: all)')
+    fault.add_argument('--updates', type=int, default=500,
+                       help='Number of IPAMRecords updates')
+    fault.add_argument('--ranges', type=int, default=20)
+    fault.add_argument('--ipam-records', type=int, default=2000)
+    fault.add_argument('--scale', type=float, default=1.0,
+                       help='Factor for all injected delays')
+    fault.add_argument('--seed', type=int, default=1)
+    fault.set_defaults(func=bench_faults)
+
+    filt = commands.add_parser('filters', parents=[common],
+                               help='Compile and evaluate inventory filters')
+    filt.add_argument('--records', type=int, default=100000,
+                      help='Number of hosts to evaluate the filters on')
+    filt.add_argument('--repeat', type=int, default=3)
+    filt.add_argument('--seed', type=int, default=1)
+    filt.set_defaults(func=bench_filters)
+
+    constructed = commands.add_parser('constructed', parents=[common],
+                                      help='Constructed groups and variables of the inventory')
+    constructed.add_argument('--hosts', type=int, default=50000,
+                             help='Number of hosts in the inventory')
+    constructed.add_argument('--templated', type=int, default=2000,
+                             help='Number of hosts to evaluate with the templating of Ansible')
+    constructed.add_argument('--seed', type=int, default=1)
+    constructed.set_defaults(func=bench_constructed)
+
+    inventory = commands.add_parser('inventory', parents=[common],
+                                    help='Inventory builds against a synthetic estate')
+    inventory.add_argument('--ranges', type=int, default=200)
+    inventory.add_argument('--hosts', type=int, default=100000,
+                           help='Number of hosts, IPAM records with an A record')
+    inventory.add_argument('--custom-properties', type=int, default=3,
+                           help='Number of custom properties of every host')
+    inventory.add_argument('--filter', choices=[name for name, dummy in FILTER_SETS],
+                           help='The filters of the filters benchmark to use')
+    inventory.add_argument('--max-workers', type=int, default=4)
+    inventory.add_argument('--no-memory', dest='memory', action='store_false',
+                           help='Do not measure the peak memory, which is slow')
+    inventory.add_argument('--seed', type=int, default=1)
+    inventory.set_defaults(func=bench_inventory)
+
+    freeip = commands.add_parser('freeip', parents=[common],
+                                 help='Free addresses with mm_freeip, one by one and in bulk')
+    freeip.add_argument('--profile', action='append', choices=sorted(faults.PROFILES),
+                        help='Fault profile, can be given more than once (default: lan and wan)')
+    freeip.add_argument('--count', type=int, default=48,
+                        help='Number of free addresses to get')
+    freeip.add_argument('--network', default='10.1.0.0/25')
+    freeip.add_argument('--ranges', type=int, default=40)
+    freeip.add_argument('--ipam-records', type=int, default=2000)
+    freeip.add_argument('--max-workers', type=int, default=8)
+    freeip.add_argument('--scale', type=float, default=1.0,
+                        help='Factor for all injected delays')
+    freeip.add_argument('--seed', type=int, default=1)
+    freeip.set_defaults(func=bench_freeip)
+
+    args = parser.parse_args()
+    if args.command == 'faults' and not args.profile:
+        args.profile = sorted(faults.PROFILES)
+    results = args.func(args)
+    results['benchmark'] = args.command
+    results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if args.output:
+        with open(args.output, 'w') as fhandle:
+            json.dump(results, fhandle, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""API call-count regression suite for the Micetro modules and plugins.
+
+Every module, lookup plugin and the inventory plugin is run against the
+simulator in `mmsim.py` through create, update, no-op and delete
+scenarios. The number of GETs and writes (POST, PUT, PATCH and DELETE)
+of every scenario is checked against an upper bound, and the `changed`
+result against the expected one. Some scenarios also have to make fewer
+calls than an earlier one, see FEWER_CALLS, or must not make a call,
+see NO_CALLS.
+
+Run as:
+
+    ./callcount.py [--verbose] [--output callcount.json]
+
+The suite prints a call table and exits with 1 when a scenario goes over
+its bounds or fails. When a change lowers the number of calls, lower the
+bounds in SCENARIOS as well, so it stays that way.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ansible import context
+from ansible.module_utils.common.collections import ImmutableDict
+
+import mmsim
+import mmtest
+
+PROVIDER = mmtest.PROVIDER
+
+# The scenarios, in the order they are run against one simulator, as
+# (target, scenario, arguments, max GETs, max writes, changed).
+# The target is a module name, `lookup/<name>` or `inventory`. Most
+# scenarios depend on the ones before them. A scenario with `fails` in
+# its arguments has to fail with that message.
+SCENARIOS = [
+    # IPAM
+    ('mm_claimip', 'create', {'ipaddress': ['10.0.0.200'], 'state': 'present'}, 1, 1, True),
+    ('mm_claimip', 'no-op', {'ipaddress': ['10.0.0.200'], 'state': 'present'}, 1, 0, False),
+    ('mm_claimip', 'update', {'ipaddress': ['10.0.0.200'], 'state': 'absent'}, 1, 1, True),
+    ('mm_claimip', 'no-op delete', {'ipaddress': ['10.0.0.200'], 'state': 'absent'}, 1, 0, False),
+    ('mm_ipprops', 'create', {'ipaddress': ['10.0.0.201'], 'properties': {'location': 'London'}}, 1, 1, True),
+    ('mm_ipprops', 'no-op', {'ipaddress': ['10.0.0.201'], 'properties': {'location': 'London'}}, 1, 0, False),
+    ('mm_ipprops', 'update', {'ipaddress': ['10.0.0.201'], 'properties': {'location': 'Paris'}}, 1, 1, True),
+    ('mm_props', 'create', {'name': 'rack', 'dest': 'ipaddress'}, 1, 1, True),
+    ('mm_props', 'no-op', {'name': 'rack', 'dest': 'ipaddress'}, 1, 0, False),
+    ('mm_props', 'update', {'name': 'rack', 'dest': 'ipaddress', 'mandatory': True}, 1, 1, True),
+    ('mm_props', 'delete', {'name': 'rack', 'dest': 'ipaddress', 'state': 'absent'}, 1, 1, True),
+    ('mm_props', 'no-op delete', {'name': 'rack', 'dest': 'ipaddress', 'state': 'absent'}, 1, 0, False),
+
+    # DNS
+    ('mm_zone', 'create', {'name': 'callcount.example.net', 'nameserver': 'micetro.example.net.',
+                           'authority': 'micetro.example.net.'}, 2, 1, True),
+    ('mm_zone', 'no-op', {'name': 'callcount.example.net', 'nameserver': 'micetro.example.net.',
+                          'authority': 'micetro.example.net.'}, 2, 0, False),
+    ('mm_zone', 'update', {'name': 'callcount.example.net', 'nameserver': 'micetro.example.net.',
+                           'authority': 'micetro.example.net.',
+                           'customproperties': {'owner': 'johndoe'}}, 2, 1, True),
+    # A DNS record is looked up again by its short name when it is not found
+    ('mm_dnsrecord', 'create', {'name': 'www', 'dnszone': 'callcount.example.net', 'data': '10.0.0.202'}, 3, 1, True),
+    ('mm_dnsrecord', 'no-op', {'name': 'www', 'dnszone': 'callcount.example.net', 'data': '10.0.0.202'}, 2, 0, False),
+    ('mm_dnsrecord', 'delete', {'name': 'www', 'dnszone': 'callcount.example.net', 'data': '10.0.0.202',
+                                'state': 'absent'}, 2, 1, True),
+    ('mm_dnsrecord', 'no-op delete', {'name': 'www', 'dnszone': 'callcount.example.net', 'data': '10.0.0.202',
+                                      'state': 'absent'}, 3, 0, False),
+    ('mm_zone', 'delete', {'name': 'callcount.example.net', 'nameserver': 'micetro.example.net.',
+                           'state': 'absent'}, 2, 1, True),
+    ('mm_zone', 'no-op delete', {'name': 'callcount.example.net', 'nameserver': 'micetro.example.net.',
+                                 'state': 'absent'}, 2, 0, False),
+
+    # DHCP
+    ('mm_dhcp', 'create', {'name': 'printer', 'ipaddress': ['10.0.0.120'],
+                           'macaddress': 'de:ad:be:ef:16:10'}, 2, 1, True),
+    ('mm_dhcp', 'no-op', {'name': 'printer', 'ipaddress': ['10.0.0.120'],
+                          'macaddress': 'de:ad:be:ef:16:10'}, 2, 0, False),
+    ('mm_dhcp', 'update', {'name': 'printer', 'ipaddress': ['10.0.0.120'],
+                           'macaddress': 'de:ad:be:ef:16:10', 'ddnshost': 'printer'}, 2, 1, True),
+    ('mm_dhcp', 'delete', {'name': 'printer', 'ipaddress': ['10.0.0.120'],
+                           'macaddress': 'de:ad:be:ef:16:10', 'state': 'absent'}, 2, 1, True),
+    ('mm_dhcp', 'no-op delete', {'name': 'printer', 'ipaddress': ['10.0.0.120'],
+                                 'macaddress': 'de:ad:be:ef:16:10', 'state': 'absent'}, 2, 0, False),
+
+    # Users, groups and roles
+    ('mm_role', 'create', {'name': 'callrole', 'desc': 'A role'}, 1, 1, True),
+    ('mm_role', 'no-op', {'name': 'callrole', 'desc': 'A role'}, 1, 0, False),
+    ('mm_role', 'update', {'name': 'callrole', 'desc': 'Another role'}, 1, 1, True),
+    ('mm_group', 'create', {'name': 'callgroup', 'desc': 'A group', 'roles': ['callrole']}, 2, 2, True),
+    ('mm_group', 'no-op', {'name': 'callgroup', 'desc': 'A group', 'roles': ['callrole']}, 2, 0, False),
+    ('mm_group', 'update', {'name': 'callgroup', 'desc': 'Another group', 'roles': ['callrole']}, 2, 1, True),
+    ('mm_user', 'create', {'username': 'calluser', 'password': 'secret', 'full_name': 'Call User',
+                           'authentication_type': 'Internal', 'groups': ['callgroup'],
+                           'roles': ['callrole']}, 3, 3, True),
+    # The password of a user cannot be compared, so a user is always
+    # updated and reported as unchanged
+    ('mm_user', 'no-op', {'username': 'calluser', 'password': 'secret', 'full_name': 'Call User',
+                          'authentication_type': 'Internal', 'groups': ['callgroup'],
+                          'roles': ['callrole']}, 3, 1, False),
+    ('mm_user', 'update', {'username': 'calluser', 'password': 'secret', 'full_name': 'Call M. User',
+                           'authentication_type': 'Internal', 'groups': ['callgroup'],
+                           'roles': ['callrole']}, 3, 1, False),
+    ('mm_user', 'delete', {'username': 'calluser', 'state': 'absent'}, 1, 1, True),
+    ('mm_user', 'no-op delete', {'username': 'calluser', 'state': 'absent'}, 1, 0, False),
+    ('mm_group', 'delete', {'name': 'callgroup', 'state': 'absent'}, 1, 1, True),
+    ('mm_group', 'no-op delete', {'name': 'callgroup', 'state': 'absent'}, 1, 0, False),
+    ('mm_role', 'delete', {'name': 'callrole', 'state': 'absent'}, 1, 1, True),
+    ('mm_role', 'no-op delete', {'name': 'callrole', 'state': 'absent'}, 1, 0, False),
+
+    # Plugins
+    ('lookup/mm_ipinfo', 'read', {'terms': ['10.0.0.1']}, 1, 0, None),
+    ('lookup/mm_ipinfo', 'redirect', {'terms': ['10.0.0.1'], 'redirect': '127.0.0.1'}, 1, 0, None),
+    ('lookup/mm_ipinfo', 'redirect away', {'terms': ['10.0.0.1'], 'redirect': 'localhost',
+                                           'fails': 'set mmurl to the URL'}, 1, 0, None),
+    ('lookup/mm_freeip', 'read', {'terms': ['10.1.0.0/25']}, 2, 0, None),
+    ('lookup/mm_freeip', 'read multi', {'terms': ['10.1.0.0/25'], 'multi': 5, 'claim': 60}, 6, 0, None),
+    ('lookup/mm_freeip', 'bulk', {'terms': ['10.1.0.0/25'], 'multi': 5, 'bulk': True}, 2, 0, None),
+    # The scan does not see the 5 addresses 'read multi' holds: Micetro
+    # refuses them all, and 4 more are scanned and asked for
+    ('lookup/mm_freeip', 'bulk ping', {'terms': ['10.1.0.0/25'], 'multi': 5, 'bulk': True, 'ping': True},
+     12, 0, None),
+    ('lookup/mm_freeip', 'bulk claim', {'terms': ['10.1.0.0/25'], 'multi': 5, 'claim': 60, 'bulk': True}, 6, 0, None),
+    ('lookup/mm_freeip', 'bulk permanent', {'terms': ['10.1.0.0/25'], 'multi': 5, 'bulk': True,
+                                            'permanent_claim': True}, 2, 5, None),
+    ('lookup/mm_freeip', 'bulk perm. ping', {'terms': ['10.1.0.0/25'], 'multi': 5, 'bulk': True, 'ping': True,
+                                             'permanent_claim': True}, 6, 5, None),
+    ('inventory', 'build', {'ranges': ['10.1.0.0/25', '10.2.0.128/25']}, 3, 0, None),
+    ('inventory', 'build supernet', {'ranges': ['10.1.0.0/16']}, 2, 0, None),
+    ('inventory', 'build all', {}, 2, 0, None),
+    ('inventory', 'build paged', {'ranges': ['10.1.0.0/25'], 'page_size': 40}, 3, 0, None),
+    ('inventory', 'federation', {'providers': [{'name': 'east', 'ranges': ['10.1.0.0/25']},
+                                               {'name': 'west', 'ranges': ['10.2.0.0/25'], 'prefix': 'west-'}]},
+     3, 0, None),
+    ('inventory', 'shared', {'ranges': ['10.1.0.0/16'],
+                             'also': {'ranges': ['10.1.0.0/25'], 'filters': [{'owner': {'regex': '^ton'}}]}},
+     2, 0, None),
+    ('inventory', 'cache fill', {'cache': True, 'cache_incremental': True}, 3, 0, None),
+    ('inventory', 'cached', {'cache': True, 'cache_incremental': True}, 0, 0, None),
+    ('inventory', 'incremental', {'cache': True, 'cache_incremental': True, 'cache_timeout': 1, 'wait': 1.1}, 1, 0, None),
+    ('inventory', 'incr. change', {'cache': True, 'cache_incremental': True, 'cache_timeout': 1, 'wait': 1.1,
+                                   'change': '10.1.0.5'}, 4, 0, None),
+    ('inventory', 'incr. dns move', {'cache': True, 'cache_incremental': True, 'cache_timeout': 1, 'wait': 1.1,
+                                     'dns': 'move', 'verify': True}, 5, 0, None),
+    ('inventory', 'incr. dns del', {'cache': True, 'cache_incremental': True, 'cache_timeout': 1, 'wait': 1.1,
+                                    'dns': 'delete', 'verify': True}, 4, 0, None),
+    ('inventory', 'full refresh', {'cache': True, 'cache_timeout': 1, 'wait': 1.1}, 2, 0, None),
+    ('inventory', 'stale', {'cache': True, 'cache_stale_while_revalidate': True, 'cache_timeout': 1,
+                            'wait': 1.1, 'dns': 'move', 'revalidate': True}, 0, 0, None),
+    ('inventory', 'revalidated', {'cache': True, 'cache_stale_while_revalidate': True, 'verify': True}, 0, 0, None),
+    ('inventory', 'limit index', {'cache': True, 'limit_aware': True}, 0, 0, None),
+    ('inventory', 'limit', {'cache': True, 'limit_aware': True, 'limit': 'range_10_2_0_0_25',
+                            'cache_timeout': 1, 'wait': 1.1, 'cache_incremental': False}, 2, 0, None),
+    # The lowest timeout of the cache_ttls entries of a range is used, in
+    # any order, so the moved A record is fetched again
+    ('inventory', 'ttls overlap', {'cache': True, 'limit_aware': True, 'cache_timeout': 1, 'wait': 1.1,
+                                   'cache_ttls': {'10.0.0.0/8': 1, '10.1.0.0/16': 3600},
+                                   'dns': 'move', 'verify': True}, 2, 0, None),
+    ('inventory', 'ttls reversed', {'cache': True, 'limit_aware': True, 'cache_timeout': 1, 'wait': 1.1,
+                                    'cache_ttls': {'10.1.0.0/16': 3600, '10.0.0.0/8': 1},
+                                    'dns': 'move', 'verify': True}, 2, 0, None),
+    ('inventory', 'snapshot', {'cache': True, 'snapshot': True}, 0, 0, None),
+]
+
+# Scenarios that have to make fewer API calls than an earlier scenario
+# of the same target, as (target, scenario) -> earlier scenario
+FEWER_CALLS = {
+    ('lookup/mm_freeip', 'bulk'): 'read multi',
+}
+
+# Calls a scenario must not make, as (target, scenario) -> API path
+NO_CALLS = {
+    ('inventory', 'full refresh'): 'command/GetHistory',
+}
+
+WRITES = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class Counter(object):
+    """A transport that counts the calls to the simulator."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.transport = sim.transport
+        self.calls = []
+
+    def __call__(self, method, apiurl, provider, body, headers):
+        self.calls.append((method, apiurl.split('/mmws/api/', 1)[-1]))
+        return self.transport(method, apiurl, provider, body, headers)
+
+
+def run_module(name, args, transport):
+    """Run a module like Ansible does and return its result."""
+    from ansible.module_utils import basic
+    from ansible.module_utils.common import warnings
+
+    # The warnings of a module are global, forget the ones of the last run
+    del warnings._global_warnings[:]
+    del warnings._global_deprecations[:]
+    module = mmtest.load_module(name)
+    module.TRANSPORT = transport
+    args = dict(args, provider=PROVIDER)
+    basic._ANSIBLE_ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': args}).encode('utf8')
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            module.run_module()
+        except SystemExit:
+            pass
+    return json.loads(output.getvalue())
+
+
+@contextlib.contextmanager
+def redirected(sim, host):
+    """Serve the simulator over HTTP, behind a server that redirects to it.
+
+    Yields the URL of the redirecting server, which redirects to the
+    simulator as `host`.
+    """
+    servers = [mmsim.serve(sim, port=0)]
+    servers.append(mmsim.serve(sim, port=0, redirect='http://%s:%d' % (host, servers[0].server_address[1])))
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % servers[1].server_address[1]
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def run_lookup(name, args, transport):
+    """Run a lookup plugin and return its result.
+
+    With `redirect` the plugin calls the simulator over HTTP, through a
+    server that redirects to it as that host. The calls are counted
+    before the redirects.
+    """
+    plugin = mmtest.load_plugin(name)
+    plugin.TRANSPORT = transport
+    args = dict(args)
+    terms = [PROVIDER] + args.pop('terms')
+    redirect = args.pop('redirect', None)
+    if not redirect:
+        return {'result': plugin.LookupModule().run(terms, **args)}
+    counted = transport.transport
+    with redirected(transport.sim, redirect) as mmurl:
+        transport.transport = plugin._http_transport
+        terms[0] = dict(PROVIDER, mmurl=mmurl)
+        try:
+            return {'result': plugin.LookupModule().run(terms, **args)}
+        finally:
+            transport.transport = counted
+
+
+def run_inventory(args, transport, workdir):
+    """Build an inventory and return the number of hosts.
+
+    With `wait` the cache gets older first, with `change` an address gets
+    another location in the simulator first, with `dns` an A record is
+    moved to a free address or deleted first, without counting the calls.
+    With `verify` the hosts are checked against an inventory built
+    without the cache. With `revalidate` the build waits for the refresh
+    of a stale cache in the background.
+    With `snapshot` a snapshot is made from the cache and the inventory
+    is built from the snapshot, without the cache. With `also` the
+    options of a second source are loaded in the same inventory.
+    """
+    options = {}
+    if args.get('cache'):
+        options.update({'cache': True, 'cache_plugin': 'jsonfile',
+                        'cache_connection': os.path.join(workdir, 'cache')})
+    for option in ('ranges', 'cache_timeout', 'cache_ttls', 'cache_incremental', 'cache_stale_while_revalidate',
+                   'limit_aware', 'page_size', 'providers'):
+        if option in args:
+            options[option] = args[option]
+    if args.get('wait'):
+        time.sleep(args['wait'])
+    if args.get('change'):
+        transport.sim.handle('PUT', 'IPAMRecords/%s' % args['change'],
+                             {'properties': {'location': 'Tokyo'}})
+    if args.get('dns'):
+        change_dns_record(transport.sim, args['dns'])
+    # The limit of a run is in the CLI arguments of Ansible
+    cliargs = context.CLIARGS
+    if args.get('limit'):
+        context.CLIARGS = ImmutableDict(cliargs, subset=args['limit'])
+    try:
+        if args.get('snapshot'):
+            from ansible.plugins.loader import inventory_loader
+            snapshot = os.path.join(workdir, 'snapshot.json')
+            mmtest.build_inventory(transport, workdir, **options)
+            plugin = inventory_loader.get('mm_inventory')
+            sys.modules[type(plugin).__module__].export_snapshot(os.path.join(workdir, 'mm_inventory.yml'), snapshot)
+            options = {'snapshot': snapshot}
+        inventory = mmtest.build_inventory(transport, workdir, **options)
+        if args.get('also'):
+            inventory = mmtest.build_inventory(transport, workdir, inventory=inventory, **args['also'])
+        if args.get('revalidate'):
+            wait_for_refresh(os.path.join(workdir, 'cache'), time.time())
+    finally:
+        context.CLIARGS = cliargs
+    if args.get('verify'):
+        expected = mmtest.build_inventory(transport.transport, workdir)
+        if hosts(inventory) != hosts(expected):
+            raise AssertionError("the hosts differ from an inventory without the cache: %s" % sorted(
+                set(hosts(inventory).items()) ^ set(hosts(expected).items()))[:4])
+    return {'hosts': len(inventory.hosts)}
+
+
+def wait_for_refresh(cachedir, since, timeout=30):
+    """Wait until a background refresh has written the new shards.
+
+    The refresh writes the manifest of the shards last and holds its
+    lock until it is done.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(os.path.getmtime(path) > since for path in glob.glob(os.path.join(cachedir, '*_manifest'))):
+            for path in glob.glob(os.path.join(cachedir, '*.lock')):
+                with open(path) as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+            return
+        time.sleep(0.05)
+    raise AssertionError("the cache was not refreshed in the background in %ds" % timeout)
+
+
+def hosts(inventory):
+    """Return the hosts of an inventory with their addresses."""
+    return dict((name, host.vars.get('ansible_host')) for name, host in inventory.hosts.items())
+
+
+def change_dns_record(sim, change):
+    """Move the first A record in 10.1.0.0/25 to a free address, or delete it."""
+    used = [ref for ref in sorted(sim.objects['dnsrecords'])
+            if sim.objects['dnsrecords'][ref].get('type') == 'A' and
+            sim.objects['dnsrecords'][ref]['data'].startswith('10.1.0.')]
+    ref = used[0]
+    if change == 'delete':
+        sim.handle('DELETE', ref)
+        return
+    free = next('10.1.0.%d' % num for num in range(1, 127) if '10.1.0.%d' % num not in sim.dns_by_address)
+    sim.handle('PUT', ref, {'properties': {'data': free}})
+
+
+def run_scenario(target, args, transport, workdir):
+    """Run a scenario on a module or plugin."""
+    if target == 'inventory':
+        return run_inventory(args, transport, workdir)
+    if target.startswith('lookup/'):
+        return run_lookup(target.split('/', 1)[1], args, transport)
+    return run_module(target, args, transport)
+
+
+def main():
+    """Start here."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--verbose', action='store_true', help='Show the calls of every scenario')
+    parser.add_argument('--output', help='Save the results as JSON in this file')
+    args = parser.parse_args()
+
+    sim = mmsim.Micetro(PROVIDER['user'], PROVIDER['password'])
+    mmsim.generate(sim, ranges=20, ipam_records=2000, dns_records=1500)
+    workdir = tempfile.mkdtemp(prefix='callcount')
+
+    results = []
+    failures = 0
+    print("%-18s %-14s %5s %5s %7s %7s %-8s %s" % (
+        'target', 'scenario', 'GETs', 'max', 'writes', 'max', 'changed', 'result'))
+    try:
+        for target, scenario, scenario_args, max_gets, max_writes, changed in SCENARIOS:
+            counter = Counter(sim)
+            error = None
+            fails = scenario_args.get('fails')
+            try:
+                result = run_scenario(target, dict((key, val) for key, val in scenario_args.items() if key != 'fails'),
+                                      counter, workdir)
+            except Exception as err:
+                result = {}
+                error = "%s: %s" % (type(err).__name__, err)
+            if fails:
+                error = None if fails in (error or '') else "%s, expected to fail with '%s'" % (error or 'OK', fails)
+
+            gets = sum(1 for method, dummy in counter.calls if method == 'GET')
+            writes = sum(1 for method, dummy in counter.calls if method in WRITES)
+            if not error and result.get('failed'):
+                error = result.get('msg')
+            if not error and result.get('warnings'):
+                error = "; ".join(result['warnings'])
+            if not error and changed is not None and result.get('changed') != changed:
+                error = "changed is %s, expected %s" % (result.get('changed'), changed)
+            if not error and gets > max_gets:
+                error = "%d GETs, at most %d expected" % (gets, max_gets)
+            if not error and writes > max_writes:
+                error = "%d writes, at most %d expected" % (writes, max_writes)
+            path = NO_CALLS.get((target, scenario))
+            if not error and path and any(url.split('?', 1)[0] == path for method, url in counter.calls):
+                error = "calls %s, not expected" % path
+            earlier = FEWER_CALLS.get((target, scenario))
+            if not error and earlier:
+                calls = [len(res['calls']) for res in results if res['target'] == target and res['scenario'] == earlier]
+                if len(counter.calls) >= calls[0]:
+                    error = "%d calls, fewer than the %d of '%s' expected" % (len(counter.calls), calls[0], earlier)
+            if error:
+                failures += 1
+
+            print("%-18s %-14s %5d %5d %7d %7d %-8s %s" % (
+                target, scenario, gets, max_gets, writes, max_writes,
+                '-' if changed is None else result.get('changed'), error or 'OK'))
+            if args.verbose:
+                for method, url in counter.calls:
+                    print("    %-6s %s" % (method, url))
+            results.append({'target': target, 'scenario': scenario, 'gets': gets, 'writes': writes,
+                            'max_gets': max_gets, 'max_writes': max_writes, 'error': error,
+                            'calls': counter.calls})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%d scenarios, %d failed, %d API calls" % (
+        len(results), failures, sum(len(res['calls']) for res in results)))
+    if args.output:
+        with open(args.output, 'w') as fhandle:
+            json.dump({'failures': failures, 'results': results}, fhandle, indent=2, sort_keys=True)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
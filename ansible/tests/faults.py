@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""Latency and fault injection for the API client.
+
+A `FaultyTransport` wraps another transport, like the one of the
+simulator, and injects faults in the API calls:
+
+- latency: a delay before every call, from a distribution
+- resets: the connection is reset by the peer
+- 5xx bursts: a number of calls in a row get a 5xx error
+- slow bodies: the response body arrives at a limited speed
+- stalls: the server does not answer until the client times out
+
+The faults are defined per endpoint with `Rule` objects. The regular
+expression of a rule is matched against `<METHOD> <url>`, where the url
+is relative to `/mmws/api/`, and the first matching rule is used:
+
+    transport = FaultyTransport(sim.transport, [
+        Rule(r'^PUT IPAMRecords/', latency=lognormal(0.02, 0.5), reset=0.01),
+        Rule(r'.', latency=constant(0.005)),
+    ])
+    client.TRANSPORT = transport
+
+The named profiles in PROFILES are used by the `faults` benchmark.
+"""
+
+import errno
+import math
+import random
+import re
+import socket
+import threading
+import time
+
+
+# Latency distributions. Every distribution returns a function that is
+# called with a random generator and returns a delay in seconds.
+
+def constant(delay):
+    """Always the same delay."""
+    return lambda rnd: delay
+
+
+def uniform(low, high):
+    """A delay evenly spread between low and high."""
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def normal(mean, stddev):
+    """A normal distributed delay, never below 0."""
+    return lambda rnd: max(0.0, rnd.gauss(mean, stddev))
+
+
+def lognormal(median, sigma):
+    """A log-normal distributed delay, with a long tail like real networks."""
+    mu = math.log(median)
+    return lambda rnd: rnd.lognormvariate(mu, sigma)
+
+
+class Rule(object):
+    """The faults for the endpoints matching a regular expression.
+
+    - latency:    Distribution of the delay before a call
+    - reset:      Chance a call gets a connection reset
+    - burst:      Chance a call starts a burst of 5xx errors
+    - burst_len:  Number of calls in a 5xx burst
+    - status:     The 5xx status of a burst
+    - bandwidth:  Speed of the response body in bytes per second
+    - stall:      Chance a call stalls until the timeout
+    - timeout:    How long a stall takes, default the provider timeout
+    """
+
+    def __init__(self, pattern, latency=None, reset=0.0, burst=0.0, burst_len=5,
+                 status=503, bandwidth=None, stall=0.0, timeout=None):
+        self.pattern = re.compile(pattern)
+        self.latency = latency
+        self.reset = reset
+        self.burst = burst
+        self.burst_len = burst_len
+        self.status = status
+        self.bandwidth = bandwidth
+        self.stall = stall
+        self.timeout = timeout
+
+
+REASONS = {
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+
+class FaultyTransport(object):
+    """A transport that injects faults in the calls to another transport.
+
+    Every call is recorded in `calls` as a dict with the method, the url,
+    the injected fault (or None), the status and the elapsed time.
+    """
+
+    def __init__(self, transport, rules, seed=1, scale=1.0, sleep=time.sleep):
+        self.transport = transport
+        self.rules = rules
+        self.rnd = random.Random(seed)
+        self.scale = scale
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.bursts = {}
+        self.calls = []
+
+    def _delay(self, seconds):
+        if seconds > 0:
+            self.sleep(seconds * self.scale)
+
+    def _rule(self, name):
+        for rule in self.rules:
+            if rule.pattern.search(name):
+                return rule
+        return None
+
+    def __call__(self, method, apiurl, provider, body, headers):
+        path = apiurl.split('/mmws/api/', 1)[-1]
+        name = "%s %s" % (method, path)
+        rule = self._rule(name)
+        start = time.time()
+        call = {'method': method, 'url': path, 'fault': None, 'status': None}
+        try:
+            if rule is None:
+                status, reason, response = self.transport(method, apiurl, provider, body, headers)
+                call['status'] = status
+                return status, reason, response
+
+            # Draw all random numbers under the lock, so a seed gives the
+            # same faults, also with threads
+            with self.lock:
+                latency = rule.latency(self.rnd) if rule.latency else 0.0
+                reset = self.rnd.random() < rule.reset
+                stall = self.rnd.random() < rule.stall
+                burst = self.bursts.get(rule, 0)
+                if not burst and self.rnd.random() < rule.burst:
+                    burst = rule.burst_len
+                if burst:
+                    self.bursts[rule] = burst - 1
+
+            self._delay(latency)
+            if stall:
+                call['fault'] = 'stall'
+                self._delay(rule.timeout or provider.get('timeout') or 10)
+                raise socket.timeout('timed out')
+            if reset:
+                call['fault'] = 'reset'
+                raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+            if burst:
+                call['fault'] = str(rule.status)
+                call['status'] = rule.status
+                message = '{"error": {"code": 0, "message": "Injected fault"}}'
+                return rule.status, REASONS.get(rule.status, 'Server Error'), message.encode('utf8')
+
+            status, reason, response = self.transport(method, apiurl, provider, body, headers)
+            call['status'] = status
+            if rule.bandwidth and response:
+                call['fault'] = 'slow'
+                self._delay(float(len(response)) / rule.bandwidth)
+            return status, reason, response
+        finally:
+            call['elapsed'] = time.time() - start
+            with self.lock:
+                self.calls.append(call)
+
+    def summary(self):
+        """Return the number of calls and of every injected fault."""
+        faults = {}
+        for call in self.calls:
+            if call['fault']:
+                faults[call['fault']] = faults.get(call['fault'], 0) + 1
+        return {'calls': len(self.calls), 'faults': faults}
+
+
+# Fault profiles for the benchmarks, all times are in seconds
+PROFILES = {
+    'none': [],
+    'lan': [
+        Rule(r'.', latency=lognormal(0.001, 0.3)),
+    ],
+    'wan': [
+        Rule(r'.', latency=lognormal(0.02, 0.5)),
+    ],
+    'lossy': [
+        Rule(r'.', latency=lognormal(0.005, 0.5), reset=0.02, burst=0.01, burst_len=3),
+    ],
+    'slow': [
+        Rule(r'GetIPAMRecords|^GET Ranges$', latency=lognormal(0.005, 0.5), bandwidth=1e6),
+        Rule(r'.', latency=lognormal(0.005, 0.5)),
+    ],
+    'stalls': [
+        Rule(r'.', latency=lognormal(0.005, 0.5), stall=0.01, timeout=1.0),
+    ],
+}
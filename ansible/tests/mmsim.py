@@ -0,0 +1,1100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""Micetro API simulator.
+
+A stateful, in-memory emulation of the parts of the Micetro REST API
+(`/mmws/api`) that the modules and plugins use. It can be used in two
+ways:
+
+- As an HTTP server, so playbooks, `runtests` and `test_matrix` run
+  without a live Micetro:
+
+      ./mmsim.py --port 8080 --ranges 200 --ipam-records 100000 --dns-records 50000
+
+- In-process, as the `TRANSPORT` of a module or plugin:
+
+      sim = mmsim.Micetro()
+      mmsim.generate(sim, ranges=200, ipam_records=100000, dns_records=50000)
+      mm_inventory.TRANSPORT = sim.transport
+
+Only the behaviour the modules and plugins depend on is emulated, the
+simulator does not validate requests the way Micetro does.
+"""
+
+import argparse
+import base64
+import bisect
+import ipaddress
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote
+
+# The object types of the API with the key of a single object and of a
+# list of objects in a response.
+OBJTYPES = {
+    'ranges': ('Ranges', 'range', 'ranges'),
+    'ipamrecords': ('IPAMRecords', 'ipamRecord', 'ipamRecords'),
+    'dnszones': ('DNSZones', 'dnsZone', 'dnsZones'),
+    'dnsrecords': ('DNSRecords', 'dnsRecord', 'dnsRecords'),
+    'dnsviews': ('DNSViews', 'dnsView', 'dnsViews'),
+    'dnsservers': ('DNSServers', 'dnsServer', 'dnsServers'),
+    'dhcpscopes': ('DHCPScopes', 'dhcpScope', 'dhcpScopes'),
+    'dhcpreservations': ('DHCPReservations', 'dhcpReservation', 'dhcpReservations'),
+    'dhcpservers': ('DHCPServers', 'dhcpServer', 'dhcpServers'),
+    'users': ('Users', 'user', 'users'),
+    'groups': ('Groups', 'group', 'groups'),
+    'roles': ('Roles', 'role', 'roles'),
+    'devices': ('Devices', 'device', 'devices'),
+    'interfaces': ('Interfaces', 'interface', 'interfaces'),
+    'cloudnetworks': ('CloudNetworks', 'cloudNetwork', 'cloudNetworks'),
+    'cloudserviceaccounts': ('CloudServiceAccounts', 'cloudServiceAccount', 'cloudServiceAccounts'),
+}
+
+BUILTIN_ROLES = [
+    'Administrators (built-in)',
+    'DNS Administrators (built-in)',
+    'DHCP Administrators (built-in)',
+    'IPAM Administrators (built-in)',
+    'User Administrators (built-in)',
+    'Approvers (built-in)',
+    'Requesters (built-in)',
+]
+
+
+class APIError(Exception):
+    """An error response of the API."""
+
+    def __init__(self, status, message, code=0):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+        self.code = code
+
+
+def not_found(ref):
+    """Return the error for an unknown object."""
+    return APIError(404, "Object not found for reference: %s" % ref, 2049)
+
+
+def addr2int(address):
+    """Convert an IP address to an integer."""
+    return int(ipaddress.ip_address(address))
+
+
+def int2addr(number, version=4):
+    """Convert an integer to an IP address."""
+    if version == 6:
+        return str(ipaddress.IPv6Address(number))
+    return str(ipaddress.IPv4Address(number))
+
+
+def objfield(obj, field):
+    """Get a field of an object, or a custom property with that name."""
+    if field in obj:
+        return obj[field]
+    for key, val in obj.get('customProperties', {}).items():
+        if key.lower() == field.lower():
+            return val
+    lfield = field.lower()
+    for key, val in obj.items():
+        if key.lower() == lfield:
+            return val
+    return None
+
+
+class Filter(object):
+    """A Micetro filter expression.
+
+    Supports `field<op>value` terms with the operators =, !=, <, >, <=,
+    >=, ^= (starts with), $= (ends with) and @= (contains), combined with
+    `and`, `or`, `not` and parentheses. A term without an operator is a
+    quick search on the name or address of an object. Comparing is
+    case-insensitive, like Micetro does.
+    """
+
+    TERM = re.compile(r'^([A-Za-z_][\w.]*)\s*(!=|<=|>=|\^=|\$=|@=|=|<|>)\s*(.*)$', re.DOTALL)
+
+    def __init__(self, expression, quick=None):
+        self.expression = expression or ''
+        self.quick = quick
+        self.tokens = self._tokenize(self.expression)
+        self.pos = 0
+        self.tree = self._parse_or() if self.tokens else None
+
+    @staticmethod
+    def _tokenize(expression):
+        """Split an expression in parentheses, operators and terms."""
+        tokens = []
+        rest = expression.strip()
+        while rest:
+            if rest[0] in '()':
+                tokens.append(rest[0])
+                rest = rest[1:].strip()
+                continue
+            match = re.match(r'(and|or|not)(\s+|(?=\())', rest, re.IGNORECASE)
+            if match:
+                tokens.append(match.group(1).lower())
+                rest = rest[match.end():].strip()
+                continue
+            # A term runs until ' and ', ' or ' or a closing parenthesis
+            match = re.search(r'\s+(and|or)\s+|\)', rest, re.IGNORECASE)
+            end = match.start() if match else len(rest)
+            tokens.append(('term', rest[:end].strip()))
+            rest = rest[end:].strip()
+        return tokens
+
+    def _next(self):
+        token = self.tokens[self.pos] if self.pos < len(self.tokens) else None
+        self.pos += 1
+        return token
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek() == 'or':
+            self._next()
+            node = ('or', node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek() == 'and':
+            self._next()
+            node = ('and', node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        if self._peek() == 'not':
+            self._next()
+            return ('not', self._parse_not())
+        token = self._next()
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                raise APIError(400, "Invalid filter: %s" % self.expression, 1)
+            return node
+        if not isinstance(token, tuple):
+            raise APIError(400, "Invalid filter: %s" % self.expression, 1)
+        match = self.TERM.match(token[1])
+        if match:
+            return ('term', match.group(1), match.group(2), match.group(3).strip().strip('"\''))
+        return ('quick', token[1])
+
+    def __call__(self, obj):
+        """Check if an object matches the filter."""
+        return self.tree is None or self._eval(self.tree, obj)
+
+    def _eval(self, node, obj):
+        if node[0] == 'and':
+            return self._eval(node[1], obj) and self._eval(node[2], obj)
+        if node[0] == 'or':
+            return self._eval(node[1], obj) or self._eval(node[2], obj)
+        if node[0] == 'not':
+            return not self._eval(node[1], obj)
+        if node[0] == 'quick':
+            if self.quick:
+                return self.quick(obj, node[1])
+            return node[1].lower() in str(obj.get('name', '')).lower()
+        return self._compare(objfield(obj, node[1]), node[2], node[3])
+
+    @staticmethod
+    def _compare(value, oper, wanted):
+        """Compare a value of an object with the wanted value."""
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        if isinstance(value, (int, float)):
+            try:
+                wanted = type(value)(wanted)
+            except ValueError:
+                value = str(value)
+        if value is None:
+            value = ''
+        if isinstance(value, str):
+            value = value.lower()
+            wanted = wanted.replace('\\t', '\t').lower()
+        if oper == '=':
+            return value == wanted
+        if oper == '!=':
+            return value != wanted
+        if oper == '<':
+            return value < wanted
+        if oper == '>':
+            return value > wanted
+        if oper == '<=':
+            return value <= wanted
+        if oper == '>=':
+            return value >= wanted
+        if oper == '^=':
+            return str(value).startswith(wanted)
+        if oper == '$=':
+            return str(value).endswith(wanted)
+        return wanted in str(value)
+
+
+class Micetro(object):
+    """The in-memory state of a simulated Micetro."""
+
+    def __init__(self, user='apiuser', password='apipasswd'):
+        self.lock = threading.RLock()
+        self.credentials = {user: password}
+        self.objects = dict((objtype, {}) for objtype in OBJTYPES)
+        self.nextid = dict((objtype, 1) for objtype in OBJTYPES)
+        self.propdefs = dict((objtype, {}) for objtype in OBJTYPES)
+        # IPAM records by address, with a sorted index of the addresses
+        self.ipam = {}
+        self.ipam_index = []
+        # DNS records with an address as data, by address
+        self.dns_by_address = {}
+        # Temporary claims from NextFreeAddress, address -> expire time
+        self.claims = {}
+        # All API calls, as (method, path)
+        self.calls = []
+        # The change history, the last history_size changes
+        self.history = []
+        self.history_id = 0
+        self.history_size = 10000
+
+        # A Micetro always has the built-in roles and groups, a DNS server
+        # with a default view and the API user
+        for name in BUILTIN_ROLES:
+            self.add('roles', {'name': name, 'description': name, 'builtIn': True,
+                               'users': [], 'groups': []})
+            self.add('groups', {'name': name.replace(' (built-in)', ''), 'description': name,
+                                'builtIn': True, 'groupMembers': [], 'roles': []})
+        server = self.add('dnsservers', {'name': 'micetro.example.net.', 'type': 'BIND'})
+        self.add('dnsviews', {'name': '', 'dnsServerRef': server['ref']})
+        self.add('users', {'name': user, 'fullName': 'API user', 'description': '',
+                           'email': '', 'authenticationType': 'Internal',
+                           'groups': [], 'roles': []})
+
+    # Object store ---------------------------------------------------------
+
+    def add(self, objtype, obj):
+        """Add an object and give it a reference."""
+        with self.lock:
+            num = self.nextid[objtype]
+            self.nextid[objtype] += 1
+            obj['ref'] = "%s/%d" % (OBJTYPES[objtype][0], num)
+            obj.setdefault('customProperties', {})
+            self.objects[objtype][obj['ref']] = obj
+            if objtype == 'dnsrecords':
+                self._index_dns(obj)
+        return obj
+
+    def _index_dns(self, record, remove=False):
+        """Keep the address index of the A and AAAA records up to date."""
+        if record.get('type') not in ('A', 'AAAA'):
+            return
+        refs = self.dns_by_address.setdefault(record['data'], [])
+        if remove:
+            if record['ref'] in refs:
+                refs.remove(record['ref'])
+        else:
+            refs.append(record['ref'])
+
+    def get(self, ref):
+        """Find an object by reference, like `Ranges/3`."""
+        objtype = ref.split('/', 1)[0].lower()
+        if objtype == 'ipamrecords':
+            return self.ipam_record(ref.split('/', 1)[1])
+        obj = self.objects.get(objtype, {}).get("%s/%s" % (OBJTYPES.get(objtype, ('',))[0], ref.split('/', 1)[-1]))
+        if obj is None:
+            raise not_found(ref)
+        return obj
+
+    def find(self, objtype, name):
+        """Find an object by reference or name."""
+        if '/' in name:
+            return self.get(name)
+        for obj in self.objects[objtype].values():
+            if obj.get('name') == name:
+                return obj
+        raise not_found(name)
+
+    def delete(self, ref):
+        """Delete an object."""
+        obj = self.get(ref)
+        objtype = obj['ref'].split('/')[0].lower()
+        with self.lock:
+            del self.objects[objtype][obj['ref']]
+            if objtype == 'dnsrecords':
+                self._index_dns(obj, remove=True)
+            if objtype == 'dhcpreservations':
+                for address in obj['addresses']:
+                    record = self.ipam.get(address)
+                    if record and obj['ref'] in record['dhcpReservations']:
+                        record['dhcpReservations'].remove(obj['ref'])
+
+    def log(self, action, ref, name):
+        """Add a change to the history.
+
+        The object type of a change is the type in its reference, like
+        `IPAMRecords`, and the name of an IPAM record is its address. A
+        change of a DNS record is only a change of the DNS record, the
+        IPAM records of its addresses are not in the history.
+        """
+        with self.lock:
+            self.history_id += 1
+            self.history.append({
+                'id': self.history_id,
+                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'user': next(iter(self.credentials)),
+                'action': action,
+                'objType': ref.split('/', 1)[0],
+                'objRef': ref,
+                'objName': name or '',
+            })
+            if len(self.history) > self.history_size:
+                del self.history[:len(self.history) - self.history_size]
+
+    def log_addresses(self, obj):
+        """Log a change of the IPAM records of a DHCP reservation."""
+        for address in obj.get('addresses') or []:
+            self.log('Modified', 'IPAMRecords/%s' % address, address)
+
+    # Ranges and IPAM ------------------------------------------------------
+
+    def add_range(self, name, parent=None, **fields):
+        """Add a range in CIDR notation below an optional parent."""
+        network = ipaddress.ip_network(name, strict=False)
+        rng = {
+            'name': name,
+            'from': str(network[0]),
+            'to': str(network[-1]),
+            'parentRef': parent['ref'] if parent else '',
+            'adSiteRef': '',
+            'childRanges': [],
+            'dhcpScopes': [],
+            'subnet': True,
+            'locked': False,
+            'autoAssign': False,
+            'hasSchedule': False,
+            'hasMonitor': False,
+            'inheritAccess': True,
+            'isContainer': False,
+            'hasRogueAddresses': False,
+            'cloudNetworkRef': '',
+            'cloudAllocationPools': [],
+            'discoveredProperties': [],
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'lastModified': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'customProperties': {},
+        }
+        rng.update(fields)
+        rng['_first'] = int(network[0])
+        rng['_last'] = int(network[-1])
+        rng['_version'] = network.version
+        self.add('ranges', rng)
+        if parent:
+            parent['childRanges'].append({'ref': rng['ref'], 'objType': 'Ranges', 'name': name})
+            parent['isContainer'] = True
+        return rng
+
+    def add_scope(self, rng):
+        """Add a DHCP scope for a range."""
+        scope = self.add('dhcpscopes', {'name': rng['name'], 'rangeRef': rng['ref'],
+                                        'dhcpServerRef': 'DHCPServers/1',
+                                        'superscope': '', 'description': '',
+                                        'available': 0, 'enabled': True})
+        rng['dhcpScopes'].append({'ref': scope['ref'], 'objType': 'DHCPScopes'})
+        return scope
+
+    def ipam_record(self, address, create=False):
+        """Get the IPAM record of an address.
+
+        Addresses without a record are free and get a record on the fly.
+        """
+        if address.startswith('IPAMRecords/'):
+            address = address.split('/', 1)[1]
+        if address not in self.ipam:
+            try:
+                number = addr2int(address)
+            except ValueError:
+                raise not_found('IPAMRecords/%s' % address)
+            if not any(rng['_first'] <= number <= rng['_last']
+                       for rng in self.objects['ranges'].values()):
+                raise not_found('IPAMRecords/%s' % address)
+            record = {
+                'addrRef': "IPAMRecords/%s" % address,
+                'address': address,
+                'claimed': False,
+                'dhcpReservations': [],
+                'dhcpLeases': [],
+                'discoveryType': 'None',
+                'lastSeenDate': '',
+                'lastDiscoveryDate': '',
+                'lastKnownClientIdentifier': '',
+                'device': '',
+                'interface': '',
+                'ptrStatus': 'OK',
+                'extraneousPTR': False,
+                'customProperties': {},
+                'state': 'Free',
+                'usage': 0,
+                '_int': number,
+            }
+            if not create:
+                return record
+            with self.lock:
+                self.ipam[address] = record
+                bisect.insort(self.ipam_index, (number, address))
+        return self.ipam[address]
+
+    def set_state(self, record):
+        """Update the state of an IPAM record after a change."""
+        assigned = (self.dns_by_address.get(record['address']) or record['dhcpReservations'] or
+                    record['dhcpLeases'])
+        if assigned:
+            record['state'] = 'Assigned'
+        elif record['claimed']:
+            record['state'] = 'Claimed'
+        else:
+            record['state'] = 'Free'
+
+    def records_in(self, first, last):
+        """Return the IPAM records with an address from first to last."""
+        start = bisect.bisect_left(self.ipam_index, (first, ''))
+        end = bisect.bisect_right(self.ipam_index, (last, '\uffff'))
+        return [self.ipam[address] for dummy, address in self.ipam_index[start:end]]
+
+    def render_ipam(self, record):
+        """Return an IPAM record as the API does."""
+        self.set_state(record)
+        out = dict((key, val) for key, val in record.items() if not key.startswith('_'))
+        out['dnsHosts'] = []
+        for ref in self.dns_by_address.get(record['address'], []):
+            out['dnsHosts'].append({'dnsRecord': self.render(self.objects['dnsrecords'][ref]),
+                                    'ptrStatus': 'OK', 'relatedRecords': []})
+        out['dhcpReservations'] = [self.render(self.objects['dhcpreservations'][ref])
+                                   for ref in record['dhcpReservations']
+                                   if ref in self.objects['dhcpreservations']]
+        return out
+
+    def render_range(self, rng):
+        """Return a range as the API does, with the utilization."""
+        out = self.render(rng)
+        size = rng['_last'] - rng['_first'] + 1
+        used = len(self.records_in(rng['_first'], rng['_last']))
+        out['utilizationPercentage'] = int(100 * used / size) if size else 0
+        return out
+
+    @staticmethod
+    def render(obj):
+        """Return an object without the internal fields."""
+        return dict((key, val) for key, val in obj.items() if not key.startswith('_'))
+
+    def range_for(self, ref):
+        """Find a range by reference, name or address."""
+        if ref.startswith('Ranges/') or '/' in ref and not re.match(r'^[\d.:a-fA-F]+/\d+$', ref):
+            return self.get(ref)
+        for rng in self.objects['ranges'].values():
+            if rng['name'] == ref:
+                return rng
+        raise not_found(ref)
+
+    def free_addresses(self, rng, start=None, exclude_dhcp=False):
+        """Generate the free addresses in a range."""
+        now = time.time()
+        first = rng['_first'] + (1 if rng['_version'] == 4 and rng['_last'] > rng['_first'] + 1 else 0)
+        last = rng['_last'] - (1 if rng['_version'] == 4 and rng['_last'] > rng['_first'] + 1 else 0)
+        if start:
+            first = max(first, addr2int(start))
+        used = set(number for number, dummy in
+                   self.ipam_index[bisect.bisect_left(self.ipam_index, (first, '')):
+                                   bisect.bisect_right(self.ipam_index, (last, '\uffff'))]
+                   if self.ipam[int2addr(number, rng['_version'])]['state'] != 'Free')
+        for number in range(first, last + 1):
+            address = int2addr(number, rng['_version'])
+            if number in used or self.claims.get(address, 0) > now:
+                continue
+            if exclude_dhcp and rng['dhcpScopes']:
+                continue
+            yield address
+
+    # Request handling -----------------------------------------------------
+
+    def handle(self, method, path, body=None):
+        """Handle an API call.
+
+        The path is relative to `/mmws/api/` and can have a query string.
+        The body is the decoded JSON body, or None. Returns the HTTP status,
+        the reason and the response as a dict, or None for no content.
+        """
+        with self.lock:
+            self.calls.append((method, path))
+        if '?' in path:
+            path, query = path.split('?', 1)
+        else:
+            query = ''
+        params = dict(body) if isinstance(body, dict) else {}
+        params.update(parse_qsl(query.replace('+', '%2B'), keep_blank_values=True))
+
+        segs = [unquote(seg) for seg in path.strip('/').split('/') if seg]
+        # Some modules send a reference prefixed with its type (Users/Users/3)
+        if len(segs) > 2 and segs[0].lower() == segs[1].lower():
+            segs = segs[1:]
+        try:
+            with self.lock:
+                response = self._route(method, segs, params)
+        except APIError as err:
+            return err.status, 'Error', {'error': {'code': err.code, 'message': err.message}}
+        if response is None:
+            return 204, 'No Content', None
+        return 200, 'OK', response
+
+    @property
+    def transport(self):
+        """A transport for the API client that calls the simulator."""
+
+        def transport(method, apiurl, provider, body, headers):
+            if isinstance(body, bytes):
+                body = body.decode('utf8')
+            path = apiurl.split('/mmws/api/', 1)[-1]
+            status, reason, response = self.handle(method, path, json.loads(body) if body else None)
+            if response is None:
+                return status, reason, b''
+            return status, reason, json.dumps(response).encode('utf8')
+        return transport
+
+    def _route(self, method, segs, params):
+        """Find the handler for a request."""
+        if segs[0].lower() == 'command':
+            handler = getattr(self, 'cmd_%s' % segs[1], None)
+            if handler is None:
+                raise APIError(404, "Unknown command: %s" % segs[1], 1)
+            return handler(params)
+
+        objtype = segs[0].lower()
+        if objtype not in OBJTYPES:
+            raise APIError(404, "Unknown object type: %s" % segs[0], 1)
+
+        if len(segs) >= 3 and segs[2] == 'PropertyDefinitions':
+            return self.propertydefinitions(method, objtype, segs[3] if len(segs) > 3 else None, params)
+        if len(segs) == 1:
+            return getattr(self, 'list_%s' % objtype, self.list_objects)(method, objtype, params)
+        ref = '/'.join(segs[:2])
+        if len(segs) == 2:
+            return self.single(method, ref, params)
+        if len(segs) == 3 and segs[2] == 'NextFreeAddress':
+            return self.nextfreeaddress(ref, params)
+        if len(segs) == 3 and segs[2] == 'DNSRecords':
+            return self.zone_records(ref, params)
+        if len(segs) == 3 and segs[2] == 'DHCPReservations':
+            return self.scope_reservations(method, ref, params)
+        if len(segs) == 3 and segs[2] == 'IPAMRecords':
+            rng = self.get(ref)
+            return self.cmd_GetIPAMRecords(dict(params, rangeRef=rng['ref']))
+        if len(segs) == 4:
+            return self.membership(method, ref, '/'.join(segs[2:4]))
+        raise APIError(404, "Unknown path: %s" % '/'.join(segs), 1)
+
+    def _page(self, objs, params):
+        """Apply the limit and offset of a request."""
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 0)
+        if limit:
+            return objs[offset:offset + limit]
+        return objs[offset:]
+
+    def _result_list(self, objtype, objs, params, render=None):
+        """Return a list of objects as the API does."""
+        render = render or self.render
+        page = self._page(objs, params)
+        return {'result': {OBJTYPES[objtype][2]: [render(obj) for obj in page],
+                           'totalResults': len(objs)}}
+
+    def list_objects(self, method, objtype, params):
+        """List, filter or create objects of a type."""
+        if method == 'POST':
+            return self.create(objtype, params)
+        objs = list(self.objects[objtype].values())
+        flt = Filter(params.get('filter'))
+        return self._result_list(objtype, [obj for obj in objs if flt(obj)], params)
+
+    def list_ranges(self, method, objtype, params):
+        """List ranges, a quick search on an address finds its ranges."""
+        if method == 'POST':
+            return self.create(objtype, params)
+
+        def quick(rng, term):
+            if rng['name'] == term:
+                return True
+            try:
+                net = ipaddress.ip_network(term, strict=False)
+            except ValueError:
+                return term.lower() in rng['name'].lower()
+            if net.version != rng['_version']:
+                return False
+            if net.num_addresses == 1:
+                return rng['_first'] <= int(net[0]) <= rng['_last']
+            return rng['_first'] == int(net[0]) and rng['_last'] == int(net[-1])
+
+        flt = Filter(params.get('filter'), quick=quick)
+        objs = [rng for rng in self.objects['ranges'].values() if flt(rng)]
+        return self._result_list('ranges', objs, params, render=self.render_range)
+
+    def list_dnsviews(self, method, objtype, params):
+        """List DNS views, optionally for a DNS server."""
+        server = params.get('dnsServerRef')
+        objs = list(self.objects['dnsviews'].values())
+        if server:
+            try:
+                server = self.find('dnsservers', server)['ref']
+            except APIError:
+                try:
+                    server = self.find('dnsservers', server + '.')['ref']
+                except APIError:
+                    raise not_found(params['dnsServerRef'])
+            objs = [view for view in objs if view['dnsServerRef'] == server]
+        return self._result_list('dnsviews', objs, params)
+
+    def list_dnszones(self, method, objtype, params):
+        """List DNS zones, optionally in a DNS view."""
+        if method == 'POST':
+            return self.create('dnszones', params)
+        view = params.get('dnsViewRef')
+        if view and '/' not in view:
+            view = 'DNSViews/%s' % view
+        flt = Filter(params.get('filter'), quick=lambda zone, term: zone['name'].rstrip('.').lower() == term.rstrip('.').lower())
+        objs = [zone for zone in self.objects['dnszones'].values()
+                if flt(zone) and (not view or zone['dnsViewRef'] == view)]
+        return self._result_list('dnszones', objs, params)
+
+    def list_ipamrecords(self, method, objtype, params):
+        """List the IPAM records."""
+        return self.cmd_GetIPAMRecords(params)
+
+    def list_dnsrecords(self, method, objtype, params):
+        """List or create DNS records."""
+        if method != 'POST':
+            return self.list_objects(method, objtype, params)
+        refs = []
+        errors = []
+        for record in params.get('dnsRecords', []):
+            record = dict(record)
+            try:
+                self.get(record.get('dnsZoneRef', ''))
+            except APIError as err:
+                errors.append(err.message)
+                continue
+            record.setdefault('ttl', '')
+            record.setdefault('comment', '')
+            record.setdefault('enabled', True)
+            record.setdefault('aging', 0)
+            if record.get('type') in ('A', 'AAAA'):
+                ipam = self.ipam_record(record['data'], create=True)
+                if ipam['claimed'] and ipam['state'] == 'Claimed':
+                    errors.append("Address %s is claimed" % record['data'])
+                    continue
+            record = self.add('dnsrecords', record)
+            refs.append(record['ref'])
+            self.log('Created', record['ref'], record.get('name'))
+            self.log_addresses(record)
+        return {'result': {'objRefs': refs, 'errors': errors}}
+
+    def create(self, objtype, params):
+        """Create an object from a POST."""
+        key = OBJTYPES[objtype][1]
+        if key not in params:
+            raise APIError(400, "Missing %s in request" % key, 1)
+        obj = dict(params[key])
+        if objtype == 'users':
+            obj.pop('password', None)
+            obj.setdefault('groups', [])
+            obj.setdefault('roles', [])
+        elif objtype == 'groups':
+            obj.setdefault('groupMembers', [])
+            obj.setdefault('roles', [])
+        elif objtype == 'roles':
+            obj.setdefault('users', [])
+            obj.setdefault('groups', [])
+        elif objtype == 'dnszones':
+            if obj.get('dnsViewRef') and '/' not in str(obj['dnsViewRef']):
+                obj['dnsViewRef'] = 'DNSViews/%s' % obj['dnsViewRef']
+            obj.setdefault('dynamic', False)
+            obj.setdefault('adIntegrated', False)
+            obj['customProperties'] = dict((prop['name'], prop['value']) for prop in obj.get('customProperties', []))
+        for other in self.objects[objtype].values():
+            if other.get('name') == obj.get('name') and objtype != 'dnsrecords':
+                raise APIError(400, "An object with the name %s already exists" % obj.get('name'), 1)
+        obj = self.add(objtype, obj)
+        self.log('Created', obj['ref'], obj.get('name'))
+        self.log_addresses(obj)
+        return {'result': {'ref': obj['ref']}}
+
+    def single(self, method, ref, params):
+        """Get, change or delete a single object."""
+        objtype = ref.split('/')[0].lower()
+        if method == 'GET':
+            obj = self.get(ref)
+            if objtype == 'ipamrecords':
+                return {'result': {'ipamRecord': self.render_ipam(obj)}}
+            if objtype == 'ranges':
+                return {'result': {'range': self.render_range(obj)}}
+            return {'result': {OBJTYPES[objtype][1]: self.render(obj)}}
+        if method == 'DELETE':
+            obj = self.get(ref)
+            self.delete(ref)
+            self.log('Deleted', obj['ref'], obj.get('name'))
+            self.log_addresses(obj)
+            return None
+        if method in ('PUT', 'PATCH'):
+            if objtype == 'ipamrecords':
+                return self.update_ipam(ref, params)
+            obj = self.get(ref)
+            self.update(obj, params)
+            return None
+        raise APIError(405, "Method %s not allowed" % method, 1)
+
+    def update(self, obj, params):
+        """Change the properties of an object."""
+        props = params.get('properties', {})
+        if isinstance(props, list):
+            props = dict((prop['name'], prop['value']) for prop in props)
+        if obj['ref'].startswith('DNSRecords/'):
+            self._index_dns(obj, remove=True)
+            self.log_addresses(obj)
+        if params.get('deleteUnspecified'):
+            obj['customProperties'] = {}
+        for key, val in props.items():
+            if key == 'password':
+                continue
+            if key == 'addresses' and isinstance(val, str):
+                val = [val]
+            if key in obj and key != 'customProperties':
+                obj[key] = val
+            else:
+                obj['customProperties'][key] = val
+        if obj['ref'].startswith('DNSRecords/'):
+            self._index_dns(obj)
+        if obj['ref'].startswith('DHCPReservations/'):
+            for address in obj['addresses']:
+                record = self.ipam_record(address, create=True)
+                if obj['ref'] not in record['dhcpReservations']:
+                    record['dhcpReservations'].append(obj['ref'])
+        self.log('Modified', obj['ref'], obj.get('name'))
+        self.log_addresses(obj)
+
+    def update_ipam(self, ref, params):
+        """Change an IPAM record, which claims a free address."""
+        record = self.ipam_record(ref, create=True)
+        props = params.get('properties', {})
+        if isinstance(props, list):
+            props = dict((prop['name'], prop['value']) for prop in props)
+        if params.get('deleteUnspecified'):
+            record['customProperties'] = {}
+        for key, val in props.items():
+            if key == 'claimed':
+                record['claimed'] = val if isinstance(val, bool) else str(val).lower() == 'true'
+            elif key in record and not key.startswith('_'):
+                record[key] = val
+            else:
+                record['customProperties'][key] = val
+        self.set_state(record)
+        self.log('Modified', record['addrRef'], record['address'])
+        return None
+
+    def zone_records(self, ref, params):
+        """List the DNS records in a zone."""
+        zone = self.get(ref)
+        flt = Filter(params.get('filter'))
+        objs = [rec for rec in self.objects['dnsrecords'].values()
+                if rec['dnsZoneRef'] == zone['ref'] and flt(rec)]
+        return self._result_list('dnsrecords', objs, params)
+
+    def scope_reservations(self, method, ref, params):
+        """List or create the DHCP reservations in a scope."""
+        scope = self.get(ref)
+        if method != 'POST':
+            objs = [res for res in self.objects['dhcpreservations'].values()
+                    if res['dhcpScopeRef'] == scope['ref']]
+            return self._result_list('dhcpreservations', objs, params)
+        reservation = dict(params.get('dhcpReservation', {}))
+        reservation['dhcpScopeRef'] = scope['ref']
+        reservation = self.add('dhcpreservations', reservation)
+        for address in reservation.get('addresses', []):
+            record = self.ipam_record(address, create=True)
+            record['dhcpReservations'].append(reservation['ref'])
+            self.set_state(record)
+        self.log('Created', reservation['ref'], reservation.get('name'))
+        self.log_addresses(reservation)
+        return {'result': {'ref': reservation['ref']}}
+
+    def membership(self, method, ref, member):
+        """Add or remove a user, group or role to or from another one."""
+        first = self.get(ref)
+        second = self.get(member)
+        links = {
+            ('Groups', 'Users'): ('groupMembers', 'groups'),
+            ('Groups', 'Roles'): ('roles', 'groups'),
+            ('Users', 'Roles'): ('roles', 'users'),
+            ('Users', 'Groups'): ('groups', 'groupMembers'),
+            ('Roles', 'Users'): ('users', 'roles'),
+            ('Roles', 'Groups'): ('groups', 'roles'),
+        }
+        key = (first['ref'].split('/')[0], second['ref'].split('/')[0])
+        if key not in links:
+            raise APIError(400, "Cannot link %s to %s" % (ref, member), 1)
+        field1, field2 = links[key]
+        link1 = {'ref': second['ref'], 'objType': key[1], 'name': second['name']}
+        link2 = {'ref': first['ref'], 'objType': key[0], 'name': first['name']}
+        for obj, field, link in ((first, field1, link1), (second, field2, link2)):
+            current = [item for item in obj.setdefault(field, []) if item['ref'] != link['ref']]
+            if method == 'PUT':
+                current.append(link)
+            obj[field] = current
+        return None
+
+    def propertydefinitions(self, method, objtype, name, params):
+        """Manage the custom property definitions of an object type."""
+        defs = self.propdefs[objtype]
+        ref = "PropertyDefinitions/%s" % OBJTYPES[objtype][0]
+        if name is None:
+            if method == 'POST':
+                prop = dict(params['propertyDefinition'])
+                defs[prop['name']] = prop
+                self.log('Created', ref, prop['name'])
+                return {'result': {'ref': prop['name']}}
+            return {'result': {'propertyDefinitions': list(defs.values()),
+                               'totalResults': len(defs)}}
+        if name not in defs:
+            raise APIError(404, "Property definition %s not found" % name, 2049)
+        if method == 'GET':
+            return {'result': {'propertyDefinition': defs[name]}}
+        if method == 'DELETE':
+            del defs[name]
+            self.log('Deleted', ref, name)
+            return None
+        defs[name].update(params.get('propertyDefinition', {}))
+        self.log('Modified', ref, name)
+        return None
+
+    def nextfreeaddress(self, ref, params):
+        """Find the next free address in a range."""
+        rng = self.get(ref)
+        exclude_dhcp = str(params.get('excludeDHCP', '')).lower() in ('true', '1')
+        for address in self.free_addresses(rng, params.get('startAddress'), exclude_dhcp):
+            claim = int(params.get('temporaryClaimTime') or 0)
+            if claim:
+                self.claims[address] = time.time() + claim
+            return {'result': {'address': address}}
+        return None
+
+    def cmd_GetIPAMRecords(self, params):
+        """Get the IPAM records, in a range or everywhere."""
+        if params.get('rangeRef'):
+            rng = self.range_for(params['rangeRef'])
+            records = self.records_in(rng['_first'], rng['_last'])
+        else:
+            records = [self.ipam[address] for dummy, address in self.ipam_index]
+        for record in records:
+            self.set_state(record)
+        flt = Filter(params.get('filter'))
+        records = [record for record in records if flt(record)]
+        return self._result_list('ipamrecords', records, params, render=self.render_ipam)
+
+    def cmd_GetHistory(self, params):
+        """Get the change history, oldest first or with sortOrder=Descending newest first."""
+        flt = Filter(params.get('filter'))
+        entries = [entry for entry in self.history if flt(entry)]
+        if str(params.get('sortOrder', '')).lower() == 'descending':
+            entries.reverse()
+        return {'result': {'historyEntries': self._page(entries, params),
+                           'totalResults': len(entries)}}
+
+
+# Synthetic estates ---------------------------------------------------------
+
+LOCATIONS = ['London', 'Amsterdam', 'Groesbeek', 'Reykjavik', 'New York', 'Paris', 'Berlin', 'Tokyo']
+OWNERS = ['Ton Kersten', 'Beppie di Klaveri', 'johndoe', 'angelina', 'Carsten', 'David']
+ENVIRONMENTS = ['production', 'acceptance', 'test', 'development']
+
+
+def custom_properties(rnd, count):
+    """Create a set of custom properties for an IPAM record."""
+    props = {}
+    vocab = [('location', LOCATIONS), ('owner', OWNERS), ('environment', ENVIRONMENTS)]
+    for num in range(count):
+        if num < len(vocab):
+            name, values = vocab[num]
+        else:
+            name, values = 'prop%d' % num, ['value%d' % val for val in range(10)]
+        props[name] = rnd.choice(values)
+    return props
+
+
+def generate(sim, ranges=200, ipam_records=100000, dns_records=50000,
+             custom_props=3, sites=4, zones=10, seed=1):
+    """Fill a simulated Micetro with a synthetic estate.
+
+    The estate is a 10.0.0.0/8 container with a /16 per site and the
+    ranges spread over the sites. The assigned IPAM records are spread
+    evenly over the ranges and the first `dns_records` of them get an
+    A record in one of the zones, so they show up in the inventory.
+    """
+    rnd = random.Random(seed)
+    per_range = max(1, -(-ipam_records // max(ranges, 1)))
+    prefix = 32
+    while (1 << (32 - prefix)) - 2 < per_range * 1.25:
+        prefix -= 1
+    per_site = -(-ranges // sites)
+
+    for name in custom_properties(rnd, custom_props):
+        sim.propdefs['ipamrecords'][name] = {
+            'name': name, 'type': 'String', 'system': False, 'mandatory': False,
+            'readOnly': False, 'multiLine': False, 'defaultValue': '',
+            'cloudTags': [], 'listItems': []}
+
+    view = list(sim.objects['dnsviews'].values())[0]
+    zonelist = [sim.add('dnszones', {'name': 'zone%d.example.net.' % num, 'dnsViewRef': view['ref'],
+                                     'type': 'Master', 'dynamic': False, 'authority': 'micetro.example.net.',
+                                     'adIntegrated': False, 'customProperties': {}})
+                for num in range(zones)]
+
+    top = sim.add_range('10.0.0.0/8')
+    leaves = []
+    for site in range(sites):
+        container = sim.add_range('10.%d.0.0/16' % site, parent=top,
+                                  customProperties={'location': LOCATIONS[site % len(LOCATIONS)]})
+        base = int(ipaddress.ip_address('10.%d.0.0' % site))
+        for num in range(per_site):
+            if len(leaves) >= ranges:
+                break
+            network = ipaddress.ip_network((base + num * (1 << (32 - prefix)), prefix))
+            leaves.append(sim.add_range(str(network), parent=container))
+    for rng in leaves[:max(1, len(leaves) // 10)]:
+        sim.add_scope(rng)
+
+    count = 0
+    for num in range(ipam_records):
+        rng = leaves[num % len(leaves)]
+        address = int2addr(rng['_first'] + 1 + num // len(leaves))
+        record = sim.ipam_record(address, create=True)
+        record['customProperties'] = custom_properties(rnd, custom_props)
+        record['usage'] = 9
+        if count < dns_records:
+            zone = zonelist[count % len(zonelist)]
+            sim.add('dnsrecords', {'name': 'srv%06d' % count, 'type': 'A', 'data': address,
+                                   'ttl': '', 'comment': '', 'enabled': True, 'aging': 0,
+                                   'dnsZoneRef': zone['ref']})
+            count += 1
+        else:
+            record['claimed'] = True
+        sim.set_state(record)
+    return sim
+
+
+# HTTP server ---------------------------------------------------------------
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP request handler for the simulator."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'mmsim/1.0'
+
+    def _authorized(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return False
+        user, dummy, password = base64.b64decode(auth[6:]).decode('utf8').partition(':')
+        return self.server.sim.credentials.get(user) == password
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.server.redirect:
+            self.send_response(301, 'Moved Permanently')
+            self.send_header('Location', self.server.redirect + self.path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not self.path.startswith('/mmws/api/'):
+            status, reason, response = 404, 'Not Found', {'error': {'code': 1, 'message': 'Not found'}}
+        elif not self._authorized():
+            status, reason, response = 401, 'Unauthorized', {'error': {'code': 1, 'message': 'Invalid credentials'}}
+        else:
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                data = None
+            status, reason, response = self.server.sim.handle(self.command, self.path[len('/mmws/api/'):], data)
+        payload = json.dumps(response).encode('utf8') if response is not None else b''
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_PATCH = _handle
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+def serve(sim, host='127.0.0.1', port=8080, certfile=None, keyfile=None, verbose=False, redirect=None):
+    """Run the simulator as an HTTP(S) server.
+
+    With redirect every request is redirected to that URL, followed by
+    the path of the request.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.sim = sim
+    server.redirect = redirect
+    server.verbose = verbose
+    if certfile:
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def main():
+    """Start here."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--user', default='apiuser')
+    parser.add_argument('--password', default='apipasswd')
+    parser.add_argument('--certfile', help='Serve HTTPS with this certificate')
+    parser.add_argument('--keyfile', help='Private key of the certificate')
+    parser.add_argument('--ranges', type=int, default=20)
+    parser.add_argument('--ipam-records', type=int, default=1000)
+    parser.add_argument('--dns-records', type=int, default=500)
+    parser.add_argument('--custom-properties', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    start = time.time()
+    sim = Micetro(args.user, args.password)
+    generate(sim, ranges=args.ranges, ipam_records=args.ipam_records,
+             dns_records=args.dns_records, custom_props=args.custom_properties,
+             seed=args.seed)
+    print("Generated %d ranges, %d IPAM records and %d DNS records in %.1fs" % (
+        len(sim.objects['ranges']), len(sim.ipam), len(sim.objects['dnsrecords']), time.time() - start))
+
+    server = serve(sim, args.host, args.port, args.certfile, args.keyfile, args.verbose)
+    print("Serving the Micetro API on %s://%s:%d/mmws/api" % (
+        'https' if args.certfile else 'http', args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""Helpers for the Micetro tests and benchmarks.
+
+The plugins and the modules are not a Python package, so they are
+loaded from their files. The modules are built with `src/doit` when
+needed.
+"""
+
+import glob
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRCDIR = os.path.join(TOPDIR, 'src')
+LIBDIR = os.path.join(TOPDIR, 'library')
+
+MODULES = sorted(os.path.basename(fname)[:-3] for fname in glob.glob(os.path.join(SRCDIR, 'mm_*.py')))
+
+# The provider for the simulator in mmsim.py
+PROVIDER = {
+    'mmurl': 'http://micetro.example.net',
+    'user': 'apiuser',
+    'password': 'apipasswd',
+}
+
+PLUGINS = {
+    'mm_inventory': os.path.join(TOPDIR, 'plugins', 'inventory', 'mm_inventory.py'),
+    'mm_freeip': os.path.join(TOPDIR, 'plugins', 'lookup', 'mm_freeip.py'),
+    'mm_ipinfo': os.path.join(TOPDIR, 'plugins', 'lookup', 'mm_ipinfo.py'),
+}
+
+
+def load_plugin(name):
+    """Load a Micetro plugin by name (mm_inventory, mm_freeip, ...)."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, PLUGINS[name])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_client():
+    """Load the API client.
+
+    All plugins and modules have the same client, the one from the
+    inventory plugin is used.
+    """
+    return load_plugin('mm_inventory')
+
+
+def build():
+    """Build the modules with `src/doit` when they are missing or stale."""
+    sources = [os.path.join(SRCDIR, fname) for fname in ('header', 'imports', 'include.py')]
+    newest = max(os.path.getmtime(fname) for fname in sources)
+    for name in MODULES:
+        target = os.path.join(LIBDIR, name + '.py')
+        source = os.path.join(SRCDIR, name + '.py')
+        if not os.path.exists(target) or os.path.getmtime(target) < max(newest, os.path.getmtime(source)):
+            subprocess.check_call(['./doit'], cwd=SRCDIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return
+
+
+def load_module(name):
+    """Load a Micetro module by name (mm_claimip, mm_zone, ...)."""
+    if name in sys.modules:
+        return sys.modules[name]
+    build()
+    spec = importlib.util.spec_from_file_location(name, os.path.join(LIBDIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_inventory(transport, workdir, inventory=None, **options):
+    """Build an inventory with the inventory plugin.
+
+    The options are the settings of the inventory configuration, the
+    connection settings are the ones of PROVIDER. The configuration is
+    written to `workdir`. The hosts are added to `inventory`, like for
+    the next source of an inventory load, or to a new inventory.
+    Returns the inventory data.
+    """
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.plugins.loader import inventory_loader
+
+    # Inventory plugins need to be set up by the plugin loader
+    inventory_loader.add_directory(os.path.dirname(PLUGINS['mm_inventory']))
+    plugin = inventory_loader.get('mm_inventory')
+    sys.modules[type(plugin).__module__].TRANSPORT = transport
+
+    config = {
+        'plugin': 'mm_inventory',
+        'host': PROVIDER['mmurl'],
+        'user': PROVIDER['user'],
+        'password': PROVIDER['password'],
+    }
+    config.update(options)
+    path = os.path.join(workdir, 'mm_inventory.yml')
+    with open(path, 'w') as fhandle:
+        json.dump(config, fhandle)
+
+    if inventory is None:
+        inventory = InventoryData()
+    plugin.parse(inventory, DataLoader(), path, cache=True)
+    return inventory